@@ -2,63 +2,250 @@
 from contextlib import asynccontextmanager
 from data_store import enrollments
 from models import EnrollRequest
-from database import init_db
+from database import init_db, db
 from sync import Sync
-from mqtt_handler import start_mqtt_client, stop_mqtt_client
-import subprocess
+from reports import Reports
+from reconcile import Reconcile
+from archive import archiver
+from mqtt_handler import start_mqtt_client, stop_mqtt_client, MQTT_SUBSYSTEM
+from ingest import get_ingestor
+from identity_index import identity_index, assign_enrolled_card
+from course_catalog import course_catalog
+from lms_uploader import get_uploader
+from session_context import session_contexts
+from tap_dedup import tap_dedup
+from enrollment_manager import get_enrollment_manager, EnrollmentError
+from enrollment_events import enrollment_events, FINAL_EVENT_TYPES, ENROLLMENT_EVENT_TOPIC
+from enrollment_jobs import EnrollmentJobs
+from cluster import cluster, CLUSTER_SUBSYSTEM
+from metrics import (
+    Gauge, MetricsMiddleware, WEBSOCKETS_ACTIVE, ENROLLMENT_STAGE_SECONDS, ENROLLMENT_SECONDS,
+    render as render_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE,
+)
+from health import health, ReadinessGate, READY, FAILED
+from log import get_logger, start_logging, stop_logging
 import time
 import asyncio
 from fastapi import (
     FastAPI, 
-    BackgroundTasks, 
+    Response,
     WebSocket, 
     WebSocketDisconnect,
 )
+from fastapi.middleware.gzip import GZipMiddleware
 
-mqtt_task = None
+start_logging()
+log = get_logger("app")
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
+startup_task = None
+follow_task = None
+
+FOLLOW_INTERVAL_S = 0.5 # How often the leader picks up card and course changes made by other workers
+
+async def _start_subsystem(name: str, start) -> bool:
+    """Runs one startup step and records the outcome in the health report; failures are logged, not raised."""
+    started = time.perf_counter()
+    try:
+        await start()
+    except Exception as e:
+        health.set(name, FAILED, repr(e))
+        log.exception("Application startup: %s failed", name)
+        return False
+    health.set(name, READY)
+    log.info("Application startup: %s ready in %.0f ms", name, (time.perf_counter() - started) * 1000)
+    return True
+
+async def _start_services():
     """
-    Lifespan event to initialize the database connection.
-    This will run once when the application starts.
+    Brings the subsystems up behind the already-serving HTTP server. Everything
+    touching the database waits for the schema; the leader's services wait
+    for the card index too, since taps are resolved against it.
     """
-    global mqtt_task
-    init_db()
-    print('Application startup: Database schema initialized')
+    if not await _start_subsystem("database", lambda: init_db(outbox=get_uploader().enabled)):
+        return
+    if not await _start_subsystem("identity", lambda: identity_index.load(db)):
+        return
+    await cluster.start()
 
-    print('Application startup: Starting MQTT client')
-    mqtt_task = asyncio.create_task(start_mqtt_client())
-    print('Application startup: MQTT client task created')
-    yield
-
-    if mqtt_task:
-        mqtt_task.cancel()
+async def _follow_other_workers():
+    """Keeps the leader's card index and course catalog current with writes made through other workers."""
+    while True:
+        await asyncio.sleep(FOLLOW_INTERVAL_S)
         try:
-            await mqtt_task
-        except asyncio.CancelledError:
-            pass
+            await identity_index.catch_up(db)
+            await db.read(course_catalog.ensure_fresh, True)
+        except Exception as e:
+            log.warning("Could not pick up changes from other workers: %r", e)
+
+async def _start_leader_services():
+    """
+    The services with a single owner across workers: the broker subscription
+    with its open lecture sessions, the terminals, the LMS upload and archival.
+    """
+    global follow_task
+    health.register(MQTT_SUBSYSTEM, required=False) # HTTP sync works without the broker
+    health.register("enrollment", required=False)
+    await identity_index.catch_up(db) # Writes made while another worker led
+    follow_task = asyncio.create_task(_follow_other_workers())
+    session_contexts.start()
+    start_mqtt_client()
+    get_uploader().start()
+    archiver.start()
+    await _start_subsystem("enrollment", get_enrollment_manager().start)
+    await enrollment_jobs.start()
+
+async def _stop_leader_services():
+    global follow_task
+    if follow_task is not None:
+        follow_task.cancel()
+        follow_task = None
     await stop_mqtt_client()
-    print('Application shutdown:MQTT client stopped')
-    print('Application shutdown: All services stopped')
+    log.info('MQTT client stopped')
+    await session_contexts.stop() # Taps go to the next leader, whose contexts are loaded afresh
+    tap_dedup.clear()
+    await get_enrollment_manager().stop()
+    await enrollment_jobs.drain() # Their outcomes are written before the pool can close
+    await get_uploader().stop()
+    await archiver.stop()
+    health.unregister(MQTT_SUBSYSTEM)
+    health.unregister("enrollment")
 
+cluster.on_elected(_start_leader_services)
+cluster.on_deposed(_stop_leader_services)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Starts the subsystems in the background and returns at once, so HTTP is
+    served from the first moment; /readyz reports when they are up, and
+    requests needing the database wait for it behind ReadinessGate.
+    """
+    global startup_task
+    health.register("database")
+    health.register("identity")
+    health.register(CLUSTER_SUBSYSTEM, required=False)
+    enrollment_events.start()
+    startup_task = asyncio.create_task(_start_services())
+    log.info('Application startup: Serving HTTP while subsystems start')
+    yield
+
+    startup_task.cancel()
+    try:
+        await startup_task
+    except asyncio.CancelledError:
+        pass
+    await cluster.stop() # Stops the leader's services, if this worker leads
+    await enrollment_events.stop()
+    db.close()
+    log.info('Application shutdown: Database pool closed')
+    log.info('Application shutdown: All services stopped')
+    stop_logging()
 
-active_enrollment_websockets: dict[str, WebSocket] = {}
 
 app = FastAPI(title="AFIT LMS Central Server",
               lifespan=lifespan,
               description='Handles sync via HTTP and real-time data via MQTT'
               )
+# Holds requests until the database is up; innermost, so its 503s are timed and compressed like any other
+app.add_middleware(ReadinessGate)
+# Compresses responses (including streamed exports) for clients sending Accept-Encoding: gzip
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+# Outermost, so it times compression too
+app.add_middleware(MetricsMiddleware)
 sync_router = Sync(app)
+reports_router = Reports(app)
+reconcile_router = Reconcile(app)
+
+# Read from their owners at scrape time
+Gauge("edge_ingest_queue_depth", "Records waiting for the ingest writer.", collect=lambda: get_ingestor().queue.qsize())
+Gauge("edge_enrollment_queue_depth", "Enrollments waiting for a free terminal.", collect=lambda: get_enrollment_manager().queue_depth)
+Gauge("edge_enrollment_channels", "Enrollment sessions with a status channel.", collect=lambda: len(enrollment_events))
+Gauge("edge_open_lecture_sessions", "Lecture sessions with an in-memory context.", collect=lambda: len(session_contexts))
+Gauge("edge_tap_dedup_entries", "Recent taps remembered for de-duplication.", collect=lambda: len(tap_dedup))
+Gauge("edge_identity_cards", "Cards in the in-memory identity index.", collect=lambda: len(identity_index))
+Gauge("edge_lms_outbox_depth", "Records in the LMS upload outbox, pending or parked, as last counted.", collect=lambda: get_uploader().stats.depth)
+Gauge("edge_lms_upload_blocked", "1 while the LMS rejects every upload as unauthorized or misaddressed.", collect=lambda: int(get_uploader().stats.blocked is not None))
+Gauge("edge_worker_is_leader", "1 on the worker holding the MQTT subscription and enrollment terminals.", collect=lambda: int(cluster.is_leader))
 
 @app.get('/')
 async def read_root():
     return {"message": "Central Edge Server is running! HTTP and MQTT services active"}
 
+@app.get("/healthz")
+async def healthz():
+    """Liveness: answers whenever the event loop does, with each subsystem's state."""
+    return health.snapshot()
+
+@app.get("/readyz")
+async def readyz(response: Response):
+    """Readiness: 503 until the database and card index are up, 200 from then on."""
+    report = health.snapshot()
+    if not report["ready"]:
+        response.status_code = 503
+    return report
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape endpoint."""
+    return Response(content=render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+@app.get("/cs/ingest/stats")
+async def ingest_stats():
+    """Throughput and commit latency of the MQTT attendance pipeline."""
+    return get_ingestor().stats.snapshot()
+
+@app.get("/cs/identity/stats")
+async def identity_stats():
+    """Size and hit/miss counters of the in-memory card index."""
+    return identity_index.snapshot()
+
+@app.get("/cs/catalog/stats")
+async def catalog_stats():
+    """Cache hit rate of the pre-serialized ESP32 course responses."""
+    return course_catalog.snapshot()
+
+@app.get("/cs/sessions/stats")
+async def session_stats():
+    """Open lecture sessions and how their taps were classified."""
+    return session_contexts.snapshot()
+
+@app.get("/cs/taps/stats")
+async def tap_stats():
+    """Repeated taps dropped in memory before reaching the ingest queue."""
+    return tap_dedup.snapshot()
+
+@app.get("/cs/outbox/stats")
+async def outbox_stats():
+    """Backlog and progress of the store-and-forward upload to the LMS."""
+    return await get_uploader().snapshot()
+
+@app.get("/cs/archive/stats")
+async def archive_stats():
+    """Archived semesters, their files, and the size of the live database."""
+    return await archiver.snapshot()
+
+@app.post("/cs/archive:run", status_code=202)
+async def run_archive(response: Response):
+    """Archives closed semesters now rather than at the next periodic check."""
+    if not cluster.is_leader:
+        response.status_code = 409
+        return {"detail": f"Archival runs on the leader, {cluster.leader}"}
+    archiver.trigger()
+    return {"message": "Archival started"}
+
+@app.get("/cs/cluster/stats")
+async def cluster_stats():
+    """This worker's role and the traffic it exchanged with the other workers."""
+    return cluster.snapshot()
+
 @app.post("/cs/enroll")
-async def enroll_user(data: EnrollRequest, background_tasks: BackgroundTasks):
+async def enroll_user(data: EnrollRequest):
     enrollment_session_id = f'enroll_{data.unique_id}_{int(time.time())}'
-    background_tasks.add_task(_run_serial_enrollment_and_update_ws_session, data.username, data.unique_id, enrollment_session_id)
+    # Open the channel first so events published before the client connects are replayed to it
+    enrollment_events.open(enrollment_session_id)
+    await send_ws_message(enrollment_session_id, "STATUS", {"stage": "INITIATED", "details": "Enrollment process started"})
+    # The terminals belong to the leader, which may be another worker
+    await enrollment_jobs.submit(enrollment_session_id, data.username, data.unique_id)
     return {
         "message": "Enrollment process initiated. Please connect to WebSocket for status updates.",
         "enrollment_session_id": enrollment_session_id,
@@ -68,62 +255,92 @@ async def enroll_user(data: EnrollRequest, background_tasks: BackgroundTasks):
 
 @app.websocket("/ws/enrollment_status/{enrollment_session_id}")
 async def websocket_enrollment_status(websocket: WebSocket, enrollment_session_id: str):
+    """
+    Streams a session's status events, starting with everything published so
+    far. Any number of observers may follow the same session.
+    """
     await websocket.accept()
-    active_enrollment_websockets[enrollment_session_id] = websocket
-    print(f"WebSocket {enrollment_session_id} connected.")
+    WEBSOCKETS_ACTIVE.inc()
     try:
+        await _stream_enrollment_status(websocket, enrollment_session_id)
+    finally:
+        WEBSOCKETS_ACTIVE.dec()
+
+async def _stream_enrollment_status(websocket: WebSocket, enrollment_session_id: str):
+    queue = enrollment_events.subscribe(enrollment_session_id)
+    if queue is None: # Possibly started through another worker moments ago
+        await cluster.catch_up()
+        queue = enrollment_events.subscribe(enrollment_session_id)
+    if queue is None:
+        await websocket.send_json({"type": "ERROR", "data": {"message": f"Unknown enrollment session {enrollment_session_id}"}, "timestamp": time.time()})
+        await websocket.close(code=4404)
+        return
+    log.debug("WebSocket %s connected.", enrollment_session_id)
+
+    async def forward_events():
+        while True:
+            event = await queue.get()
+            await websocket.send_json(event)
+            if event["type"] in FINAL_EVENT_TYPES:
+                return
+
+    async def drain_client():
         while True:
             received_text = await websocket.receive_text()
-            print(f"Received message from client on session {enrollment_session_id}, ignoring: {received_text}")
+            log.debug("Received message from client on session %s, ignoring: %s", enrollment_session_id, received_text)
+
+    sender = asyncio.create_task(forward_events())
+    receiver = asyncio.create_task(drain_client())
+    try:
+        done, _ = await asyncio.wait({sender, receiver}, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result() # Re-raises a disconnect or failed send
+        await websocket.close(code=1000)
     except WebSocketDisconnect:
-        print(f"WebSocket disconnected for session: {enrollment_session_id}")
+        log.debug("WebSocket disconnected for session: %s", enrollment_session_id)
     except Exception as e:
-        print(f"WebSocket error for session {enrollment_session_id}: {e}")
+        log.warning("WebSocket error for session %s: %s", enrollment_session_id, e)
     finally:
-        await close_enrollment_ws(enrollment_session_id)
+        sender.cancel()
+        receiver.cancel()
+        enrollment_events.unsubscribe(enrollment_session_id, queue)
 
 async def send_ws_message(session_id: str, message_type: str, data: dict):
-    if session_id in active_enrollment_websockets:
-        try:
-            message = {"type": message_type, "data": data, "timestamp": time.time()}
-            await active_enrollment_websockets[session_id].send_json(message)
-            print(f"WS message sent to {session_id}: {message_type}")
-        except Exception as e:
-            print(f"Failed to send WS message to {session_id}: {e}")
-            close_enrollment_ws(session_id=session_id)
+    """Publishes a status event to every observer of the session, on every worker; never waits on a socket."""
+    await cluster.publish(ENROLLMENT_EVENT_TOPIC, {"session_id": session_id, "type": message_type, "data": data})
+
+cluster.subscribe(ENROLLMENT_EVENT_TOPIC, lambda event: enrollment_events.publish(event["session_id"], event["type"], event["data"]))
 
-async def _run_serial_enrollment_and_update_ws_session(username: str, unique_id: str, session_id: str):
+async def _run_serial_enrollment_and_update_ws_session(username: str, unique_id: str, session_id: str) -> tuple[str, str | None]:
     """
-    Runs the serial_enroll.py script and sends updates via WebSocket.
-    This function will be run in a background task.
+    Queues the enrollment on the terminal manager and relays every stage to
+    the session's WebSocket as it happens. Returns the outcome and the card read.
+    This function will be run in a background task, or as a job on the leader.
     """
-
+    started = stage_started = time.perf_counter()
+    current_stage = "INITIATED"
+    outcome = "error"
     uid = None
-    await send_ws_message(session_id, "STATUS", {"stage": "INITIATED", "details": "Enrollment process started"})
-    await send_ws_message(session_id, "STATUS", {"stage": "CONNECTING_ESP32", "details": "Connecting to ESP32..."})
+
+    def end_stage(now: float):
+        ENROLLMENT_STAGE_SECONDS.labels(current_stage).observe(now - stage_started)
+
+    async def notify(stage: str, details: str, extra: dict):
+        nonlocal current_stage, stage_started
+        if stage != current_stage: # Repeats, e.g. queue position updates, stay in the same stage
+            now = time.perf_counter()
+            end_stage(now)
+            current_stage, stage_started = stage, now
+        await send_ws_message(session_id, "STATUS", {"stage": stage, "details": details, **extra})
+
     try:
-        await send_ws_message(session_id, "STATUS", {"stage": "WAITING_FOR_CARD", "details": "Please present RFID card on terminal."})
-        
-        result = await asyncio.to_thread(
-            subprocess.run,
-            ["python3", "serial_enroll_sim.py", username, unique_id],
-            capture_output=True,
-            text=True,
-            check=True # Raise CalledProcessError if serial_enroll.py fails
-        )
-        
-        for line in result.stdout.splitlines():
-            if line.startswith("Card ") and "enrolled for" in line:
-                parts = line.split(" ")
-                if len(parts) >= 2:
-                    uid = parts[1]
-                    break
-            elif line.startswith("UID_RECEIVED:"): # If serial_enroll.py is updated to send this
-                uid = line.split("UID_RECEIVED:")[1].strip()
-                break
+        uid = await get_enrollment_manager().enroll(session_id, username, unique_id, notify)
 
         if uid:
             enrollments[uid] = {"username": username, "unique_id": unique_id}
+            identity = await assign_enrolled_card(db, unique_id, uid)
+            if identity is None:
+                log.warning("No student or lecturer with sch_id %s yet; card %s kept in enrollments only", unique_id, uid)
             await send_ws_message(session_id, "COMPLETED", {
                 "message": f"Enrollment successful for {username} with UID {uid}.",
                 "uid": uid,
@@ -131,46 +348,35 @@ async def _run_serial_enrollment_and_update_ws_session(username: str, unique_id:
                 "unique_id": unique_id,
                 "success": True
             })
-            print(f"Enrollment for {username} completed. UID: {uid}")
-            close_enrollment_ws(session_id=session_id)
+            outcome = "completed"
+            log.info("Enrollment for %s completed. UID: %s", username, uid)
         else:
             await send_ws_message(session_id, "FAILED", {
                 "message": "Enrollment failed: Could not retrieve UID from ESP32.",
                 "success": False
             })
-            print(f"Enrollment for {username} failed: No UID.")
+            outcome = "no_card"
+            log.warning("Enrollment for %s failed: No UID.", username)
 
-    except subprocess.CalledProcessError as e:
-        error_message = f"Serial enrollment script failed: {e.stderr.strip()}"
-        print(error_message)
+    except EnrollmentError as e:
+        error_message = f"Enrollment terminal error: {e}"
+        outcome = "terminal_error"
+        log.warning(error_message)
         await send_ws_message(session_id, "FAILED", {
             "message": error_message,
-            "success": False,
-            "details": {"stdout": e.stdout.strip(), "stderr": e.stderr.strip()}
+            "success": False
         })
     except Exception as e:
         error_message = f"An unexpected error occurred during enrollment: {e}"
-        print(error_message)
+        log.error(error_message)
         await send_ws_message(session_id, "FAILED", {
             "message": error_message,
             "success": False
         })
+    finally:
+        now = time.perf_counter()
+        end_stage(now)
+        ENROLLMENT_SECONDS.labels(outcome).observe(now - started)
+    return outcome, uid
 
-async def close_enrollment_ws(session_id: str):
-    """
-    Closes the WebSocket connection for a given session ID and removes it
-    from the active_enrollment_websockets dictionary.
-    """
-    if session_id in active_enrollment_websockets:
-        try:
-            await active_enrollment_websockets[session_id].close(code=1000)
-            print(f"WebSocket for session {session_id} closed successfully.")
-        except RuntimeError as e:
-            print(f"Warning: Could not close WS for {session_id} due to runtime error: {e}")
-        except Exception as e:
-            print(f"Error closing WebSocket for session {session_id}: {e}")
-        finally:
-            del active_enrollment_websockets[session_id]
-            print(f"Session {session_id} removed from active_enrollment_websockets.")
-    else:
-        print(f"WebSocket session {session_id} not found in active connections. Or already deleted.")
\ No newline at end of file
+enrollment_jobs = EnrollmentJobs(cluster, db, _run_serial_enrollment_and_update_ws_session)
@@ -0,0 +1,294 @@
+# archive.py (Closed semesters moved out of the live database into an attached archive file)
+import asyncio
+import collections
+import datetime as dt
+import json
+import os
+import sqlite3
+import time
+from cluster import cluster
+from database import Database, db as default_db, ARCHIVED_TABLES, ARCHIVE_SCHEMA
+from migrations import STRICT, AUTO_VACUUM_INCREMENTAL
+from log import get_logger
+
+log = get_logger("archive")
+
+# Months semesters start in; a semester runs until the next one starts
+SEMESTER_START_MONTHS = tuple(sorted(int(m) for m in os.environ.get("SEMESTER_START_MONTHS", "3,9").split(",")))
+ARCHIVE_GRACE_DAYS = int(os.environ.get("ARCHIVE_GRACE_DAYS", 60)) # A semester stays live this long after it ends
+ARCHIVE_CHUNK_ROWS = 5000 # Attendance rows moved per transaction...
+ARCHIVE_CHUNK_PAUSE_S = 0.05 # ...with this pause between, so the writer keeps serving taps
+ARCHIVE_CHUNK_MAX_SESSIONS = 500
+ARCHIVE_START_DELAY_S = 60 # After becoming leader, so startup isn't slowed
+ARCHIVE_CHECK_INTERVAL_S = 6 * 3600
+VACUUM_STEP_PAGES = 2048 # Pages released per incremental_vacuum transaction (8 MiB at 4 KiB pages)
+
+ARCHIVING = "archive" # trigger_suppression reason while rows are being moved
+MOVING = "moving"
+ARCHIVED = "archived"
+
+# Worker message topic; every worker attaches the archive file when it is created
+ARCHIVES_CHANGED_TOPIC = "archives.changed"
+
+ARCHIVE_DDL = (
+    """CREATE TABLE IF NOT EXISTS {schema}.lecture_sessions (
+        id INTEGER PRIMARY KEY,
+        course_code TEXT NOT NULL,
+        lecturer_id INTEGER NOT NULL,
+        session_date TEXT NOT NULL,
+        created_at TEXT,
+        change_seq INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT
+    );""",
+    "CREATE INDEX IF NOT EXISTS {schema}.idx_lecture_sessions_course_date ON lecture_sessions (course_code, session_date);",
+    "CREATE INDEX IF NOT EXISTS {schema}.idx_lecture_sessions_date ON lecture_sessions (session_date);",
+    f"""CREATE TABLE IF NOT EXISTS {{schema}}.attendance_records (
+        session_id INTEGER NOT NULL,
+        student_id INTEGER NOT NULL,
+        attendance_time TEXT NOT NULL,
+        attended INTEGER NOT NULL DEFAULT 1,
+        change_seq INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT,
+        PRIMARY KEY (session_id, student_id)
+    ) WITHOUT ROWID{STRICT};""",
+    "CREATE INDEX IF NOT EXISTS {schema}.idx_attendance_records_student ON attendance_records (student_id, session_id, attended);",
+)
+
+
+def semester_start(day: dt.date) -> dt.date:
+    """First day of the semester `day` falls in."""
+    months = [m for m in SEMESTER_START_MONTHS if m <= day.month]
+    if not months:
+        return dt.date(day.year - 1, SEMESTER_START_MONTHS[-1], 1)
+    return dt.date(day.year, months[-1], 1)
+
+def next_semester_start(start: dt.date) -> dt.date:
+    months = [m for m in SEMESTER_START_MONTHS if m > start.month]
+    if not months:
+        return dt.date(start.year + 1, SEMESTER_START_MONTHS[0], 1)
+    return dt.date(start.year, months[0], 1)
+
+def semester_name(start: dt.date) -> str:
+    return f"{start:%Y-%m}"
+
+
+def _closed_semesters(conn: sqlite3.Connection, today: dt.date) -> list[tuple[dt.date, dt.date]]:
+    """
+    [start, end) of every semester past its grace period that still has live
+    sessions, oldest first. Archived semesters are included again when a move
+    was interrupted or late taps have since been recorded for their sessions.
+    """
+    semesters = set()
+    oldest = conn.execute("SELECT MIN(session_date) FROM lecture_sessions;").fetchone()[0]
+    if oldest is not None:
+        start = semester_start(dt.date.fromisoformat(oldest[:10]))
+        while (end := next_semester_start(start)) + dt.timedelta(days=ARCHIVE_GRACE_DAYS) <= today:
+            if conn.execute("SELECT 1 FROM lecture_sessions WHERE session_date >= ? AND session_date < ? LIMIT 1;",
+                            (start.isoformat(), end.isoformat())).fetchone():
+                semesters.add((start, end))
+            start = end
+    for row in conn.execute("SELECT starts, ends FROM archived_semesters WHERE state = ?;", (MOVING,)):
+        semesters.add((dt.date.fromisoformat(row["starts"]), dt.date.fromisoformat(row["ends"])))
+    if ARCHIVE_SCHEMA in {row["name"] for row in conn.execute("PRAGMA database_list;")}:
+        for (session_date,) in conn.execute(f"""
+                SELECT DISTINCT ls.session_date FROM {ARCHIVE_SCHEMA}.lecture_sessions ls
+                WHERE EXISTS (SELECT 1 FROM main.attendance_records WHERE session_id = ls.id);"""):
+            start = semester_start(dt.date.fromisoformat(session_date[:10]))
+            semesters.add((start, next_semester_start(start)))
+    return sorted(semesters)
+
+def _prepare_archive(conn: sqlite3.Connection, semester: str, starts: str, ends: str):
+    """Creates (or reopens) the archive file and registers the semester, so every connection attaches the file."""
+    databases = {row["name"]: row["file"] for row in conn.execute("PRAGMA database_list;")}
+    directory, name = os.path.split(databases["main"])
+    path = f"{os.path.splitext(name)[0]}-archive.db"
+    if ARCHIVE_SCHEMA not in databases:
+        conn.execute(f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA};", (os.path.join(directory, path),))
+    conn.execute(f"PRAGMA {ARCHIVE_SCHEMA}.journal_mode = WAL;")
+    for ddl in ARCHIVE_DDL:
+        conn.execute(ddl.format(schema=ARCHIVE_SCHEMA))
+    conn.execute("""
+        INSERT INTO archived_semesters (semester, path, starts, ends, state, started_at) VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(semester) DO UPDATE SET state = excluded.state, started_at = excluded.started_at;""",
+        (semester, path, starts, ends, MOVING, time.time()))
+
+def _move(conn: sqlite3.Connection, table: str, key: str, ids: str) -> int:
+    columns = ", ".join(ARCHIVED_TABLES[table])
+    # REPLACE: after a crash between the two files' commits, the live copy is the one to keep
+    conn.execute(f"""
+        INSERT OR REPLACE INTO {ARCHIVE_SCHEMA}.{table} ({columns})
+        SELECT {columns} FROM main.{table} WHERE {key} IN (SELECT value FROM json_each(?));""", (ids,))
+    return conn.execute(f"DELETE FROM main.{table} WHERE {key} IN (SELECT value FROM json_each(?));", (ids,)).rowcount
+
+def _move_chunk(conn: sqlite3.Connection, semester: str, starts: str, ends: str, max_rows: int) -> tuple[int, int]:
+    """
+    Moves the next sessions of the semester, with their attendance, holding
+    about `max_rows` records; returns (sessions, records) moved. Once no
+    sessions are left, moves records that arrived for already archived ones.
+    """
+    candidates = conn.execute("""
+        SELECT ls.id, COALESCE(s.present + s.absent, 0) AS records FROM lecture_sessions ls
+        LEFT JOIN attendance_session_stats s ON s.session_id = ls.id
+        WHERE ls.session_date >= ? AND ls.session_date < ? ORDER BY ls.session_date LIMIT ?;""",
+        (starts, ends, ARCHIVE_CHUNK_MAX_SESSIONS)).fetchall()
+    ids, total = [], 0
+    for row in candidates:
+        if ids and total + row["records"] > max_rows:
+            break
+        ids.append(row["id"])
+        total += row["records"]
+    if not ids:
+        ids = [row[0] for row in conn.execute(f"""
+            SELECT ls.id FROM {ARCHIVE_SCHEMA}.lecture_sessions ls
+            WHERE ls.session_date >= ? AND ls.session_date < ?
+              AND EXISTS (SELECT 1 FROM main.attendance_records WHERE session_id = ls.id) LIMIT ?;""",
+            (starts, ends, ARCHIVE_CHUNK_MAX_SESSIONS))]
+    if not ids:
+        return 0, 0
+    conn.execute("INSERT INTO trigger_suppression (reason) VALUES (?);", (ARCHIVING,))
+    encoded = json.dumps(ids)
+    records = _move(conn, "attendance_records", "session_id", encoded)
+    sessions = _move(conn, "lecture_sessions", "id", encoded)
+    conn.execute("DELETE FROM trigger_suppression WHERE reason = ?;", (ARCHIVING,))
+    conn.execute("UPDATE archived_semesters SET sessions = sessions + ?, records = records + ? WHERE semester = ?;",
+                 (sessions, records, semester))
+    return sessions, records
+
+def _finish_archive(conn: sqlite3.Connection, semester: str):
+    conn.execute("UPDATE archived_semesters SET state = ?, finished_at = ? WHERE semester = ?;",
+                 (ARCHIVED, time.time(), semester))
+
+def _vacuum_step(conn: sqlite3.Connection, pages: int) -> int:
+    """Releases up to `pages` free pages; returns how many remain free."""
+    # execute() stops after the first page: the pragma returns no rows, so it's run as a script
+    conn.executescript(f"PRAGMA main.incremental_vacuum({pages});")
+    return conn.execute("PRAGMA main.freelist_count;").fetchone()[0]
+
+def _incremental_vacuum_enabled(conn: sqlite3.Connection) -> bool:
+    return conn.execute("PRAGMA main.auto_vacuum;").fetchone()[0] == AUTO_VACUUM_INCREMENTAL
+
+def _checkpoint(conn: sqlite3.Connection):
+    """Copies the WAL into the file, which is when the file actually shrinks, and empties the WAL."""
+    conn.execute("PRAGMA main.wal_checkpoint(TRUNCATE);").fetchall()
+
+def _read_archive_stats(conn: sqlite3.Connection) -> dict:
+    pragma = lambda name: conn.execute(f"PRAGMA main.{name};").fetchone()[0]
+    directory = os.path.dirname(next(row["file"] for row in conn.execute("PRAGMA database_list;") if row["name"] == "main"))
+    semesters = [dict(row) for row in conn.execute("SELECT * FROM archived_semesters ORDER BY semester;")]
+    path = os.path.join(directory, semesters[0]["path"]) if semesters else None
+    return {
+        "live_bytes": pragma("page_count") * pragma("page_size"),
+        "archive_bytes": os.path.getsize(path) if path and os.path.exists(path) else None,
+        "free_pages": pragma("freelist_count"),
+        "incremental_vacuum": _incremental_vacuum_enabled(conn),
+        "semesters": semesters,
+    }
+
+
+class Archiver:
+    """
+    Keeps the live database to the current semesters. Once a semester is
+    ARCHIVE_GRACE_DAYS past its end, its sessions and attendance move to the
+    archive file, a few thousand records per transaction so taps keep
+    being written in between, and the freed pages are returned to the file
+    system by incremental vacuum. Archived rows are still read through the
+    all_lecture_sessions and all_attendance_records views, and the
+    attendance aggregates keep counting them. Runs on the leader.
+    """
+    def __init__(self, db: Database = default_db):
+        self.db = db
+        self.counts = collections.Counter()
+        self.last_run: float | None = None
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def trigger(self):
+        """Runs archival now instead of at the next check."""
+        self._wake.set()
+
+    async def _loop(self):
+        try:
+            await asyncio.wait_for(self._wake.wait(), ARCHIVE_START_DELAY_S)
+        except asyncio.TimeoutError:
+            pass
+        while True:
+            self._wake.clear()
+            try:
+                await self.run()
+            except Exception as e:
+                log.exception("Archival failed: %r", e)
+            try:
+                await asyncio.wait_for(self._wake.wait(), ARCHIVE_CHECK_INTERVAL_S)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self, today: dt.date | None = None) -> list[str]:
+        """Archives every closed semester still in the live database; returns their names."""
+        self.last_run = time.time()
+        semesters = await self.db.read(_closed_semesters, today or dt.date.today())
+        for start, end in semesters:
+            await self.archive(start, end)
+        if semesters:
+            await self.reclaim()
+        return [semester_name(start) for start, _ in semesters]
+
+    async def archive(self, start: dt.date, end: dt.date):
+        semester, starts, ends = semester_name(start), start.isoformat(), end.isoformat()
+        started = time.perf_counter()
+        await self.db.write(_prepare_archive, semester, starts, ends)
+        await cluster.publish(ARCHIVES_CHANGED_TOPIC, {"semester": semester})
+        sessions = records = 0
+        while True:
+            moved_sessions, moved_records = await self.db.write(_move_chunk, semester, starts, ends, ARCHIVE_CHUNK_ROWS)
+            if not moved_sessions and not moved_records:
+                break
+            sessions += moved_sessions
+            records += moved_records
+            await asyncio.sleep(ARCHIVE_CHUNK_PAUSE_S)
+        await self.db.write(_finish_archive, semester)
+        self.counts["semesters"] += 1
+        self.counts["sessions"] += sessions
+        log.info("Archived semester %s: %d sessions, %d records in %.1fs", semester, sessions, records, time.perf_counter() - started)
+
+    async def reclaim(self):
+        """Shrinks the live file by the pages archival freed, if it is in incremental vacuum mode."""
+        if not await self.db.read(_incremental_vacuum_enabled):
+            # Freed pages are still reused by new rows; only the file's size stays put
+            log.warning("Archival freed pages the file can't release: run `python migrations.py --vacuum` "
+                        "with the server stopped to switch it to incremental vacuum")
+            return
+        free = None
+        while True:
+            remaining = await self.db.write(_vacuum_step, VACUUM_STEP_PAGES)
+            self.counts["vacuum_steps"] += 1
+            if not remaining or remaining == free: # Done, or nothing more can be released
+                break
+            free = remaining
+            await asyncio.sleep(ARCHIVE_CHUNK_PAUSE_S)
+        await self.db.write(_checkpoint)
+
+    async def snapshot(self) -> dict:
+        return {
+            "semester_start_months": SEMESTER_START_MONTHS,
+            "grace_days": ARCHIVE_GRACE_DAYS,
+            "last_run": self.last_run,
+            **self.counts,
+            **await self.db.read(_read_archive_stats),
+        }
+
+
+archiver = Archiver()
+cluster.subscribe(ARCHIVES_CHANGED_TOPIC, lambda payload: default_db.reattach_archives())
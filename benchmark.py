@@ -0,0 +1,327 @@
+# benchmark.py (Offline benchmarks of the sync API and the database layer)
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+import httpx
+import enrollment_manager
+from app import app, enrollment_jobs
+from cluster import cluster
+from database import init_db, db
+from enrollment_events import enrollment_events, FINAL_EVENT_TYPES
+from enrollment_manager import EnrollmentManager, SimulatedTerminal
+from fleet_sim import percentiles
+from identity_index import identity_index
+from ingest import AttendanceIngestor, INSERT_ATTENDANCE_SQL
+from log import start_logging
+from models import StudentAttendanceRecordBase
+
+BENCH_BASELINE_PATH = "benchmark_baseline.json"
+BENCH_THRESHOLD = 0.3 # A metric more than this much worse than its baseline is a regression
+BENCH_TAIL_METRICS = ("p95", "p99") # Swing far more run to run; only warned about unless --strict-tails
+BENCH_NOISE_FLOOR_MS = 1.0 # Latency differences smaller than this are never a regression
+BENCH_LIST_SIZES = (1000, 10000, 100000)
+BENCH_STUDENT_BASE = 10_000_000 # Ids of students created by the sync benchmarks, clear of the seeded ones
+
+
+class Timings:
+    """Per-operation latencies of one benchmark, plus how much work they covered."""
+    def __init__(self, unit: str):
+        self.unit = unit
+        self.samples: list[float] = []
+        self.work = 0
+        self.elapsed = 0.0
+
+    @contextlib.asynccontextmanager
+    async def measure(self, work: int = 1):
+        started = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - started
+        self.samples.append(seconds)
+        self.work += work
+        self.elapsed += seconds
+
+    def report(self) -> dict:
+        throughput = round(self.work / self.elapsed, 1) if self.elapsed else 0.0
+        return {**percentiles(self.samples), f"{self.unit}_per_s": throughput}
+
+
+def _seed(conn: sqlite3.Connection, students: int, courses: int, sessions: int):
+    conn.executemany("INSERT INTO lecturers (id, name, sch_id, rfid_uid) VALUES (?, ?, ?, ?);",
+                     [(i, f"Lecturer {i}", f"L{i:05d}", f"LUID{i:08X}") for i in range(1, 21)])
+    conn.executemany("INSERT INTO courses (code, course_id, title, level, faculty, dept) VALUES (?, ?, ?, ?, ?, ?);",
+                     [(f"CSC{100 + i}", i, f"Course {i}", 100 * (1 + i % 5), "SEET", "CSC") for i in range(courses)])
+    _seed_students(conn, 0, students)
+    conn.executemany("INSERT INTO lecture_sessions (id, course_code, lecturer_id, session_date) VALUES (?, ?, ?, ?);",
+                     [(i, f"CSC{100 + i % courses}", 1 + i % 20, f"2024-03-{1 + i % 28:02d} 09:00:00") for i in range(1, sessions + 1)])
+
+def _seed_students(conn: sqlite3.Connection, start: int, stop: int):
+    conn.executemany("INSERT INTO students (id, name, sch_id, rfid_uid) VALUES (?, ?, ?, ?);",
+                     [(i, f"Student {i}", f"S{i:07d}", f"SUID{i:08X}") for i in range(start + 1, stop + 1)])
+
+def _student(i: int) -> dict:
+    return {"id": i, "name": f"Student {i}", "sch_id": f"S{i:08d}", "rfid_uid": f"SUID{i:09X}"}
+
+
+async def bench_db_inserts(args, results: dict):
+    """Attendance inserts, with every trigger firing, committed per row, per chunk and per run."""
+    rows = [(1 + i % args.sessions, 1 + i // args.sessions, "2024-03-01 09:00:00", 1) for i in range(args.rows)]
+    per_row = rows[:args.rows // 20]
+    timings = Timings("rows")
+    for row in per_row:
+        async with timings.measure():
+            await db.execute(INSERT_ATTENDANCE_SQL, row)
+    results["db.insert.commit_per_row"] = timings.report()
+
+    chunk = 500
+    timings = Timings("rows")
+    for i in range(len(per_row), args.rows, chunk):
+        async with timings.measure(len(rows[i:i + chunk])):
+            await db.executemany(INSERT_ATTENDANCE_SQL, rows[i:i + chunk])
+    results["db.insert.executemany_500"] = timings.report()
+
+    # The same rows again: every insert is a conflict the upsert has to resolve
+    timings = Timings("rows")
+    async with timings.measure(len(rows)):
+        await db.executemany(INSERT_ATTENDANCE_SQL, rows)
+    results["db.insert.duplicates_one_txn"] = timings.report()
+
+    ingestor = AttendanceIngestor(db)
+    ingestor.start()
+    timings = Timings("taps")
+    # Sessions of their own, so every tap is a new record
+    taps = [StudentAttendanceRecordBase(session_id=args.sessions + 1 + i % args.sessions, student_id=1 + i // args.sessions,
+                                        attendance_time=datetime.now(), attended=True) for i in range(args.rows)]
+    async with timings.measure(len(taps)):
+        for tap in taps:
+            await ingestor.submit(tap)
+        await ingestor.queue.join()
+    await ingestor.stop()
+    results["db.ingest.taps"] = timings.report()
+
+
+async def bench_sync(client: httpx.AsyncClient, args, results: dict):
+    next_id = BENCH_STUDENT_BASE
+    timings = Timings("rows")
+    for _ in range(args.requests):
+        next_id += 1
+        async with timings.measure():
+            response = await client.post("/cs/sync/students", json=_student(next_id))
+        response.raise_for_status()
+    results["sync.students.single"] = timings.report()
+
+    timings = Timings("rows")
+    for _ in range(max(1, args.requests // 25)):
+        batch = [_student(next_id + i) for i in range(1, args.batch + 1)]
+        next_id += args.batch
+        async with timings.measure(len(batch)):
+            response = await client.post("/cs/sync/students:batch", json=batch)
+        response.raise_for_status()
+    results[f"sync.students.batch_{args.batch}"] = timings.report()
+
+    timings = Timings("rows")
+    body = "\n".join(json.dumps(_student(next_id + i)) for i in range(1, args.batch + 1)).encode()
+    for _ in range(max(1, args.requests // 25)):
+        # Re-pushing one roster: the idempotent upsert path
+        async with timings.measure(args.batch):
+            response = await client.post("/cs/sync/students:batch", content=body,
+                                         headers={"Content-Type": "application/x-ndjson"})
+        response.raise_for_status()
+    results[f"sync.students.batch_{args.batch}_ndjson_repeat"] = timings.report()
+
+
+async def bench_listing(client: httpx.AsyncClient, args, results: dict):
+    await db.execute(f"DELETE FROM students WHERE id > {BENCH_STUDENT_BASE};")
+    seeded = await db.fetchone("SELECT COUNT(*) FROM students;")
+    seeded = seeded[0]
+    for size in args.sizes:
+        if size > seeded:
+            await db.write(_seed_students, seeded, size)
+            seeded = size
+        await client.get("/cs/sync/students") # Warm the page cache before measuring
+        timings = Timings("rows")
+        for _ in range(max(3, args.requests * 100 // size)):
+            async with timings.measure(size):
+                response = await client.get("/cs/sync/students")
+            response.raise_for_status()
+        results[f"sync.students.list_all.{size}"] = timings.report()
+
+        # Keyset pages from cursors spread over the whole table
+        timings = Timings("rows")
+        pages = args.requests // 10
+        for i in range(pages):
+            after = i * size // pages
+            async with timings.measure(min(1000, size - after)):
+                response = await client.get("/cs/sync/students", params={"limit": 1000, "after_id": after})
+            response.raise_for_status()
+        results[f"sync.students.list_page_1000.{size}"] = timings.report()
+
+
+async def _enroll(client: httpx.AsyncClient, i: int):
+    """Submits one enrollment and waits for its final status event."""
+    response = await client.post("/cs/enroll", json={"username": f"Student {i}", "unique_id": f"S{i:07d}"})
+    response.raise_for_status()
+    session_id = response.json()["enrollment_session_id"]
+    events = enrollment_events.subscribe(session_id) # History first, so an event already sent isn't missed
+    try:
+        while (event := await events.get())["type"] not in FINAL_EVENT_TYPES:
+            pass
+    finally:
+        enrollment_events.unsubscribe(session_id, events)
+    if event["type"] != "COMPLETED":
+        raise RuntimeError(f"Enrollment {session_id} failed: {event['data'].get('message')}")
+
+
+async def bench_enroll(client: httpx.AsyncClient, args, results: dict):
+    """POST /cs/enroll through the job queue to the COMPLETED event, with instant simulated terminals."""
+    timings = Timings("requests")
+    for i in range(1, args.enrollments + 1):
+        async with timings.measure():
+            await _enroll(client, i)
+    results["enroll.sequential"] = timings.report()
+
+    timings = Timings("requests")
+    async def one(i: int):
+        async with timings.measure():
+            await _enroll(client, i)
+    started = time.perf_counter()
+    # Students of their own: a session id repeated within the same second would be taken as the earlier job
+    await asyncio.gather(*(one(i) for i in range(args.enrollments + 1, 2 * args.enrollments + 1)))
+    report = timings.report()
+    report["requests_per_s"] = round(args.enrollments / (time.perf_counter() - started), 1)
+    results[f"enroll.concurrent_{args.enroll_terminals}_terminals"] = report
+
+
+async def run(args) -> dict:
+    results: dict = {}
+    await init_db()
+    await db.write(_seed, args.students, 40, 2 * args.sessions)
+    await identity_index.load(db)
+    manager = enrollment_manager.enrollment_manager = EnrollmentManager(
+        [SimulatedTerminal(f"bench-{i}", tap_delay=0) for i in range(args.enroll_terminals)])
+    await manager.start()
+    enrollment_events.start()
+    # Leads without the leader's lifespan services (MQTT, LMS upload, archival), so enrollment
+    # jobs queued through the API are claimed and run by this process's terminals
+    cluster.is_leader, cluster.leader = True, cluster.worker_id
+    try:
+        await bench_db_inserts(args, results)
+        # ASGITransport skips the lifespan, so the MQTT client and uploader never start
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await bench_sync(client, args, results)
+            await bench_listing(client, args, results)
+            await bench_enroll(client, args, results)
+    finally:
+        cluster.is_leader, cluster.leader = False, None
+        await manager.stop()
+        await enrollment_jobs.drain()
+        await enrollment_events.stop()
+        enrollment_events.clear() # The next run reuses session ids: same students, maybe the same second
+        db.close()
+    return results
+
+
+def merge_runs(runs: list[dict]) -> dict:
+    """Median of every metric across independent runs, which damps one-off stalls of a shared machine."""
+    return {name: {metric: statistics.median(run[name][metric] for run in runs) for metric in runs[0][name]}
+            for name in runs[0]}
+
+
+def compare(results: dict, baseline: dict, threshold: float, strict_tails: bool = False) -> dict:
+    """Metric-by-metric change against a baseline; latencies regress upward, throughputs downward."""
+    regressions, warnings, improvements = [], [], []
+    for name, current in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if not previous:
+            continue
+        for metric, value in current.items():
+            before = previous.get(metric)
+            if metric in ("count", "max") or not isinstance(before, (int, float)) or not before:
+                continue
+            change = value / before - 1
+            higher_is_better = metric.endswith("_per_s")
+            worse = -change if higher_is_better else change
+            entry = {"metric": f"{name}.{metric}", "baseline": before, "current": value, "change": round(change, 3)}
+            if worse > threshold and (higher_is_better or value - before > BENCH_NOISE_FLOOR_MS):
+                (warnings if metric in BENCH_TAIL_METRICS and not strict_tails else regressions).append(entry)
+            elif worse < -threshold:
+                improvements.append(entry)
+    missing = sorted(set(baseline.get("results", {})) - set(results))
+    return {"threshold": threshold, "regressions": regressions, "warnings": warnings,
+            "improvements": improvements, "missing": missing}
+
+
+def main(args) -> int:
+    out = os.path.abspath(args.out) if args.out else None
+    baseline_path = os.path.abspath(args.baseline)
+    settings = {"runs": args.runs, "students": args.students, "sessions": args.sessions, "rows": args.rows, "requests": args.requests,
+                "batch": args.batch, "sizes": list(args.sizes), "enrollments": args.enrollments}
+    # The server logs through the same stdout the report goes to
+    start_logging("INFO" if args.verbose else "WARNING")
+    runs = []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory(prefix="edge-bench-") as workdir:
+            # The server's modules open central_server.db relative to the working directory
+            os.chdir(workdir)
+            runs.append(asyncio.run(run(args)))
+    results = merge_runs(runs)
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "machine": platform.machine(),
+        "settings": settings,
+        "results": results,
+    }
+    status = 0
+    if args.save_baseline:
+        with open(baseline_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Benchmark: baseline written to {baseline_path}", file=sys.stderr)
+    elif os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != settings:
+            print("Benchmark: WARNING settings differ from the baseline's; the comparison is not like for like", file=sys.stderr)
+        report["comparison"] = compare(results, baseline, args.threshold, args.strict_tails)
+        for label, key in (("REGRESSION", "regressions"), ("WARNING", "warnings")):
+            for entry in report["comparison"][key]:
+                print(f"Benchmark: {label} {entry['metric']}: {entry['baseline']} -> {entry['current']} "
+                      f"({entry['change']:+.0%})", file=sys.stderr)
+        status = 1 if report["comparison"]["regressions"] else 0
+    text = json.dumps(report, indent=2)
+    print(text)
+    if out:
+        with open(out, "w") as f:
+            f.write(text)
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the sync API and database layer against a scratch database.")
+    parser.add_argument("--students", type=int, default=2000, help="Students seeded before the benchmarks")
+    parser.add_argument("--sessions", type=int, default=200, help="Lecture sessions seeded before the benchmarks")
+    parser.add_argument("--rows", type=int, default=20000, help="Attendance rows per insert benchmark")
+    parser.add_argument("--requests", type=int, default=500, help="Single-row sync requests; other counts scale from this")
+    parser.add_argument("--batch", type=int, default=1000, help="Rows per bulk sync request")
+    parser.add_argument("--sizes", type=lambda s: tuple(int(n) for n in s.split(",")), default=BENCH_LIST_SIZES,
+                        help="Comma-separated table sizes for the listing benchmarks")
+    parser.add_argument("--enrollments", type=int, default=50)
+    parser.add_argument("--enroll-terminals", type=int, default=2)
+    parser.add_argument("--runs", type=int, default=3, help="Full runs, each on a fresh database; metrics are their medians")
+    parser.add_argument("--baseline", default=BENCH_BASELINE_PATH, help="Baseline results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=BENCH_THRESHOLD, help="Relative change counted as a regression")
+    parser.add_argument("--strict-tails", action="store_true", help="Fail on p95/p99 regressions too, not just warn")
+    parser.add_argument("--out", help="Also write the JSON report to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the server's own output")
+    sys.exit(main(parser.parse_args()))
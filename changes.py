@@ -0,0 +1,94 @@
+# changes.py
+import json
+import sqlite3
+from database import VERSIONED_TABLES
+
+CHANGE_FEED_DEFAULT_LIMIT = 1000
+CHANGE_FEED_MAX_LIMIT = 10000
+
+
+class FeedEntity:
+    """
+    A synced table as exposed under /cs/sync/<name>. Listings read from
+    `source`, which for archived tables is the view spanning every semester;
+    the change feed always reads the live table.
+    """
+    def __init__(self, name: str, table: str, columns: tuple, key_types: tuple, source: str | None = None):
+        self.name = name
+        self.table = table
+        self.source = source or table
+        self.columns = columns
+        self.keys = VERSIONED_TABLES[table][0]
+        self.key_types = key_types # Python type of each key column, to parse after_id
+        placeholders = ", ".join("?" for _ in self.keys)
+        self._after_clause = (f"{self.keys[0]} > ?" if len(self.keys) == 1
+                              else f"({', '.join(self.keys)}) > ({placeholders})")
+
+    def parse_after(self, after_id: str) -> tuple:
+        """Parses an after_id cursor; composite keys are joined with ':'."""
+        parts = after_id.split(":", len(self.keys) - 1)
+        if len(parts) != len(self.keys):
+            raise ValueError(f"after_id for {self.name} must have {len(self.keys)} ':'-separated parts")
+        return tuple(t(p) for t, p in zip(self.key_types, parts))
+
+    def format_after(self, row: dict) -> str:
+        return ":".join(str(row[k]) for k in self.keys)
+
+    def page_sql(self, after: bool) -> str:
+        where = f"WHERE {self._after_clause}" if after else ""
+        return f"SELECT {', '.join(self.columns)} FROM {self.source} {where} ORDER BY {', '.join(self.keys)} LIMIT ?;"
+
+
+FEED_ENTITIES = {
+    e.name: e for e in (
+        FeedEntity("lecturers", "lecturers", ("id", "name", "sch_id", "rfid_uid"), (int,)),
+        FeedEntity("students", "students", ("id", "name", "sch_id", "rfid_uid"), (int,)),
+        FeedEntity("courses", "courses", ("code", "course_id", "title", "level", "faculty", "dept"), (str,)),
+        FeedEntity("sessions", "lecture_sessions", ("id", "course_code", "lecturer_id", "session_date"), (int,),
+                   source="all_lecture_sessions"),
+        FeedEntity("attendance", "attendance_records", ("session_id", "student_id", "attendance_time", "attended"), (int, int),
+                   source="all_attendance_records"),
+    )
+}
+
+
+def read_page(conn: sqlite3.Connection, entity: FeedEntity, after: tuple | None, limit: int) -> list[dict]:
+    """Reads the next `limit` rows in primary-key order strictly after the `after` key."""
+    params = (*after, limit) if after is not None else (limit,)
+    return [dict(row) for row in conn.execute(entity.page_sql(after is not None), params)]
+
+
+def read_changes(conn: sqlite3.Connection, entity: FeedEntity, since: int, limit: int) -> dict:
+    """
+    Returns rows changed and keys deleted after `since`, oldest first, and the
+    cursor to pass as `since` next time. Both reads share one snapshot so a
+    concurrent write can't slip between them.
+    """
+    columns = ", ".join(entity.columns)
+    conn.execute("BEGIN;")
+    try:
+        rows = conn.execute(f"""
+            SELECT {columns}, change_seq, updated_at FROM {entity.table}
+            WHERE change_seq > ? ORDER BY change_seq LIMIT ?;""", (since, limit + 1)).fetchall()
+        tombstones = conn.execute("""
+            SELECT change_seq, row_key, deleted_at FROM sync_tombstones
+            WHERE entity = ? AND change_seq > ? ORDER BY change_seq LIMIT ?;""", (entity.table, since, limit + 1)).fetchall()
+    finally:
+        conn.execute("COMMIT;")
+
+    merged = sorted([(r["change_seq"], False, r) for r in rows] + [(t["change_seq"], True, t) for t in tombstones],
+                    key=lambda item: item[0])
+    page = merged[:limit]
+    changes, deleted = [], []
+    for _, is_tombstone, row in page:
+        if is_tombstone:
+            deleted.append({"key": json.loads(row["row_key"]), "change_seq": row["change_seq"], "deleted_at": row["deleted_at"]})
+        else:
+            changes.append(dict(row))
+    return {
+        "entity": entity.name,
+        "changes": changes,
+        "deleted": deleted,
+        "next_cursor": page[-1][0] if page else since,
+        "has_more": len(merged) > limit,
+    }
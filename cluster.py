@@ -0,0 +1,213 @@
+# cluster.py (Multi-worker mode: a leader lease and a message log shared through SQLite)
+import asyncio
+import inspect
+import json
+import os
+import socket
+import sqlite3
+import time
+from typing import Awaitable, Callable
+from database import Database, db as default_db
+from health import health, READY
+from log import get_logger
+
+log = get_logger("cluster")
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+LEADER_LEASE = "leader"
+LEASE_TTL_S = 6 # A leader that hasn't renewed for this long is replaced
+LEASE_RENEW_S = 2
+MESSAGE_POLL_INTERVAL_S = 0.05 # How often each worker reads messages published by the others
+MESSAGE_BATCH_SIZE = 500
+MESSAGE_RETENTION_S = 300 # Messages are deleted by the leader after this long
+PRUNE_INTERVAL_S = 60
+
+CLUSTER_SUBSYSTEM = "cluster" # Name reported by /healthz and /readyz
+
+Handler = Callable[[dict], Awaitable[None] | None]
+
+
+def _acquire_lease(conn: sqlite3.Connection, name: str, holder: str, now: float, ttl: float) -> str:
+    """Takes the lease if it is free or expired, renews it if it is ours; returns whoever holds it after."""
+    conn.execute("""
+        INSERT INTO worker_leases (name, holder, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+        WHERE worker_leases.holder = excluded.holder OR worker_leases.expires_at < ?;""",
+        (name, holder, now + ttl, now))
+    return conn.execute("SELECT holder FROM worker_leases WHERE name = ?;", (name,)).fetchone()[0]
+
+def _release_lease(conn: sqlite3.Connection, name: str, holder: str):
+    conn.execute("DELETE FROM worker_leases WHERE name = ? AND holder = ?;", (name, holder))
+
+def _insert_message(conn: sqlite3.Connection, origin: str, topic: str, payload: str, now: float):
+    conn.execute("INSERT INTO worker_messages (origin, topic, payload, created_at) VALUES (?, ?, ?, ?);",
+                 (origin, topic, payload, now))
+
+def _read_messages(conn: sqlite3.Connection, after: int, limit: int) -> list[sqlite3.Row]:
+    return conn.execute("SELECT id, origin, topic, payload FROM worker_messages WHERE id > ? ORDER BY id LIMIT ?;",
+                        (after, limit)).fetchall()
+
+def _last_message_id(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT COALESCE(MAX(id), 0) FROM worker_messages;").fetchone()[0]
+
+def _prune_messages(conn: sqlite3.Connection, before: float) -> int:
+    return conn.execute("DELETE FROM worker_messages WHERE created_at < ?;", (before,)).rowcount
+
+
+class Cluster:
+    """
+    Coordinates the worker processes serving one database. Exactly one worker
+    holds the leader lease and runs the services that must have a single
+    owner (the MQTT subscription, the enrollment terminals, the LMS upload);
+    every worker serves HTTP. A message published on one worker is handled
+    there at once and by every other worker within MESSAGE_POLL_INTERVAL_S,
+    through the worker_messages table.
+
+    Every process takes part, however it was started (`uvicorn --workers N`
+    doesn't tell its workers how many siblings they have), so a lone worker
+    also goes through the lease: it wins it on its first attempt, and costs
+    a write every LEASE_RENEW_S and a read every MESSAGE_POLL_INTERVAL_S.
+    """
+    def __init__(self, db: Database = default_db, worker_id: str = WORKER_ID):
+        self.db = db
+        self.worker_id = worker_id
+        self.is_leader = False
+        self.leader: str | None = None
+        self.published = 0
+        self.received = 0
+        self.elections = 0
+        self._handlers: dict[str, list[Handler]] = {}
+        self._on_elected: list[Callable[[], Awaitable[None]]] = []
+        self._on_deposed: list[Callable[[], Awaitable[None]]] = []
+        self._last_id = 0
+        self._reading = asyncio.Lock()
+        self._tasks: list[asyncio.Task] = []
+
+    def subscribe(self, topic: str, handler: Handler):
+        """Calls handler(payload) for every message on `topic`, wherever it was published."""
+        self._handlers.setdefault(topic, []).append(handler)
+
+    def on_elected(self, start: Callable[[], Awaitable[None]]):
+        """Runs `start` whenever this worker becomes the leader."""
+        self._on_elected.append(start)
+
+    def on_deposed(self, stop: Callable[[], Awaitable[None]]):
+        """Runs `stop` whenever this worker stops being the leader, including at shutdown."""
+        self._on_deposed.append(stop)
+
+    async def start(self):
+        self._last_id = await self.db.read(_last_message_id) # Only what is published from now on
+        self._tasks = [asyncio.create_task(self._lease_loop()), asyncio.create_task(self._read_loop())]
+        log.info("Worker %s started", self.worker_id)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        if self.is_leader:
+            await self._step_down()
+            # Released rather than left to expire, so a successor takes over at its next renewal
+            await self.db.write(_release_lease, LEADER_LEASE, self.worker_id)
+
+    async def publish(self, topic: str, payload: dict):
+        """Handles the message on this worker now and on every other one shortly after."""
+        await self._dispatch(topic, payload)
+        await self.db.write(_insert_message, self.worker_id, topic, json.dumps(payload), time.time())
+        self.published += 1
+
+    async def catch_up(self):
+        """Handles everything the other workers have published so far."""
+        async with self._reading:
+            while True:
+                rows = await self.db.read(_read_messages, self._last_id, MESSAGE_BATCH_SIZE)
+                for row in rows:
+                    self._last_id = row["id"]
+                    if row["origin"] != self.worker_id:
+                        self.received += 1
+                        await self._dispatch(row["topic"], json.loads(row["payload"]))
+                if len(rows) < MESSAGE_BATCH_SIZE:
+                    return
+
+    async def _dispatch(self, topic: str, payload: dict):
+        for handler in self._handlers.get(topic, ()):
+            try:
+                result = handler(payload)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                log.error("Handler for %s failed: %r", topic, e)
+
+    async def _read_loop(self):
+        while True:
+            try:
+                await self.catch_up()
+            except Exception as e:
+                log.warning("Reading worker messages failed: %r", e)
+            await asyncio.sleep(MESSAGE_POLL_INTERVAL_S)
+
+    async def _lease_loop(self):
+        renewed_at = time.monotonic()
+        pruned_at = 0.0
+        while True:
+            try:
+                holder = await self.db.write(_acquire_lease, LEADER_LEASE, self.worker_id, time.time(), LEASE_TTL_S)
+            except Exception as e:
+                log.warning("Leader lease renewal failed: %r", e)
+                if self.is_leader and time.monotonic() - renewed_at > LEASE_TTL_S:
+                    log.warning("Worker %s could not renew the leader lease in time", self.worker_id)
+                    await self._step_down() # Another worker may hold it by now
+            else:
+                if holder != self.leader:
+                    log.info("Leader is %s", holder)
+                    self.leader = holder
+                if holder == self.worker_id:
+                    renewed_at = time.monotonic()
+                    if not self.is_leader:
+                        await self._become_leader()
+                elif self.is_leader:
+                    log.warning("Worker %s lost the leader lease to %s", self.worker_id, holder)
+                    await self._step_down()
+                else:
+                    health.set(CLUSTER_SUBSYSTEM, READY, f"follower; leader is {holder}")
+            if self.is_leader and time.monotonic() - pruned_at >= PRUNE_INTERVAL_S:
+                pruned_at = time.monotonic()
+                try:
+                    await self.db.write(_prune_messages, time.time() - MESSAGE_RETENTION_S)
+                except Exception as e:
+                    log.warning("Pruning worker messages failed: %r", e)
+            await asyncio.sleep(LEASE_RENEW_S)
+
+    async def _become_leader(self):
+        self.is_leader = True
+        self.leader = self.worker_id
+        self.elections += 1
+        health.set(CLUSTER_SUBSYSTEM, READY, "leader")
+        log.info("Worker %s is now the leader", self.worker_id)
+        for start in self._on_elected:
+            try:
+                await start()
+            except Exception as e:
+                log.exception("Leader service failed to start: %r", e)
+
+    async def _step_down(self):
+        self.is_leader = False
+        for stop in reversed(self._on_deposed):
+            try:
+                await stop()
+            except Exception as e:
+                log.exception("Leader service failed to stop: %r", e)
+
+    def snapshot(self) -> dict:
+        return {
+            "worker": self.worker_id,
+            "leader": self.leader,
+            "is_leader": self.is_leader,
+            "elections": self.elections,
+            "published": self.published,
+            "received": self.received,
+        }
+
+
+cluster = Cluster()
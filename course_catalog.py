@@ -0,0 +1,129 @@
+# course_catalog.py
+import itertools
+import sqlite3
+import threading
+import time
+import fast_json
+
+CATALOG_VERSION_CHECK_S = 1.0 # How often a reader that can't see invalidate() calls re-checks the courses table
+
+COURSE_COLUMNS = ("code", "course_id", "title", "level", "faculty", "dept")
+
+# Answers for a course or facet combination the catalog doesn't have; never cached,
+# so made-up request values can't grow the cache
+EMPTY_LIST_RESPONSE = fast_json.dumps([])
+EMPTY_OBJECT_RESPONSE = fast_json.dumps({})
+
+# Cheap probe of the courses table: its newest change and newest delete
+COURSES_VERSION_SQL = """
+    SELECT (SELECT COALESCE(MAX(change_seq), 0) FROM courses),
+           (SELECT COALESCE(MAX(change_seq), 0) FROM sync_tombstones WHERE entity = 'courses');"""
+
+
+def _facet_keys(level, faculty, dept):
+    """Every (level, faculty, dept) lookup a course answers, with None as 'any'."""
+    return itertools.product((level, None), (faculty, None), (dept, None))
+
+
+class CourseCatalog:
+    """
+    Courses indexed by level x faculty x dept, with each distinct ESP32
+    response pre-serialized once and served as cached bytes until the courses
+    table changes. Requests may leave any facet out to mean "any". Only
+    lookups that match a course or a facet combination are cached, so the
+    cache is bounded by the catalog itself.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._courses: dict[str, dict] = {}
+        self._by_facets: dict[tuple, tuple[str, ...]] = {}
+        self._responses: dict[tuple, bytes] = {}
+        self._version: tuple | None = None
+        self._generation = 0 # Bumped by invalidate(), so a load already under way can't clear it
+        self._stale = True
+        self._last_check = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+
+    @property
+    def is_stale(self) -> bool:
+        return self._stale
+
+    def invalidate(self):
+        """Marks the catalog stale; it is rebuilt on the next request."""
+        with self._lock:
+            self._generation += 1
+            self._stale = True
+
+    def load(self, conn: sqlite3.Connection):
+        generation = self._generation
+        rows = conn.execute(f"SELECT {', '.join(COURSE_COLUMNS)} FROM courses ORDER BY code;").fetchall()
+        version = tuple(conn.execute(COURSES_VERSION_SQL).fetchone())
+        courses = {row["code"]: dict(row) for row in rows}
+        by_facets: dict[tuple, list[str]] = {}
+        for course in courses.values():
+            for key in _facet_keys(course["level"], course["faculty"], course["dept"]):
+                by_facets.setdefault(key, []).append(course["code"])
+        with self._lock:
+            self._courses = courses
+            self._by_facets = {key: tuple(codes) for key, codes in by_facets.items()}
+            self._responses = {}
+            self._version = version
+            self._stale = self._generation != generation # Invalidated while reading: reload next time
+            self.rebuilds += 1
+
+    def ensure_fresh(self, conn: sqlite3.Connection, probe: bool = False):
+        """
+        Reloads if invalidated. With probe=True (for processes that don't see
+        the sync routes' invalidate() calls) the courses table's version is
+        also compared, at most every CATALOG_VERSION_CHECK_S seconds.
+        """
+        if not self._stale and probe and time.monotonic() - self._last_check >= CATALOG_VERSION_CHECK_S:
+            self._last_check = time.monotonic()
+            if tuple(conn.execute(COURSES_VERSION_SQL).fetchone()) != self._version:
+                self.invalidate()
+        if self._stale:
+            self.load(conn)
+
+    def _cached(self, responses: dict, key: tuple, value) -> bytes:
+        response = responses.get(key)
+        if response is not None:
+            self.hits += 1
+            return response
+        self.misses += 1
+        response = fast_json.dumps(value)
+        with self._lock:
+            responses[key] = response
+        return response
+
+    # Each takes the response cache before the data, so a reload in between
+    # (on a reader thread) drops what is built from the old data with the old cache
+
+    def course_codes_response(self, level=None, faculty=None, dept=None) -> bytes:
+        responses = self._responses
+        codes = self._by_facets.get((level, faculty, dept))
+        if codes is None:
+            return EMPTY_LIST_RESPONSE
+        return self._cached(responses, ("course_codes", level, faculty, dept), list(codes))
+
+    def attendance_info_response(self, course_code: str) -> bytes:
+        responses = self._responses
+        course = self._courses.get(course_code)
+        if course is None:
+            return EMPTY_OBJECT_RESPONSE
+        return self._cached(responses, ("attendance_info", course_code), course)
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "courses": len(self._courses),
+            "cached_responses": len(self._responses),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "rebuilds": self.rebuilds,
+        }
+
+
+course_catalog = CourseCatalog()
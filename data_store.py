@@ -1,13 +1,3 @@
 # data_store.py
 
-courses = {
-    "CSC101": {
-        "lecturer": {"name": "Dr. Musa", "attended": False},
-        "students": [
-            {"name": "Aliyu Musa", "attended": False},
-            {"name": "Grace Obi", "attended": False},
-        ]
-    }
-}
-
 enrollments = {}  # uid -> name
@@ -1,70 +1,416 @@
 # database.py
+import asyncio
+import functools
+import os
 import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import contextlib as ctxlib
+from migrations import SESSION_WEEK_SQL, migrate
+from log import get_logger
+from metrics import DB_OPERATION_SECONDS, DB_WAIT_SECONDS, DB_COMMIT_SECONDS, DB_PENDING
 
 DATABASE_URL = "sqlite:///./central_server.db" # Or just "./central_server.db" for relative path
+DATABASE_PATH = DATABASE_URL.replace("sqlite:///./", "")
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE_URL.replace("sqlite:///./", ""), check_same_thread=False)
+log = get_logger("database")
+
+READER_POOL_SIZE = 4 # Concurrent read connections; writes always go through one writer
+STATEMENT_CACHE_SIZE = 256 # Prepared statements kept per connection
+
+# Applied to every connection. journal_mode is persistent in the file, the rest are per-connection.
+CONNECTION_PRAGMAS = (
+    "PRAGMA auto_vacuum = INCREMENTAL;", # Only takes effect on a new file; `migrations.py --vacuum` converts existing ones
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;", # Safe with WAL: only the last transactions can be lost on power cut
+    "PRAGMA cache_size = -16000;", # ~16 MiB page cache
+    "PRAGMA mmap_size = 134217728;", # 128 MiB memory-mapped reads
+    "PRAGMA busy_timeout = 5000;",
+    "PRAGMA temp_store = MEMORY;",
+)
+
+def _connect(path: str = DATABASE_PATH, read_only: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
     conn.row_factory = sqlite3.Row # Allows accessing rows as dictionaries
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    _attach_archives(conn) # Before query_only, which also forbids TEMP views
+    if read_only:
+        conn.execute("PRAGMA query_only = ON;")
     return conn
 
-def init_db():
-    conn = get_db_connection()
+ARCHIVE_SCHEMA = "archive" # Every closed semester is in one file, attached under this name
+
+def _attach_archives(conn: sqlite3.Connection):
+    """
+    Attaches the archive file once a semester has been archived and
+    recreates the all_<table> views over the live table and the archived
+    one. The views are TEMP since a view in main can't refer to another
+    database, so every connection builds its own. Semesters share the one
+    file so a connection never needs more than one of SQLite's few
+    attachment slots, however many years are archived.
+    """
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'archived_semesters';").fetchone():
+        return # Not migrated yet
+    query_only = conn.execute("PRAGMA query_only;").fetchone()[0]
+    conn.execute("PRAGMA query_only = OFF;")
+    try:
+        databases = {row["name"]: row["file"] for row in conn.execute("PRAGMA database_list;")}
+        schemas = ("main",)
+        archive = conn.execute("SELECT path FROM archived_semesters LIMIT 1;").fetchone()
+        if ARCHIVE_SCHEMA in databases:
+            schemas += (ARCHIVE_SCHEMA,)
+        elif archive is not None:
+            path = os.path.join(os.path.dirname(databases["main"]), archive["path"])
+            if os.path.exists(path): # ATTACH would create an empty file in its place
+                conn.execute(f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA};", (path,))
+                schemas += (ARCHIVE_SCHEMA,)
+            else:
+                log.error("Archive of closed semesters is missing: %s", path)
+        for table, columns in ARCHIVED_TABLES.items():
+            select = f"SELECT {', '.join(columns)} FROM {{schema}}.{table}"
+            conn.execute(f"DROP VIEW IF EXISTS temp.all_{table};")
+            conn.execute(f"CREATE TEMP VIEW all_{table} AS "
+                         + " UNION ALL ".join(select.format(schema=schema) for schema in schemas) + ";")
+    finally:
+        if query_only:
+            conn.execute("PRAGMA query_only = ON;")
+
+def get_db_connection():
+    """Opens a standalone connection, for scripts that run outside the server's pool."""
+    return _connect()
+
+
+class Database:
+    """
+    Bounded SQLite connection pool with an async API.
+
+    All writes are serialized through a single writer thread holding the only
+    write connection, so writers never contend for SQLite's lock. Reads run on
+    a small pool of read-only connections which, thanks to WAL, are not blocked
+    by an in-flight write. Every call runs on these dedicated threads, so the
+    asyncio loop never blocks on disk I/O.
+    """
+    def __init__(self, path: str = DATABASE_PATH, readers: int = READER_POOL_SIZE):
+        self.path = path
+        self.readers = readers
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: list[sqlite3.Connection] = []
+        self._writer: ThreadPoolExecutor | None = None
+        self._reader_pool: ThreadPoolExecutor | None = None
+        self._archives = 0 # Bumped when the archive file is created
+
+    def reattach_archives(self):
+        """Makes every pooled connection attach the archive file before its next call."""
+        self._archives += 1
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = self._local.conn
+        if self._local.archives != self._archives:
+            self._local.archives = self._archives
+            try:
+                _attach_archives(conn)
+            except sqlite3.Error as e:
+                log.error("Could not attach the archive: %r", e)
+        return conn
+
+    def _open_thread_connection(self, read_only: bool):
+        conn = _connect(self.path, read_only=read_only)
+        self._local.conn = conn
+        self._local.archives = self._archives
+        with self._lock:
+            self._connections.append(conn)
+
+    def _executors(self) -> tuple[ThreadPoolExecutor, ThreadPoolExecutor]:
+        with self._lock:
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="db-writer",
+                    initializer=self._open_thread_connection, initargs=(False,))
+                self._reader_pool = ThreadPoolExecutor(
+                    max_workers=self.readers, thread_name_prefix="db-reader",
+                    initializer=self._open_thread_connection, initargs=(True,))
+            return self._writer, self._reader_pool
+
+    def _run_write(self, fn, args, submitted: float):
+        started = time.perf_counter()
+        DB_WAIT_SECONDS.labels("write").observe(started - submitted)
+        conn = self._connection()
+        try:
+            result = fn(conn, *args)
+            committing = time.perf_counter()
+            conn.commit()
+            done = time.perf_counter()
+            DB_COMMIT_SECONDS.observe(done - committing)
+            DB_OPERATION_SECONDS.labels("write").observe(done - started)
+            return result
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def _run_read(self, fn, args, submitted: float):
+        started = time.perf_counter()
+        DB_WAIT_SECONDS.labels("read").observe(started - submitted)
+        try:
+            return fn(self._connection(), *args)
+        finally:
+            DB_OPERATION_SECONDS.labels("read").observe(time.perf_counter() - started)
+
+    async def _submit(self, kind: str, executor: ThreadPoolExecutor, run, fn, args):
+        pending = DB_PENDING.labels(kind)
+        pending.inc()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, functools.partial(run, fn, args, time.perf_counter()))
+        finally:
+            pending.dec()
+
+    async def write(self, fn, *args):
+        """Runs fn(conn, *args) on the writer thread and commits, or rolls back on error."""
+        writer, _ = self._executors()
+        return await self._submit("write", writer, self._run_write, fn, args)
+
+    async def read(self, fn, *args):
+        """Runs fn(conn, *args) on one of the read-only connections."""
+        _, reader_pool = self._executors()
+        return await self._submit("read", reader_pool, self._run_read, fn, args)
+
+    async def execute(self, sql: str, params=()) -> int:
+        """Executes one write statement and returns the number of affected rows."""
+        return await self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql: str, seq_of_params) -> int:
+        return await self.write(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    async def fetchall(self, sql: str, params=()) -> list[sqlite3.Row]:
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def fetchone(self, sql: str, params=()) -> sqlite3.Row | None:
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    def close(self):
+        """Drains both executors and closes every pooled connection."""
+        with self._lock:
+            writer, reader_pool = self._writer, self._reader_pool
+            self._writer = self._reader_pool = None
+        if writer:
+            writer.shutdown(wait=True)
+            reader_pool.shutdown(wait=True)
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+
+
+db = Database()
+
+# table -> (primary key columns, columns whose change bumps the row's change_seq)
+VERSIONED_TABLES = {
+    "lecturers": (("id",), ("name", "sch_id", "rfid_uid")),
+    "students": (("id",), ("name", "sch_id", "rfid_uid")),
+    "courses": (("code",), ("course_id", "title", "level", "faculty", "dept")),
+    "lecture_sessions": (("id",), ("course_code", "lecturer_id", "session_date")),
+    "attendance_records": (("session_id", "student_id"), ("attendance_time", "attended")),
+}
+
+# table -> (columns sent upstream, primary key columns); every change is queued in lms_outbox
+OUTBOX_TABLES = {
+    "lecture_sessions": (("id", "course_code", "lecturer_id", "session_date"), ("id",)),
+    "attendance_records": (("session_id", "student_id", "attendance_time", "attended"), ("session_id", "student_id")),
+}
+
+# table -> columns; rows of closed semesters move to the archive file (archive.py), and the
+# TEMP view all_<table> spans the live table and the archived one
+ARCHIVED_TABLES = {
+    "lecture_sessions": ("id", "course_code", "lecturer_id", "session_date", "created_at", "change_seq", "updated_at"),
+    "attendance_records": ("session_id", "student_id", "attendance_time", "attended", "change_seq", "updated_at"),
+}
+
+# Delete triggers don't fire while trigger_suppression has a row: archival moves rows
+# out of the live tables, which is neither a change to sync nor to count out of the aggregates
+NOT_SUPPRESSED = "NOT EXISTS (SELECT 1 FROM trigger_suppression)"
+
+def get_database() -> Database:
+    """FastAPI dependency returning the shared connection pool."""
+    return db
+
+def _create_schema(conn: sqlite3.Connection, outbox: bool):
+    # Tables and indexes are versioned in migrations.py; triggers are derived
+    # from the table maps above and recreated on every start.
+    migrate(conn)
     cursor = conn.cursor()
-    # Create tables
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS lecturers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            sch_id TEXT UNIQUE,
-            rfid_uid TEXT UNIQUE, -- Fingerprint/Card UID from enrollment
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS students (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            sch_id TEXT UNIQUE, 
-            rfid_uid TEXT UNIQUE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS courses (
-            code TEXT PRIMARY KEY,
-            course_id INTEGER NOT NULL,
-            title TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS lecture_sessions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            course_code TEXT NOT NULL,
-            lecturer_id INTEGER NOT NULL, -- Lecturer for this specific session
-            session_date TIMESTAMP NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (course_code) REFERENCES courses(code) ON DELETE RESTRICT,
-            FOREIGN KEY (lecturer_id) REFERENCES lecturers(id) ON DELETE RESTRICT
-        );
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS attendance_records (
-            session_id INTEGER NOT NULL,
-            student_id INTEGER NOT NULL,
-            attendance_time TIMESTAMP NOT NULL,
-            attended BOOLEAN NOT NULL DEFAULT 1,
-            PRIMARY KEY (session_id, student_id),
-            FOREIGN KEY (session_id) REFERENCES lecture_sessions(id) ON DELETE CASCADE,
-            FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE RESTRICT
-        );
-    """)
-    conn.commit()
-    print("Database initialized successfully.")
-    conn.close()
+    # One transaction, so another worker's write never runs while a trigger is missing
+    cursor.execute("BEGIN IMMEDIATE;")
+    _create_change_tracking(cursor)
+    _create_outbox(cursor, outbox)
+    _create_attendance_stats(cursor)
+    cursor.close()
+
+def _create_change_tracking(cursor: sqlite3.Cursor):
+    """
+    Gives every synced table a monotonic change_seq and records deletes as
+    tombstones, so clients can pull only what changed after a cursor.
+    All tables share one sequence, held in sync_sequence.
+    """
+    for table, (keys, tracked) in VERSIONED_TABLES.items():
+        match_new = " AND ".join(f"{k} = NEW.{k}" for k in keys)
+        changed = " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in keys + tracked)
+        old_key = "json_object(" + ", ".join(f"'{k}', OLD.{k}" for k in keys) + ")"
+        bump = f"""
+            UPDATE sync_sequence SET value = value + 1;
+            UPDATE {table} SET change_seq = (SELECT value FROM sync_sequence), updated_at = CURRENT_TIMESTAMP
+            WHERE {match_new};"""
+        # Always recreated so a change to the tracked columns reaches existing databases
+        for suffix in ("insert", "update", "delete"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {table}_versioned_{suffix};")
+        cursor.execute(f"""
+            CREATE TRIGGER {table}_versioned_insert AFTER INSERT ON {table}
+            BEGIN {bump}
+            END;
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER {table}_versioned_update AFTER UPDATE OF {", ".join(keys + tracked)} ON {table}
+            WHEN {changed}
+            BEGIN {bump}
+            END;
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER {table}_versioned_delete AFTER DELETE ON {table}
+            WHEN {NOT_SUPPRESSED}
+            BEGIN
+                UPDATE sync_sequence SET value = value + 1;
+                INSERT INTO sync_tombstones (change_seq, entity, row_key)
+                VALUES ((SELECT value FROM sync_sequence), '{table}', {old_key});
+            END;
+        """)
+
+def _create_outbox(cursor: sqlite3.Cursor, enabled: bool):
+    """
+    Queues every change to the tables in OUTBOX_TABLES for upload to the LMS.
+    The queue is filled by triggers, so a record is in the outbox exactly when
+    the write that produced it has committed. Without an upload configured
+    nothing would ever drain it, so the triggers are only dropped; the LMS pulls
+    changes made meanwhile from /cs/sync/sessions and /cs/sync/attendance.
+    """
+    for table, (columns, keys) in OUTBOX_TABLES.items():
+        new_row = "json_object(" + ", ".join(f"'{c}', NEW.{c}" for c in columns) + ")"
+        old_key = "json_object(" + ", ".join(f"'{k}', OLD.{k}" for k in keys) + ")"
+        changed = " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in columns)
+        for suffix in ("insert", "update", "delete"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {table}_outbox_{suffix};")
+        if not enabled:
+            continue
+        cursor.execute(f"""
+            CREATE TRIGGER {table}_outbox_insert AFTER INSERT ON {table}
+            BEGIN
+                INSERT INTO lms_outbox (entity, op, payload) VALUES ('{table}', 'upsert', {new_row});
+            END;
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER {table}_outbox_update AFTER UPDATE OF {", ".join(columns)} ON {table}
+            WHEN {changed}
+            BEGIN
+                INSERT INTO lms_outbox (entity, op, payload) VALUES ('{table}', 'upsert', {new_row});
+            END;
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER {table}_outbox_delete AFTER DELETE ON {table}
+            WHEN {NOT_SUPPRESSED}
+            BEGIN
+                INSERT INTO lms_outbox (entity, op, payload) VALUES ('{table}', 'delete', {old_key});
+            END;
+        """)
+
+def _attendance_delta(ref: str, present: str, absent: str, recorded: int) -> str:
+    """Trigger body applying one attendance row's change to every aggregate of its session."""
+    session = f"(SELECT {{cols}} FROM attendance_session_stats WHERE session_id = {ref}.session_id)"
+    counts = f"present = present + ({present}), absent = absent + ({absent})"
+    return f"""
+        UPDATE attendance_session_stats SET {counts} WHERE session_id = {ref}.session_id;
+        UPDATE attendance_course_stats SET {counts} WHERE course_code = {session.format(cols="course_code")};
+        UPDATE attendance_course_weekly SET {counts}
+        WHERE (course_code, week_start) = {session.format(cols="course_code, week_start")};
+        INSERT INTO attendance_student_course (course_code, student_id, attended, recorded)
+        SELECT course_code, {ref}.student_id, {present}, {recorded} FROM attendance_session_stats WHERE session_id = {ref}.session_id
+        ON CONFLICT(course_code, student_id) DO UPDATE SET attended = attended + excluded.attended, recorded = recorded + excluded.recorded;"""
+
+def _session_added(ref: str) -> str:
+    """Trigger body counting a session, and any attendance already stored for it, into the aggregates."""
+    return f"""
+        INSERT INTO attendance_session_stats (session_id, course_code, week_start, present, absent)
+        SELECT {ref}.id, {ref}.course_code, {SESSION_WEEK_SQL.format(date=f"{ref}.session_date")},
+               COALESCE(SUM(attended), 0), COALESCE(SUM(NOT attended), 0)
+        FROM attendance_records WHERE session_id = {ref}.id;
+        INSERT INTO attendance_course_stats (course_code, sessions, present, absent)
+        SELECT course_code, 1, present, absent FROM attendance_session_stats WHERE session_id = {ref}.id
+        ON CONFLICT(course_code) DO UPDATE SET
+            sessions = sessions + 1, present = present + excluded.present, absent = absent + excluded.absent;
+        INSERT INTO attendance_course_weekly (course_code, week_start, sessions, present, absent)
+        SELECT course_code, week_start, 1, present, absent FROM attendance_session_stats WHERE session_id = {ref}.id
+        ON CONFLICT(course_code, week_start) DO UPDATE SET
+            sessions = sessions + 1, present = present + excluded.present, absent = absent + excluded.absent;
+        INSERT INTO attendance_student_course (course_code, student_id, attended, recorded)
+        SELECT {ref}.course_code, student_id, attended, 1 FROM attendance_records WHERE session_id = {ref}.id
+        ON CONFLICT(course_code, student_id) DO UPDATE SET attended = attended + excluded.attended, recorded = recorded + 1;"""
+
+def _session_removed(ref: str) -> str:
+    """Inverse of _session_added, using the counts held in the session's aggregate row."""
+    stats = f"(SELECT {{col}} FROM attendance_session_stats WHERE session_id = {ref}.id)"
+    less = f"sessions = sessions - 1, present = present - {stats.format(col='present')}, absent = absent - {stats.format(col='absent')}"
+    return f"""
+        UPDATE attendance_course_stats SET {less} WHERE course_code = {stats.format(col="course_code")};
+        UPDATE attendance_course_weekly SET {less}
+        WHERE course_code = {stats.format(col="course_code")} AND week_start = {stats.format(col="week_start")};
+        UPDATE attendance_student_course SET
+            attended = attended - (SELECT a.attended FROM attendance_records a
+                                   WHERE a.session_id = {ref}.id AND a.student_id = attendance_student_course.student_id),
+            recorded = recorded - 1
+        WHERE course_code = {stats.format(col="course_code")}
+          AND student_id IN (SELECT student_id FROM attendance_records WHERE session_id = {ref}.id);
+        DELETE FROM attendance_session_stats WHERE session_id = {ref}.id;"""
+
+def _create_attendance_stats(cursor: sqlite3.Cursor):
+    """
+    Attendance aggregates kept current by triggers, so reports read a handful
+    of rows however long the semester's history grows: per session, per
+    course, per course and week, and per student and course.
+    """
+    triggers = {
+        "lecture_sessions_stats_insert": ("AFTER INSERT ON lecture_sessions", "", _session_added("NEW")),
+        "lecture_sessions_stats_delete": ("AFTER DELETE ON lecture_sessions", f"WHEN {NOT_SUPPRESSED}", _session_removed("OLD")),
+        "lecture_sessions_stats_update": (
+            "AFTER UPDATE OF id, course_code, session_date ON lecture_sessions",
+            "WHEN OLD.id IS NOT NEW.id OR OLD.course_code IS NOT NEW.course_code OR OLD.session_date IS NOT NEW.session_date",
+            _session_removed("OLD") + _session_added("NEW")),
+        "attendance_records_stats_insert": (
+            "AFTER INSERT ON attendance_records", "",
+            _attendance_delta("NEW", "NEW.attended", "NOT NEW.attended", 1)),
+        "attendance_records_stats_delete": (
+            "AFTER DELETE ON attendance_records", f"WHEN {NOT_SUPPRESSED}",
+            _attendance_delta("OLD", "-OLD.attended", "-(NOT OLD.attended)", -1)),
+        "attendance_records_stats_update": (
+            "AFTER UPDATE OF attended ON attendance_records",
+            "WHEN OLD.attended IS NOT NEW.attended AND OLD.session_id = NEW.session_id AND OLD.student_id = NEW.student_id",
+            _attendance_delta("NEW", "NEW.attended - OLD.attended", "(NOT NEW.attended) - (NOT OLD.attended)", 0)),
+        "attendance_records_stats_move": (
+            "AFTER UPDATE OF session_id, student_id ON attendance_records",
+            "WHEN OLD.session_id IS NOT NEW.session_id OR OLD.student_id IS NOT NEW.student_id",
+            _attendance_delta("OLD", "-OLD.attended", "-(NOT OLD.attended)", -1)
+            + _attendance_delta("NEW", "NEW.attended", "NOT NEW.attended", 1)),
+    }
+    # Always recreated, like the versioning triggers
+    for name, (event, when, body) in triggers.items():
+        cursor.execute(f"DROP TRIGGER IF EXISTS {name};")
+        cursor.execute(f"CREATE TRIGGER {name} {event} {when} BEGIN {body} END;")
+
+async def init_db(database: Database = db, outbox: bool = True):
+    """Migrates the schema and recreates its triggers; `outbox` is whether changes are queued for the LMS upload."""
+    await database.write(_create_schema, outbox)
+    database.reattach_archives() # The views need the migrated schema
+    log.info("Database initialized successfully.")
 
 # Context manager for database sessions in FastAPI
 @contextmanager
@@ -83,4 +429,4 @@ def get_db():
 #     db = next(db_gen)
 #     cursor = db.cursor()
 #     # handle database operations here
-#     db.commit()
\ No newline at end of file
+#     db.commit()
@@ -0,0 +1,116 @@
+# enrollment_events.py
+import asyncio
+import collections
+import time
+
+EVENT_REPLAY_SIZE = 32 # Events kept per session for subscribers that connect late
+SUBSCRIBER_QUEUE_SIZE = 64 # Undelivered events per subscriber before its oldest are dropped
+FINISHED_SESSION_TTL_S = 300 # How long a finished session's history stays available
+MAX_SESSIONS = 1000 # Hard cap; the least recently started sessions are evicted first
+SWEEP_INTERVAL_S = 30
+
+FINAL_EVENT_TYPES = frozenset({"COMPLETED", "FAILED"})
+
+# Worker message topic carrying every status event, so observers on any worker see it
+ENROLLMENT_EVENT_TOPIC = "enrollment.event"
+
+
+class EnrollmentChannel:
+    """Event history and live subscribers of one enrollment session."""
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.history: collections.deque[dict] = collections.deque(maxlen=EVENT_REPLAY_SIZE)
+        self.subscribers: set[asyncio.Queue] = set()
+        self.finished_at: float | None = None
+        self.dropped = 0
+
+    def publish(self, event: dict):
+        self.history.append(event)
+        for queue in self.subscribers:
+            if queue.full():
+                # A slow observer loses its oldest pending event rather than
+                # stalling the enrollment task that is publishing.
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(event)
+        if event["type"] in FINAL_EVENT_TYPES:
+            self.finished_at = time.monotonic()
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        for event in list(self.history)[-SUBSCRIBER_QUEUE_SIZE:]:
+            queue.put_nowait(event)
+        self.subscribers.add(queue)
+        return queue
+
+
+class EnrollmentEventHub:
+    """
+    Per-session fan-out of enrollment status events. Events published before
+    anyone connects are replayed to whoever subscribes later, any number of
+    observers can follow one session, and publishing never waits on a socket.
+    """
+    def __init__(self):
+        self._channels: collections.OrderedDict[str, EnrollmentChannel] = collections.OrderedDict()
+        self._sweeper: asyncio.Task | None = None
+
+    def open(self, session_id: str) -> EnrollmentChannel:
+        channel = self._channels.get(session_id)
+        if channel is None:
+            channel = self._channels[session_id] = EnrollmentChannel(session_id)
+            while len(self._channels) > MAX_SESSIONS:
+                self._channels.popitem(last=False)
+        return channel
+
+    def publish(self, session_id: str, message_type: str, data: dict):
+        event = {"type": message_type, "data": data, "timestamp": time.time()}
+        self.open(session_id).publish(event)
+
+    def subscribe(self, session_id: str) -> asyncio.Queue | None:
+        """Returns a queue of the session's events (history first), or None for an unknown session."""
+        channel = self._channels.get(session_id)
+        return channel.subscribe() if channel is not None else None
+
+    def unsubscribe(self, session_id: str, queue: asyncio.Queue):
+        channel = self._channels.get(session_id)
+        if channel is not None:
+            channel.subscribers.discard(queue)
+
+    @property
+    def subscriber_count(self) -> int:
+        return sum(len(c.subscribers) for c in self._channels.values())
+
+    def __len__(self):
+        return len(self._channels)
+
+    def clear(self):
+        """Forgets every session, for a process that serves a fresh database (the benchmark's runs)."""
+        self._channels.clear()
+
+    def sweep(self):
+        """Forgets finished sessions older than FINISHED_SESSION_TTL_S."""
+        cutoff = time.monotonic() - FINISHED_SESSION_TTL_S
+        expired = [sid for sid, c in self._channels.items() if c.finished_at is not None and c.finished_at < cutoff]
+        for session_id in expired:
+            del self._channels[session_id]
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL_S)
+            self.sweep()
+
+    def start(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+
+
+enrollment_events = EnrollmentEventHub()
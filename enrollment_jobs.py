@@ -0,0 +1,101 @@
+# enrollment_jobs.py (Enrollments accepted by any worker, run by the one holding the terminals)
+import asyncio
+import sqlite3
+import time
+from typing import Awaitable, Callable
+from cluster import Cluster
+from database import Database
+from enrollment_events import ENROLLMENT_EVENT_TOPIC
+from log import get_logger
+
+log = get_logger("enrollment")
+
+ENROLLMENT_JOB_TOPIC = "enrollment.job" # Wakes the leader when a job is queued
+
+QUEUED = "queued"
+RUNNING = "running"
+INTERRUPTED = "interrupted" # Its worker stopped leading before the card was read
+JOB_RETENTION_S = 86400 # Finished jobs are kept this long
+PRUNE_INTERVAL_S = 3600
+
+Run = Callable[[str, str, str], Awaitable[tuple[str, str | None]]] # (username, unique_id, session_id) -> (outcome, uid)
+
+
+def _insert_job(conn: sqlite3.Connection, session_id: str, username: str, unique_id: str, now: float):
+    conn.execute("""
+        INSERT INTO enrollment_jobs (session_id, username, unique_id, state, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(session_id) DO NOTHING;""",
+        (session_id, username, unique_id, QUEUED, now, now))
+
+def _claim_jobs(conn: sqlite3.Connection, worker: str, now: float) -> list[sqlite3.Row]:
+    rows = conn.execute("""
+        UPDATE enrollment_jobs SET state = ?, worker = ?, updated_at = ? WHERE state = ?
+        RETURNING session_id, username, unique_id, created_at;""", (RUNNING, worker, now, QUEUED)).fetchall()
+    return sorted(rows, key=lambda row: row["created_at"]) # RETURNING has no order of its own
+
+def _finish_job(conn: sqlite3.Connection, session_id: str, state: str, uid: str | None, now: float):
+    conn.execute("UPDATE enrollment_jobs SET state = ?, uid = ?, updated_at = ? WHERE session_id = ?;",
+                 (state, uid, now, session_id))
+
+def _interrupt_orphans(conn: sqlite3.Connection, worker: str, now: float) -> list[str]:
+    """Marks jobs left running by a previous leader as interrupted; returns their session ids."""
+    return [row[0] for row in conn.execute("""
+        UPDATE enrollment_jobs SET state = ?, updated_at = ? WHERE state = ? AND worker IS NOT ?
+        RETURNING session_id;""", (INTERRUPTED, now, RUNNING, worker))]
+
+def _prune_jobs(conn: sqlite3.Connection, before: float) -> int:
+    return conn.execute("DELETE FROM enrollment_jobs WHERE state NOT IN (?, ?) AND updated_at < ?;",
+                        (QUEUED, RUNNING, before)).rowcount
+
+
+class EnrollmentJobs:
+    """
+    Enrollments in multi-worker mode. Whichever worker receives the request
+    records a queued job and announces it; the leader, which owns the
+    enrollment terminals, claims queued jobs and runs each with `run`. A job
+    running when its leader went away can't be resumed (the card tap went to
+    the old process), so the next leader fails it and says so.
+    """
+    def __init__(self, cluster: Cluster, db: Database, run: Run):
+        self.cluster = cluster
+        self.db = db
+        self.run = run
+        self._running: set[asyncio.Task] = set()
+        self._pruned_at = 0.0
+        cluster.subscribe(ENROLLMENT_JOB_TOPIC, lambda payload: self.claim())
+
+    async def submit(self, session_id: str, username: str, unique_id: str):
+        await self.db.write(_insert_job, session_id, username, unique_id, time.time())
+        await self.cluster.publish(ENROLLMENT_JOB_TOPIC, {"session_id": session_id})
+
+    async def start(self):
+        """Run on election: fails what the previous leader left running, then takes over the queue."""
+        for session_id in await self.db.write(_interrupt_orphans, self.cluster.worker_id, time.time()):
+            log.warning("Enrollment %s was interrupted by a change of leader", session_id)
+            await self.cluster.publish(ENROLLMENT_EVENT_TOPIC, {
+                "session_id": session_id, "type": "FAILED",
+                "data": {"message": "Enrollment interrupted by a server restart; please try again.", "success": False},
+            })
+        await self.claim()
+
+    async def claim(self):
+        if not self.cluster.is_leader:
+            return
+        for job in await self.db.write(_claim_jobs, self.cluster.worker_id, time.time()):
+            task = asyncio.create_task(self._run(job["session_id"], job["username"], job["unique_id"]))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+        if time.monotonic() - self._pruned_at >= PRUNE_INTERVAL_S:
+            self._pruned_at = time.monotonic()
+            await self.db.write(_prune_jobs, time.time() - JOB_RETENTION_S)
+
+    async def drain(self):
+        """Waits for the jobs running here to record how they ended; run once their terminals have stopped."""
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+    async def _run(self, session_id: str, username: str, unique_id: str):
+        outcome, uid = "error", None
+        try:
+            outcome, uid = await self.run(username, unique_id, session_id)
+        finally:
+            await self.db.write(_finish_job, session_id, outcome, uid, time.time())
@@ -0,0 +1,246 @@
+# enrollment_manager.py
+import abc
+import asyncio
+import collections
+import itertools
+import os
+import re
+import time
+from typing import Awaitable, Callable
+from log import get_logger
+
+log = get_logger("enrollment")
+
+BAUD_RATE = 115200
+ENROLL_TIMEOUT_S = 30 # Time allowed for the card tap once a terminal has the job
+SERIAL_RESET_DELAY_S = 2 # ESP32 reboots when the port is opened; only paid once per connection
+SIMULATED_TAP_DELAY_S = 2 # Mirrors serial_enroll_sim.py when no serial terminals are configured
+
+# What a terminal's "UID:" reply must carry; anything else is line noise, not a card
+UID_PATTERN = re.compile(r"[0-9A-Za-z_-]{1,64}")
+
+# Comma-separated serial ports of enrollment terminals, e.g. "/dev/ttyUSB0,/dev/ttyUSB1".
+# When empty a single in-process simulated terminal is used.
+ENROLL_SERIAL_PORTS = [p for p in os.environ.get("ENROLL_SERIAL_PORTS", "").split(",") if p]
+
+Notify = Callable[[str, str, dict], Awaitable[None]] # (stage, details, extra data)
+
+
+class EnrollmentError(Exception):
+    pass
+
+
+class EnrollmentTerminal(abc.ABC):
+    """A reader that can be asked to enroll one card at a time."""
+    name = "terminal"
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @abc.abstractmethod
+    async def enroll(self, user_id: str, user_name: str, notify: Notify) -> str | None:
+        """Runs one enrollment and returns the card UID, or None if no card was presented in time."""
+
+
+class SimulatedTerminal(EnrollmentTerminal):
+    """In-process stand-in for serial_enroll_sim.py."""
+    _serial = itertools.count(1)
+
+    def __init__(self, name: str = "simulated", tap_delay: float = SIMULATED_TAP_DELAY_S):
+        self.name = name
+        self.tap_delay = tap_delay
+
+    async def enroll(self, user_id: str, user_name: str, notify: Notify) -> str | None:
+        await asyncio.sleep(self.tap_delay)
+        # The serial keeps cards unique when several simulated terminals finish in the same millisecond
+        return f"SIM_UID_{int(time.time() * 1000)}_{next(self._serial)}"
+
+
+class SerialTerminal(EnrollmentTerminal):
+    """
+    Persistent connection to an ESP32 speaking the serial_enroll2.py protocol:
+    the host writes "ENROLL:<user_id>:<user_name>" and the terminal answers
+    with progress lines and finally "UID:<uid>". The port stays open between
+    enrollments, so the reset delay is paid once rather than per request.
+    A UID reply that doesn't match UID_PATTERN fails the enrollment, and the
+    manager reopens the port for the next one. tests/test_enrollment_terminals.py
+    runs this class against fake_terminal.py's pseudo-terminal readers.
+    """
+    def __init__(self, port: str, baud_rate: int = BAUD_RATE, reset_delay: float = SERIAL_RESET_DELAY_S,
+                 timeout: float = ENROLL_TIMEOUT_S):
+        self.name = port
+        self.port = port
+        self.baud_rate = baud_rate
+        self.reset_delay = reset_delay
+        self.timeout = timeout
+        self._serial = None
+        self._buffer = b""
+        self._lines: asyncio.Queue[str] = asyncio.Queue()
+
+    @property
+    def is_open(self) -> bool:
+        return self._serial is not None
+
+    async def open(self):
+        if self.is_open:
+            return
+        import serial # pyserial is only needed when real terminals are configured
+
+        self._serial = await asyncio.to_thread(serial.Serial, self.port, self.baud_rate, timeout=0)
+        await asyncio.sleep(self.reset_delay)
+        self._serial.reset_input_buffer()
+        self._serial.reset_output_buffer()
+        asyncio.get_running_loop().add_reader(self._serial.fileno(), self._on_readable)
+        log.info("Terminal %s connected", self.name)
+
+    async def close(self):
+        if not self.is_open:
+            return
+        asyncio.get_running_loop().remove_reader(self._serial.fileno())
+        self._serial.close()
+        self._serial = None
+        self._buffer = b""
+
+    def _on_readable(self):
+        try:
+            data = self._serial.read(self._serial.in_waiting or 1)
+        except Exception as e:
+            log.warning("Terminal %s read failed: %s", self.name, e)
+            asyncio.get_running_loop().create_task(self.close())
+            return
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b"\n")
+        for line in lines:
+            line = line.decode(errors="replace").strip()
+            if line:
+                self._lines.put_nowait(line)
+
+    async def enroll(self, user_id: str, user_name: str, notify: Notify) -> str | None:
+        await self.open()
+        while not self._lines.empty(): # Drop anything left over from a previous job
+            self._lines.get_nowait()
+        self._serial.write(f"ENROLL:{user_id}:{user_name}\n".encode())
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                line = await asyncio.wait_for(self._lines.get(), deadline - time.monotonic())
+            except (asyncio.TimeoutError, ValueError):
+                return None
+            if line.startswith("UID:"):
+                uid = line.split("UID:", 1)[1].strip()
+                if not UID_PATTERN.fullmatch(uid):
+                    raise EnrollmentError(f"garbled UID reply {line!r}")
+                return uid
+            await notify("TERMINAL", line, {})
+
+
+class EnrollmentJob:
+    def __init__(self, session_id: str, username: str, unique_id: str, notify: Notify):
+        self.session_id = session_id
+        self.username = username
+        self.unique_id = unique_id
+        self.notify = notify
+        self.result: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class EnrollmentManager:
+    """
+    Queues enrollment requests and runs each on the next free terminal.
+    Every terminal has one worker task, so a reader never receives two
+    commands at once; waiting jobs are told their queue position as it moves.
+    """
+    def __init__(self, terminals: list[EnrollmentTerminal]):
+        self.terminals = terminals
+        self._pending: collections.deque[EnrollmentJob] = collections.deque()
+        self._available = asyncio.Semaphore(0)
+        self._workers: list[asyncio.Task] = []
+
+    async def start(self):
+        # Opened together, so the ESP32 reset delays overlap instead of adding up
+        await asyncio.gather(*(self._open(terminal) for terminal in self.terminals))
+        for terminal in self.terminals:
+            self._workers.append(asyncio.create_task(self._worker(terminal)))
+        log.info("Manager started with %d terminal(s)", len(self.terminals))
+
+    async def _open(self, terminal: EnrollmentTerminal):
+        try:
+            await terminal.open()
+        except Exception as e:
+            # The worker retries on its first job, so a missing reader doesn't block startup
+            log.warning("Could not open terminal %s: %s", terminal.name, e)
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        for terminal in self.terminals:
+            await terminal.close()
+        while self._pending:
+            job = self._pending.popleft()
+            if not job.result.done():
+                job.result.set_exception(EnrollmentError("Enrollment service shutting down"))
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    async def enroll(self, session_id: str, username: str, unique_id: str, notify: Notify) -> str | None:
+        """Queues an enrollment and waits for the card UID (None if no card was read)."""
+        job = EnrollmentJob(session_id, username, unique_id, notify)
+        self._pending.append(job)
+        await notify("QUEUED", "Waiting for a free enrollment terminal.", {"position": len(self._pending)})
+        self._available.release()
+        try:
+            return await job.result
+        finally:
+            if job in self._pending: # Caller went away before a terminal picked it up
+                self._pending.remove(job)
+
+    async def _announce_positions(self):
+        for position, job in enumerate(list(self._pending), start=1):
+            try:
+                await job.notify("QUEUED", "Waiting for a free enrollment terminal.", {"position": position})
+            except Exception as e: # One observer's failure mustn't cost the job being started
+                log.warning("Queue position update for %s failed: %r", job.session_id, e)
+
+    async def _worker(self, terminal: EnrollmentTerminal):
+        while True:
+            await self._available.acquire()
+            if not self._pending:
+                continue
+            job = self._pending.popleft()
+            try: # From here the job is only this worker's, so every way out must settle it
+                await self._announce_positions()
+                await job.notify("CONNECTING_ESP32", f"Connecting to terminal {terminal.name}...", {"terminal": terminal.name})
+                await terminal.open()
+                await job.notify("WAITING_FOR_CARD", "Please present RFID card on terminal.", {"terminal": terminal.name})
+                uid = await terminal.enroll(job.unique_id, job.username, job.notify)
+                if not job.result.done():
+                    job.result.set_result(uid)
+            except asyncio.CancelledError:
+                if not job.result.done():
+                    job.result.set_exception(EnrollmentError("Enrollment service shutting down"))
+                raise
+            except Exception as e:
+                await terminal.close() # Reconnect on the next job
+                if not job.result.done():
+                    job.result.set_exception(EnrollmentError(f"Terminal {terminal.name} failed: {e}"))
+
+
+def build_terminals() -> list[EnrollmentTerminal]:
+    if ENROLL_SERIAL_PORTS:
+        return [SerialTerminal(port) for port in ENROLL_SERIAL_PORTS]
+    return [SimulatedTerminal()]
+
+
+enrollment_manager: EnrollmentManager | None = None
+
+def get_enrollment_manager() -> EnrollmentManager:
+    global enrollment_manager
+    if enrollment_manager is None:
+        enrollment_manager = EnrollmentManager(build_terminals())
+    return enrollment_manager
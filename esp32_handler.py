@@ -0,0 +1,212 @@
+# esp32_handler.py
+import collections
+import json
+import sqlite3
+from datetime import datetime
+from database import db
+from course_catalog import course_catalog
+from ingest import get_ingestor
+from models import StudentAttendanceRecordBase
+from roster import Roster, RosterError, load_roster, unpack_upload, decode_upload, apply_attendance
+from session_context import session_contexts
+import fast_json
+from log import get_logger
+
+log = get_logger("esp32")
+
+COURSE_CODES_REQUEST_TOPIC = "esp32/request/course_codes"
+ATTENDANCE_INFO_REQUEST_TOPIC = "esp32/request/attendance_info"
+ROSTER_REQUEST_TOPIC = "esp32/request/roster"
+RECORD_ATTENDANCE_TOPIC = "esp32/record/attendance" # JSON fallback for firmware without roster support
+ROSTER_ATTENDANCE_PREFIX = "esp32/record/roster_attendance/" # Binary upload, followed by the device id
+ESP32_TOPIC_PREFIX = "esp32/"
+ESP32_TOPICS = (COURSE_CODES_REQUEST_TOPIC, ATTENDANCE_INFO_REQUEST_TOPIC, ROSTER_REQUEST_TOPIC,
+                RECORD_ATTENDANCE_TOPIC, ROSTER_ATTENDANCE_PREFIX + "+")
+
+ROSTER_CACHE_SIZE = 256 # Rosters kept for the uploads of recently started lectures
+STUDENT_LOOKUP_CHUNK = 500 # Keys per IN (...), well under SQLite's host-parameter limit
+
+# How a JSON attendance update may name its student, most precise first. Names are
+# only for firmware that sends nothing else, and only count when they are unambiguous.
+STUDENT_KEYS = ("id", "sch_id", "name")
+
+LEGACY_RESPONSE_TOPIC = "esp32/response/{name}" # Shared by every terminal; only for firmware without a device_id
+
+
+def response_topic(payload: dict, properties: dict, name: str) -> tuple[str, dict]:
+    """
+    Picks where a reply goes: the MQTT 5 response topic (echoing its
+    correlation data) if the request carried one, otherwise the requesting
+    device's own topic esp32/response/<device_id>/<name>.
+    """
+    if properties.get("response_topic"):
+        reply_properties = {}
+        if properties.get("correlation_data"):
+            reply_properties["correlation_data"] = properties["correlation_data"][0]
+        return properties["response_topic"][0], reply_properties
+    device_id = payload.get("device_id")
+    if device_id:
+        return f"esp32/response/{device_id}/{name}", {}
+    return LEGACY_RESPONSE_TOPIC.format(name=name), {}
+
+
+def _facet(value):
+    """Empty facets mean "any"; levels arrive as numbers or numeric strings."""
+    if value in (None, ""):
+        return None
+    return int(value) if isinstance(value, str) and value.isdigit() else value
+
+
+def _find_session(conn: sqlite3.Connection, course_code: str, session_id: int | None):
+    if session_id is not None:
+        return session_id
+    row = conn.execute("""
+        SELECT id FROM lecture_sessions WHERE course_code = ?
+        ORDER BY session_date DESC LIMIT 1;""", (course_code,)).fetchone()
+    return row["id"] if row else None
+
+
+def _student_key(update: dict) -> tuple[str, object] | None:
+    """The most precise (key, value) an update names its student by, in the form the students table stores."""
+    for key in STUDENT_KEYS:
+        value = update.get(key)
+        if value in (None, ""):
+            continue
+        if key == "id":
+            return (key, int(value)) if str(value).isdigit() else None
+        return key, str(value)
+    return None
+
+def _resolve_students(conn: sqlite3.Connection, course_code: str, keys: set[tuple[str, object]]) -> dict[tuple, set[int]]:
+    """
+    The students each (key, value) matches. Names are matched among the
+    course's registered students when it has any, so namesakes elsewhere in
+    the school don't make them ambiguous.
+    """
+    matches: dict[tuple, set[int]] = {key: set() for key in keys}
+    registered = conn.execute("SELECT 1 FROM course_registrations WHERE course_code = ? LIMIT 1;", (course_code,)).fetchone()
+    for column in STUDENT_KEYS:
+        values = [value for key, value in keys if key == column]
+        where = ""
+        if column == "name" and registered:
+            where = " AND id IN (SELECT student_id FROM course_registrations WHERE course_code = ?)"
+        for i in range(0, len(values), STUDENT_LOOKUP_CHUNK):
+            chunk = values[i:i + STUDENT_LOOKUP_CHUNK]
+            rows = conn.execute(
+                f"SELECT id, {column} AS value FROM students WHERE {column} IN ({', '.join('?' * len(chunk))}){where};",
+                chunk + ([course_code] if where else []))
+            for row in rows:
+                matches.setdefault((column, row["value"]), set()).add(row["id"])
+    return matches
+
+
+async def _record_attendance(payload: dict):
+    """
+    Persists an end-of-lecture attendance list through the ingestion pipeline,
+    against the session named in the payload or the course's latest session.
+    Each student is named by "id" or "sch_id"; a "name" alone is used only
+    when exactly one student has it, and is skipped as ambiguous otherwise.
+    Only "students" is stored: anything else in "updates", such as the
+    lecturer's own attendance, has no table and is logged as ignored.
+    """
+    course_code = payload["course_code"]
+    updates = payload["updates"]
+    ignored = sorted(set(updates) - {"students"})
+    if ignored:
+        log.warning("Attendance upload for %s: ignored %s; only students' attendance is stored", course_code, ", ".join(ignored))
+    session_id = await db.read(_find_session, course_code, payload.get("session_id"))
+    if session_id is None:
+        log.warning("No lecture session for %s; attendance upload dropped", course_code)
+        return
+    students = [(update, _student_key(update)) for update in updates.get("students", [])]
+    keys = {key for _, key in students if key is not None}
+    matches = await db.read(_resolve_students, course_code, keys) if keys else {}
+    now = datetime.now()
+    ingestor = get_ingestor()
+    for update, key in students:
+        found = matches.get(key, ())
+        if len(found) != 1:
+            log.warning("%s student %r in attendance for %s", "Ambiguous" if found else "Unknown", key, course_code)
+            continue
+        await ingestor.submit(StudentAttendanceRecordBase(
+            session_id=session_id, student_id=next(iter(found)), attendance_time=now, attended=update["attended"]))
+
+
+_rosters: collections.OrderedDict[int, Roster] = collections.OrderedDict()
+
+
+async def _get_roster(session_id: int, version: int | None = None) -> Roster | None:
+    """The session's roster, reloaded if the cached one isn't the requested version."""
+    context = session_contexts.get(session_id)
+    if context is not None and version in (None, context.roster.version):
+        return context.roster
+    roster = _rosters.get(session_id)
+    if roster is None or (version is not None and roster.version != version):
+        roster = await db.read(load_roster, session_id)
+        if roster is None:
+            return None
+        _rosters[session_id] = roster
+        while len(_rosters) > ROSTER_CACHE_SIZE:
+            _rosters.popitem(last=False)
+    _rosters.move_to_end(session_id)
+    return roster
+
+
+async def _record_roster_attendance(client, topic: str, payload: bytes, properties: dict):
+    """
+    Applies a bitmap or run-length upload against the roster it was made for,
+    in one write. A terminal whose roster is out of date is told so, and
+    re-requests the roster or falls back to the JSON upload.
+    """
+    device_id = topic[len(ROSTER_ATTENDANCE_PREFIX):]
+    reply_topic, reply_properties = response_topic({"device_id": device_id}, properties, "attendance_ack")
+    encoding, session_id, version, size, body = unpack_upload(payload)
+    roster = await _get_roster(session_id, version)
+    if roster is None or roster.version != version:
+        ack = {"session_id": session_id, "error": "unknown_session" if roster is None else "stale_roster"}
+    else:
+        present = decode_upload(roster, encoding, size, body)
+        count = await db.write(apply_attendance, roster, present, datetime.now())
+        context = session_contexts.get(session_id)
+        if context is not None:
+            context.marked.update(roster.student_ids[i] for i in present)
+        ack = {"session_id": session_id, "present": count, "absent": len(roster) - count}
+    client.publish(reply_topic, fast_json.dumps(ack), qos=0, **reply_properties)
+
+
+def publish_roster(client, roster: Roster | None, session_id: int, request: dict, properties: dict):
+    """Sends a terminal the ordered roster its attendance upload will refer to."""
+    body = fast_json.dumps(roster.to_message() if roster is not None else {"session_id": session_id, "error": "unknown_session"})
+    reply_topic, reply_properties = response_topic(request, properties, "roster")
+    client.publish(reply_topic, body, qos=0, **reply_properties)
+
+
+async def handle_esp32_message(client, topic: str, payload: bytes, properties: dict):
+    """Serves the request/record topics the classroom terminals publish on."""
+    if topic.startswith(ROSTER_ATTENDANCE_PREFIX):
+        try:
+            await _record_roster_attendance(client, topic, payload, properties)
+        except RosterError as e:
+            log.warning("Rejected roster upload on %s: %s", topic, e)
+        return
+
+    request = json.loads(payload)
+
+    if topic in (COURSE_CODES_REQUEST_TOPIC, ATTENDANCE_INFO_REQUEST_TOPIC):
+        if course_catalog.is_stale:
+            await db.read(course_catalog.ensure_fresh)
+        if topic == COURSE_CODES_REQUEST_TOPIC:
+            name = "course_codes"
+            body = course_catalog.course_codes_response(*(_facet(request.get(k)) for k in ("level", "faculty", "dept")))
+        else:
+            name = "attendance_info"
+            body = course_catalog.attendance_info_response(request["course_code"])
+        reply_topic, reply_properties = response_topic(request, properties, name)
+        client.publish(reply_topic, body, qos=0, **reply_properties)
+
+    elif topic == ROSTER_REQUEST_TOPIC:
+        session_id = int(request["session_id"])
+        publish_roster(client, await _get_roster(session_id), session_id, request, properties)
+
+    elif topic == RECORD_ATTENDANCE_TOPIC:
+        await _record_attendance(request)
@@ -0,0 +1,91 @@
+# fake_terminal.py (Pseudo-terminal ESP32 enrollment reader for development)
+import argparse
+import os
+import pty
+import threading
+import time
+import tty
+
+REPLY_UID = "uid" # Answers like a reader whose card was tapped
+REPLY_SILENT = "silent" # Acknowledges the command, then no card is ever presented
+REPLY_GARBLED = "garbled" # Line noise, then a UID line that isn't one
+REPLIES = (REPLY_UID, REPLY_SILENT, REPLY_GARBLED)
+
+
+class FakeTerminal:
+    """
+    Emulates an enrollment ESP32 on a pseudo-terminal. Open `port` exactly like
+    a real /dev/ttyUSB device: it answers "ENROLL:<user_id>:<user_name>" with
+    the same progress lines and "UID:<uid>" reply that serial_enroll2.py expects,
+    or misbehaves as `reply` says.
+    """
+    def __init__(self, tap_delay: float = 0.5, uid_prefix: str = "FAKE", reply: str = REPLY_UID):
+        self.tap_delay = tap_delay
+        self.uid_prefix = uid_prefix
+        self.reply = reply
+        self.enrolled = 0
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        self.port = os.ttyname(self._slave)
+        self._thread = threading.Thread(target=self._serve, name=f"fake-terminal-{self.port}", daemon=True)
+        self._running = False
+
+    def start(self) -> "FakeTerminal":
+        self._running = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _write(self, line: str | bytes):
+        os.write(self._master, (line if isinstance(line, bytes) else line.encode()) + b"\n")
+
+    def _serve(self):
+        buffer = b""
+        while self._running:
+            try:
+                data = os.read(self._master, 1024)
+            except OSError:
+                return
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                self._handle(line.decode(errors="replace").strip())
+
+    def _handle(self, command: str):
+        if not command.startswith("ENROLL:"):
+            self._write(f"ESP32: Unknown command {command}")
+            return
+        _, user_id, _ = command.split(":", 2)
+        self._write(f"ESP32: Received enrollment command for User ID: {user_id}")
+        self._write("ESP32: Waiting for card...")
+        if self.reply == REPLY_SILENT:
+            return
+        time.sleep(self.tap_delay)
+        if self.reply == REPLY_GARBLED:
+            self._write(b"\xfe\x9c\x00ESP\xff32")
+            self._write(b"UID:\xa4\x11 3F")
+            return
+        self.enrolled += 1
+        self._write(f"UID:{self.uid_prefix}{self.enrolled:04d}{int(time.time()) % 10000:04d}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run fake enrollment terminals on pseudo-terminals.")
+    parser.add_argument("--count", type=int, default=1, help="Number of terminals")
+    parser.add_argument("--delay", type=float, default=0.5, help="Seconds between command and simulated card tap")
+    parser.add_argument("--reply", choices=REPLIES, default=REPLY_UID, help="How the terminals answer an enrollment")
+    args = parser.parse_args()
+
+    terminals = [FakeTerminal(args.delay, uid_prefix=f"FAKE{i}_", reply=args.reply).start() for i in range(args.count)]
+    print("Fake terminals ready. Start the server with:")
+    print(f"  ENROLL_SERIAL_PORTS={','.join(t.port for t in terminals)} uvicorn app:app")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for t in terminals:
+            t.stop()
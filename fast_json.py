@@ -0,0 +1,14 @@
+# fast_json.py
+import json
+
+try:
+    import orjson # Optional: several times faster than the stdlib encoder
+except ImportError:
+    orjson = None
+
+
+def dumps(obj) -> bytes:
+    """Serializes obj to compact UTF-8 JSON bytes, using orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=str).encode()
@@ -0,0 +1,308 @@
+# fleet_sim.py (Virtual ESP32 fleet for load-testing the edge server)
+import argparse
+import asyncio
+import json
+import random
+import struct
+import time
+from datetime import datetime
+from fake_terminal import FakeTerminal
+from enrollment_manager import EnrollmentManager, SerialTerminal
+from roster import pack_upload, ENCODING_BITMAP, ENCODING_RUNS
+from mini_broker import (
+    MiniBroker, CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK, DISCONNECT,
+    packet, encode_str, encode_publish, decode_publish, read_packet,
+)
+
+
+def percentiles(values: list[float]) -> dict:
+    """p50/p95/p99/max of a list of seconds, in milliseconds."""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {"count": len(ordered), "p50": round(pick(0.50), 2), "p95": round(pick(0.95), 2),
+            "p99": round(pick(0.99), 2), "max": round(ordered[-1] * 1000, 2)}
+
+
+class SimClient:
+    """Minimal MQTT 3.1.1 client, roughly what PubSubClient on an ESP32 does."""
+    def __init__(self, client_id: str):
+        self.client_id = client_id
+        self.on_message = lambda topic, payload: None
+        self._next_id = 0
+        self._acks: dict[int, asyncio.Future] = {}
+        self._connected: asyncio.Future | None = None
+        self._reader_task: asyncio.Task | None = None
+
+    async def connect(self, host: str, port: int, keepalive: int = 60):
+        self._reader, self._writer = await asyncio.open_connection(host, port)
+        self._connected = asyncio.get_running_loop().create_future()
+        self._reader_task = asyncio.create_task(self._read_loop())
+        body = encode_str("MQTT") + bytes([4, 0x02]) + struct.pack("!H", keepalive) + encode_str(self.client_id)
+        self._writer.write(packet(CONNECT, body))
+        await self._connected
+
+    async def _read_loop(self):
+        try:
+            while True:
+                kind, flags, body = await read_packet(self._reader)
+                if kind == CONNACK:
+                    self._connected.set_result(True)
+                elif kind in (PUBACK, SUBACK):
+                    (packet_id,) = struct.unpack_from("!H", body)
+                    future = self._acks.pop(packet_id, None)
+                    if future and not future.done():
+                        future.set_result(None)
+                elif kind == PUBLISH:
+                    topic, payload, qos, packet_id, _ = decode_publish(flags, body, 4)
+                    if qos:
+                        self._writer.write(packet(PUBACK, struct.pack("!H", packet_id)))
+                    self.on_message(topic, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    def _track(self) -> tuple[int, asyncio.Future]:
+        self._next_id = self._next_id % 65535 + 1
+        future = asyncio.get_running_loop().create_future()
+        self._acks[self._next_id] = future
+        return self._next_id, future
+
+    async def subscribe(self, topic_filter: str, qos: int = 1):
+        packet_id, future = self._track()
+        self._writer.write(packet(SUBSCRIBE, struct.pack("!H", packet_id) + encode_str(topic_filter) + bytes([qos]), flags=0x02))
+        await future
+
+    async def publish(self, topic: str, payload: dict | bytes, qos: int = 0):
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        if not qos:
+            self._writer.write(encode_publish(topic, data))
+            await self._writer.drain()
+            return
+        packet_id, future = self._track()
+        self._writer.write(encode_publish(topic, data, qos, packet_id))
+        await future
+
+    async def disconnect(self):
+        self._writer.write(packet(DISCONNECT, b""))
+        await self._writer.drain()
+        self._writer.close()
+        if self._reader_task:
+            self._reader_task.cancel()
+
+
+class FleetStats:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.timeouts: dict[str, int] = {}
+        self.taps = 0
+        self.upload_bytes: list[int] = []
+        self.first_tap: float | None = None
+        self.last_tap: float | None = None
+
+    def add(self, name: str, seconds: float):
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def timeout(self, name: str):
+        self.timeouts[name] = self.timeouts.get(name, 0) + 1
+
+
+class VirtualTerminal:
+    """
+    One classroom ESP32: boots and asks for its course codes and attendance
+    info, opens a lecture session, streams card taps, then uploads the
+    end-of-lecture attendance summary.
+    """
+    def __init__(self, index: int, args: argparse.Namespace, stats: FleetStats):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.device_id = f"sim-esp32-{index:04d}"
+        self.session_id = args.session_base + index
+        self.client = SimClient(self.device_id)
+        self._waiting: dict[str, asyncio.Future] = {}
+        self.client.on_message = self._on_message
+
+    def _on_message(self, topic: str, payload: bytes):
+        future = self._waiting.pop(topic, None)
+        if future and not future.done():
+            future.set_result(payload)
+
+    async def _request(self, name: str, payload: dict | bytes, request_topic: str | None = None,
+                       reply_name: str | None = None) -> bytes | None:
+        # Replies come back on this terminal's own topic, not a shared one
+        request_topic = request_topic or f"esp32/request/{name}"
+        response_topic = f"esp32/response/{self.device_id}/{reply_name or name}"
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[response_topic] = future
+        started = time.perf_counter()
+        if isinstance(payload, dict):
+            payload = {**payload, "device_id": self.device_id}
+        await self.client.publish(request_topic, payload)
+        try:
+            reply = await asyncio.wait_for(future, self.args.response_timeout)
+            self.stats.add(f"{name}_rtt", time.perf_counter() - started)
+            return reply
+        except asyncio.TimeoutError:
+            self._waiting.pop(response_topic, None)
+            self.stats.timeout(f"{name}_rtt")
+            return None
+
+    async def _upload_attendance(self, course_code: str):
+        """End-of-lecture summary, as a roster bitmap/runs upload or the legacy JSON list."""
+        if self.args.upload != "json":
+            reply = await self._request("roster", {"session_id": self.session_id})
+            message = json.loads(reply) if reply else {}
+            if "uids" in message:
+                size = len(message["uids"])
+                present = [i for i in range(size) if random.random() < self.args.attendance]
+                encoding = ENCODING_RUNS if self.args.upload == "runs" else ENCODING_BITMAP
+                upload = pack_upload(self.session_id, message["version"], size, present, encoding)
+                self.stats.upload_bytes.append(len(upload))
+                await self._request("roster_upload", upload, f"esp32/record/roster_attendance/{self.device_id}", "attendance_ack")
+                return
+        payload = {
+            "course_code": course_code,
+            "updates": {"lecturer": True, "students": [
+                {"id": random.randint(1, self.args.students), "attended": True} for _ in range(5)]},
+        }
+        self.stats.upload_bytes.append(len(json.dumps(payload)))
+        await self.client.publish("esp32/record/attendance", payload, qos=1)
+
+    def _tap_interval(self) -> float:
+        pattern, rate = self.args.pattern, self.args.rate
+        if pattern == "burst":
+            return 0.0
+        if pattern == "poisson":
+            return random.expovariate(rate)
+        return 1.0 / rate
+
+    async def run(self, host: str, port: int):
+        await asyncio.sleep(random.uniform(0, self.args.ramp))
+        await self.client.connect(host, port)
+        await self.client.subscribe(f"esp32/response/{self.device_id}/#")
+        course_code = f"CSC{100 + self.index % self.args.courses}"
+        await self._request("course_codes", {"level": 100, "faculty": "SEET", "dept": "CSC"})
+        await self._request("attendance_info", {"course_code": course_code})
+
+        await self.client.publish("cs/lecture/session", {
+            "id": self.session_id, "course_code": course_code, "device_id": self.device_id,
+            "lecturer_id": 1 + self.index % self.args.lecturers, "session_date": datetime.now().isoformat(),
+        }, qos=1)
+
+        for _ in range(self.args.taps):
+            await asyncio.sleep(self._tap_interval())
+            started = time.perf_counter()
+            self.stats.first_tap = self.stats.first_tap or started
+            await self.client.publish("cs/attendance", {
+                "session_id": self.session_id,
+                "student_id": random.randint(1, self.args.students),
+                "attendance_time": datetime.now().isoformat(),
+            }, qos=1)
+            self.stats.last_tap = time.perf_counter()
+            self.stats.add("tap_broker_ack", self.stats.last_tap - started)
+            self.stats.taps += 1
+
+        await self._upload_attendance(course_code)
+        await self.client.disconnect()
+
+
+async def run_enrollments(args: argparse.Namespace, stats: FleetStats):
+    """Drives the real enrollment manager against pty-backed fake ESP32 readers."""
+    fakes = [FakeTerminal(args.enroll_tap_delay, uid_prefix=f"SIM{i}_").start() for i in range(args.enroll_terminals)]
+    manager = EnrollmentManager([SerialTerminal(f.port, reset_delay=0) for f in fakes])
+    await manager.start()
+
+    async def notify(stage, details, extra):
+        pass
+
+    async def one(i: int):
+        started = time.perf_counter()
+        uid = await manager.enroll(f"sim_enroll_{i}", f"user{i}", f"SIM{i:05d}", notify)
+        if uid:
+            stats.add("enrollment", time.perf_counter() - started)
+        else:
+            stats.timeout("enrollment")
+
+    await asyncio.gather(*(one(i) for i in range(args.enrollments)))
+    await manager.stop()
+    for fake in fakes:
+        fake.stop()
+
+
+async def main(args: argparse.Namespace) -> dict:
+    broker = None
+    if args.broker:
+        host, _, port = args.broker.partition(":")
+        port = int(port or 1883)
+    else:
+        broker = await MiniBroker("127.0.0.1", args.port).start()
+        host, port = "127.0.0.1", broker.port
+        print(f"Fleet: broker stand-in on {host}:{port}; point the edge server at it and press Enter...")
+        if not args.no_wait:
+            await asyncio.get_running_loop().run_in_executor(None, input)
+
+    stats = FleetStats()
+    started = time.perf_counter()
+    terminals = [VirtualTerminal(i, args, stats) for i in range(args.terminals)]
+    jobs = [t.run(host, port) for t in terminals]
+    if args.enrollments:
+        jobs.append(run_enrollments(args, stats))
+    await asyncio.gather(*jobs)
+    await asyncio.sleep(args.settle) # Let the server acknowledge the tail of the burst
+    elapsed = time.perf_counter() - started
+
+    report = {
+        "terminals": args.terminals,
+        "pattern": args.pattern,
+        "duration_s": round(elapsed, 3),
+        "taps_published": stats.taps,
+        "throughput": {},
+        "latency_ms": {name: percentiles(values) for name, values in stats.latencies.items()},
+        "timeouts": stats.timeouts,
+        "upload_bytes_avg": round(sum(stats.upload_bytes) / len(stats.upload_bytes), 1) if stats.upload_bytes else 0,
+    }
+    if stats.first_tap and stats.last_tap > stats.first_tap:
+        report["throughput"]["taps_per_s_published"] = round(stats.taps / (stats.last_tap - stats.first_tap), 1)
+    if broker:
+        # End to end: the server's PUBACK is only sent once the tap is queued for the database
+        for topic, values in broker.delivery_latencies.items():
+            report["latency_ms"][f"server_ack:{topic}"] = percentiles(values)
+        acked = len(broker.delivery_latencies.get("cs/attendance", []))
+        report["throughput"]["taps_server_acked"] = acked
+        if stats.first_tap and acked:
+            report["throughput"]["taps_per_s_server_acked"] = round(acked / (time.perf_counter() - stats.first_tap - args.settle), 1)
+        await broker.stop()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a fleet of classroom ESP32 terminals.")
+    parser.add_argument("--terminals", type=int, default=100, help="Virtual MQTT terminals")
+    parser.add_argument("--taps", type=int, default=50, help="Card taps per terminal")
+    parser.add_argument("--rate", type=float, default=2.0, help="Taps per second per terminal")
+    parser.add_argument("--pattern", choices=("uniform", "poisson", "burst"), default="poisson")
+    parser.add_argument("--ramp", type=float, default=0.0, help="Spread terminal start-up over this many seconds (0 = all at 8:00 sharp)")
+    parser.add_argument("--students", type=int, default=5000, help="Student ids taps are drawn from")
+    parser.add_argument("--courses", type=int, default=40)
+    parser.add_argument("--lecturers", type=int, default=20)
+    parser.add_argument("--session-base", type=int, default=900000, help="First lecture session id")
+    parser.add_argument("--upload", choices=("bitmap", "runs", "json"), default="bitmap", help="End-of-lecture attendance format")
+    parser.add_argument("--attendance", type=float, default=0.8, help="Share of the roster marked present in uploads")
+    parser.add_argument("--response-timeout", type=float, default=5.0)
+    parser.add_argument("--enroll-terminals", type=int, default=2, help="pty-backed enrollment readers")
+    parser.add_argument("--enrollments", type=int, default=0, help="Concurrent enrollment requests")
+    parser.add_argument("--enroll-tap-delay", type=float, default=0.05, help="Seconds before the simulated card tap")
+    parser.add_argument("--broker", help="host[:port] of an existing broker instead of the embedded stand-in")
+    parser.add_argument("--port", type=int, default=1883, help="Port for the embedded broker stand-in")
+    parser.add_argument("--no-wait", action="store_true", help="Start immediately instead of waiting for Enter")
+    parser.add_argument("--settle", type=float, default=1.0, help="Seconds to wait for server acks after the last tap")
+    parser.add_argument("--out", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
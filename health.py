@@ -0,0 +1,109 @@
+# health.py (Subsystem states behind /healthz and /readyz)
+import asyncio
+import json
+import time
+
+STARTING = "starting"
+READY = "ready"
+DEGRADED = "degraded" # Was ready and is recovering by itself, e.g. MQTT reconnecting
+FAILED = "failed" # Will not recover without an operator
+
+STARTUP_GATE_TIMEOUT_S = 10 # How long a request may wait for startup before getting a 503
+GATE_EXEMPT_PATHS = frozenset({"/", "/healthz", "/readyz", "/metrics"})
+
+
+class Subsystem:
+    def __init__(self, name: str, required: bool):
+        self.name = name
+        self.required = required # Whether requests must wait for it
+        self.state = STARTING
+        self.detail = ""
+        self.changed_at = time.time()
+        self._settled = asyncio.Event() # Set once ready or failed
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "required": self.required,
+            "detail": self.detail,
+            "since": round(self.changed_at, 3),
+        }
+
+
+class Health:
+    """
+    Tracks what each subsystem is doing while the server starts and runs.
+    Subsystems start in the background, so HTTP is served from the first
+    moment; requests that need the database wait for it behind ReadinessGate.
+    """
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self._subsystems: dict[str, Subsystem] = {}
+
+    def register(self, name: str, required: bool = True) -> Subsystem:
+        subsystem = self._subsystems[name] = Subsystem(name, required)
+        return subsystem
+
+    def unregister(self, name: str):
+        self._subsystems.pop(name, None)
+
+    def set(self, name: str, state: str, detail: str = ""):
+        subsystem = self._subsystems.get(name) or self.register(name, required=False)
+        if subsystem.state != state or subsystem.detail != detail:
+            subsystem.state, subsystem.detail, subsystem.changed_at = state, detail, time.time()
+        if state in (READY, FAILED):
+            subsystem._settled.set()
+
+    def state(self, name: str) -> str | None:
+        subsystem = self._subsystems.get(name)
+        return subsystem.state if subsystem else None
+
+    @property
+    def ready(self) -> bool:
+        """True once every required subsystem is ready; subsystems never registered don't count."""
+        return all(s.state == READY for s in self._subsystems.values() if s.required)
+
+    async def wait_ready(self, timeout: float) -> bool:
+        """Waits until every required subsystem is ready or has failed."""
+        pending = [s._settled.wait() for s in self._subsystems.values() if s.required and not s._settled.is_set()]
+        if pending:
+            try:
+                await asyncio.wait_for(asyncio.gather(*pending), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.ready
+
+    def snapshot(self) -> dict:
+        return {
+            "ready": self.ready,
+            "uptime_seconds": round(time.monotonic() - self.started_at, 3),
+            "subsystems": {name: s.snapshot() for name, s in self._subsystems.items()},
+        }
+
+
+health = Health()
+
+
+class ReadinessGate:
+    """
+    ASGI middleware holding HTTP requests until the required subsystems are
+    ready, then answering 503 if startup still hasn't finished. Probes, the
+    metrics scrape and the root page are always served.
+    """
+    def __init__(self, app, health: Health = health, timeout: float = STARTUP_GATE_TIMEOUT_S):
+        self.app = app
+        self.health = health
+        self.timeout = timeout
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or scope["path"] in GATE_EXEMPT_PATHS
+                or self.health.ready or await self.health.wait_ready(self.timeout)):
+            return await self.app(scope, receive, send)
+        body = json.dumps({"detail": "Server is starting up", **self.health.snapshot()}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [(b"content-type", b"application/json"), (b"retry-after", b"1"),
+                        (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
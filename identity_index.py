@@ -0,0 +1,154 @@
+# identity_index.py
+import json
+import sqlite3
+import sys
+from database import Database
+from log import get_logger
+
+log = get_logger("identity")
+
+STUDENT = "student"
+LECTURER = "lecturer"
+CARD_TABLES = ((STUDENT, "students"), (LECTURER, "lecturers"))
+
+
+class Identity:
+    """Who a card belongs to. Slotted so a 50k-card index stays a few MiB."""
+    __slots__ = ("kind", "id")
+
+    def __init__(self, kind: str, id: int):
+        self.kind = kind
+        self.id = id
+
+    def __repr__(self):
+        return f"Identity({self.kind}, {self.id})"
+
+
+class IdentityIndex:
+    """
+    In-memory rfid_uid -> Identity map, built once from the students and
+    lecturers tables and then kept current by every write that touches a card,
+    so resolving a tap never queries SQLite.
+    """
+    def __init__(self):
+        self._by_uid: dict[str, Identity] = {}
+        # Reverse maps (id -> uid) so a changed or deleted card can be unlinked
+        self._uid_of: dict[str, dict[int, str]] = {STUDENT: {}, LECTURER: {}}
+        self.version = 0 # sync_sequence value the index reflects
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._by_uid)
+
+    async def load(self, db: Database):
+        def _read(conn: sqlite3.Connection):
+            conn.execute("BEGIN;") # The rows and the sequence from one snapshot
+            try:
+                version = conn.execute("SELECT value FROM sync_sequence;").fetchone()[0]
+                students = conn.execute("SELECT id, rfid_uid FROM students WHERE rfid_uid IS NOT NULL;").fetchall()
+                lecturers = conn.execute("SELECT id, rfid_uid FROM lecturers WHERE rfid_uid IS NOT NULL;").fetchall()
+            finally:
+                conn.execute("COMMIT;")
+            return version, students, lecturers
+
+        version, students, lecturers = await db.read(_read)
+        self._by_uid.clear()
+        for owners in self._uid_of.values():
+            owners.clear()
+        for kind, rows in ((STUDENT, students), (LECTURER, lecturers)):
+            for row in rows:
+                self.put(kind, row["id"], row["rfid_uid"])
+        self.version = version
+        log.info("Loaded %d cards", len(self._by_uid))
+
+    async def catch_up(self, db: Database) -> int:
+        """
+        Applies card changes committed since the last load or catch_up, found
+        by change_seq, including those made by other worker processes. Returns
+        how many changes were applied.
+        """
+        version, rows = await db.read(_read_card_changes, self.version)
+        for _, kind, id, uid in rows:
+            self.put(kind, id, uid)
+        self.version = version
+        return len(rows)
+
+    def resolve(self, uid: str) -> Identity | None:
+        identity = self._by_uid.get(uid)
+        if identity is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return identity
+
+    def put(self, kind: str, id: int, uid: str | None):
+        """Records that `id` of `kind` now holds card `uid` (None unlinks its card)."""
+        owners = self._uid_of[kind]
+        old_uid = owners.pop(id, None)
+        if old_uid is not None and old_uid != uid:
+            self._by_uid.pop(old_uid, None)
+        if uid is None:
+            return
+        uid = sys.intern(uid)
+        previous = self._by_uid.get(uid)
+        if previous is not None and (previous.kind, previous.id) != (kind, id):
+            self._uid_of[previous.kind].pop(previous.id, None)
+        self._by_uid[uid] = Identity(kind, id)
+        owners[id] = uid
+
+    def remove(self, kind: str, id: int):
+        self.put(kind, id, None)
+
+    def clear(self, kind: str):
+        for uid in self._uid_of[kind].values():
+            self._by_uid.pop(uid, None)
+        self._uid_of[kind].clear()
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "cards": len(self._by_uid),
+            "students": len(self._uid_of[STUDENT]),
+            "lecturers": len(self._uid_of[LECTURER]),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+identity_index = IdentityIndex()
+
+
+def _read_card_changes(conn: sqlite3.Connection, since: int) -> tuple[int, list]:
+    """(sequence now, [(change_seq, kind, id, uid or None for a delete)] in change order) after `since`."""
+    conn.execute("BEGIN;")
+    try:
+        version = conn.execute("SELECT value FROM sync_sequence;").fetchone()[0]
+        rows = []
+        for kind, table in CARD_TABLES:
+            rows += [(r["change_seq"], kind, r["id"], r["rfid_uid"]) for r in conn.execute(
+                f"SELECT id, rfid_uid, change_seq FROM {table} WHERE change_seq > ?;", (since,))]
+            rows += [(r["change_seq"], kind, json.loads(r["row_key"])["id"], None) for r in conn.execute(
+                "SELECT change_seq, row_key FROM sync_tombstones WHERE entity = ? AND change_seq > ?;", (table, since))]
+    finally:
+        conn.execute("COMMIT;")
+    rows.sort(key=lambda r: r[0])
+    return version, rows
+
+def _assign_card(conn: sqlite3.Connection, sch_id: str, uid: str) -> Identity | None:
+    for kind, table in CARD_TABLES:
+        row = conn.execute(f"UPDATE {table} SET rfid_uid = ? WHERE sch_id = ? RETURNING id;", (uid, sch_id)).fetchone()
+        if row is not None:
+            return Identity(kind, row["id"])
+    return None
+
+async def assign_enrolled_card(db: Database, sch_id: str, uid: str) -> Identity | None:
+    """
+    Stores a freshly enrolled card against the student or lecturer with this
+    school id and updates the index. Returns None if nobody has that sch_id yet.
+    """
+    identity = await db.write(_assign_card, sch_id, uid)
+    if identity is not None:
+        identity_index.put(identity.kind, identity.id, uid)
+    return identity
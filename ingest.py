@@ -0,0 +1,223 @@
+# ingest.py
+import asyncio
+import sqlite3
+import time
+from typing import Union
+from database import Database, db as default_db
+from models import LectureSessionBase, StudentAttendanceRecordBase
+from log import get_logger
+
+log = get_logger("ingest")
+
+INGEST_QUEUE_SIZE = 10000 # Records buffered before producers are made to wait
+INGEST_BATCH_SIZE = 500 # Commit after this many records...
+INGEST_FLUSH_INTERVAL_MS = 50 # ...or after this long, whichever comes first
+INGEST_REPORT_INTERVAL_S = 30 # How often throughput is reported while busy
+INGEST_RETRY_MIN_S = 0.1 # Backoff before retrying a failed commit...
+INGEST_RETRY_MAX_S = 5.0 # ...doubling up to this
+INGEST_STOP_TIMEOUT_S = 30 # How long stop() waits for the queue to be written
+
+# Errors about the records themselves; a batch failing with one is split to find the record.
+# Anything else (locked, disk I/O, disk full) is the database's and is retried.
+REJECTED_RECORD_ERRORS = (sqlite3.IntegrityError, sqlite3.DataError, sqlite3.ProgrammingError, sqlite3.InterfaceError)
+
+IngestRecord = Union[LectureSessionBase, StudentAttendanceRecordBase]
+
+# Both inserts are no-ops on a duplicate key, so QoS 1 redeliveries are harmless.
+# The one exception is a tap for a student already recorded absent, which marks them present.
+INSERT_SESSION_SQL = """
+    INSERT INTO lecture_sessions (id, course_code, lecturer_id, session_date) VALUES (?, ?, ?, ?)
+    ON CONFLICT(id) DO NOTHING;"""
+INSERT_ATTENDANCE_SQL = """
+    INSERT INTO attendance_records (session_id, student_id, attendance_time, attended) VALUES (?, ?, ?, ?)
+    ON CONFLICT(session_id, student_id) DO UPDATE SET attended = 1, attendance_time = excluded.attendance_time
+    WHERE excluded.attended AND NOT attendance_records.attended;"""
+
+
+class IngestStats:
+    """Counters describing how the ingestion pipeline is keeping up."""
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.received = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.commits = 0
+        self.retries = 0
+        self.rejected = 0
+        self.commit_seconds_total = 0.0
+        self.commit_seconds_max = 0.0
+        self.last_commit_seconds = 0.0
+        self._window_start = self.started_at
+        self._window_received = 0
+        self.messages_per_second = 0.0
+
+    def record_commit(self, batch_size: int, inserted: int, seconds: float):
+        self.inserted += inserted
+        self.duplicates += batch_size - inserted
+        self.commits += 1
+        self.commit_seconds_total += seconds
+        self.last_commit_seconds = seconds
+        self.commit_seconds_max = max(self.commit_seconds_max, seconds)
+
+    def roll_window(self) -> float:
+        """Closes the current rate window and returns its messages/sec."""
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed > 0:
+            self.messages_per_second = (self.received - self._window_received) / elapsed
+        self._window_start = now
+        self._window_received = self.received
+        return self.messages_per_second
+
+    def snapshot(self) -> dict:
+        avg = self.commit_seconds_total / self.commits if self.commits else 0.0
+        uptime = time.monotonic() - self.started_at
+        return {
+            "received": self.received,
+            "inserted": self.inserted,
+            "duplicates": self.duplicates,
+            "commits": self.commits,
+            "retries": self.retries,
+            "rejected": self.rejected,
+            "messages_per_second": round(self.messages_per_second, 1),
+            "avg_messages_per_second": round(self.received / uptime, 1) if uptime > 0 else 0.0,
+            "commit_latency_ms": {
+                "last": round(self.last_commit_seconds * 1000, 2),
+                "avg": round(avg * 1000, 2),
+                "max": round(self.commit_seconds_max * 1000, 2),
+            },
+        }
+
+
+def _write_batch(conn: sqlite3.Connection, sessions: list, attendance: list) -> int:
+    """Inserts one batch in a single transaction, returning the number of new rows."""
+    inserted = 0
+    if sessions:
+        inserted += conn.executemany(INSERT_SESSION_SQL, sessions).rowcount
+    if attendance:
+        inserted += conn.executemany(INSERT_ATTENDANCE_SQL, attendance).rowcount
+    return inserted
+
+
+class AttendanceIngestor:
+    """
+    Group-commit pipeline for lecture sessions and attendance taps.
+
+    Producers await submit(), which blocks once the bounded queue is full so a
+    burst of taps slows the MQTT client down instead of growing memory. A single
+    writer task drains the queue and commits every INGEST_BATCH_SIZE records or
+    INGEST_FLUSH_INTERVAL_MS milliseconds, whichever comes first.
+
+    A record is acknowledged to the broker once it is queued, so a batch that
+    fails to commit is the only copy: it is retried with backoff until the
+    database takes it, while the full queue holds the broker back. A record
+    the database refuses outright is found by splitting the batch, and only
+    it is dropped.
+    """
+    def __init__(self, db: Database = default_db, queue_size: int = INGEST_QUEUE_SIZE,
+                 batch_size: int = INGEST_BATCH_SIZE, flush_interval_ms: int = INGEST_FLUSH_INTERVAL_MS):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.queue: asyncio.Queue[IngestRecord] = asyncio.Queue(maxsize=queue_size)
+        self.stats = IngestStats()
+        self._writer_task: asyncio.Task | None = None
+
+    def start(self):
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._writer_loop())
+            log.info("Writer task started")
+
+    async def stop(self):
+        """Stops the writer after flushing everything already queued."""
+        if self._writer_task is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), INGEST_STOP_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            log.error("Stopping with %d records not written", self.queue.qsize() + 1)
+        self._writer_task.cancel()
+        try:
+            await self._writer_task
+        except asyncio.CancelledError:
+            pass
+        self._writer_task = None
+        log.info("Writer task stopped %s", self.stats.snapshot())
+
+    async def submit(self, record: IngestRecord):
+        await self.queue.put(record)
+        self.stats.received += 1
+
+    async def _next_batch(self) -> list[IngestRecord]:
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _commit(self, batch: list[IngestRecord]):
+        sessions, attendance = [], []
+        for record in batch:
+            if isinstance(record, LectureSessionBase):
+                sessions.append((record.id, record.course_code, record.lecturer_id, record.session_date.isoformat(sep=" ")))
+            else:
+                attendance.append((record.session_id, record.student_id, record.attendance_time.isoformat(sep=" "), record.attended))
+        started = time.perf_counter()
+        inserted = await self.db.write(_write_batch, sessions, attendance)
+        self.stats.record_commit(len(batch), inserted, time.perf_counter() - started)
+
+    async def _commit_until_written(self, batch: list[IngestRecord]):
+        delay = INGEST_RETRY_MIN_S
+        while True:
+            try:
+                await self._commit(batch)
+                return
+            except REJECTED_RECORD_ERRORS as e:
+                if len(batch) == 1:
+                    self.stats.rejected += 1
+                    log.error("Dropped a record the database refuses (%s): %r", e, batch[0])
+                    return
+                middle = len(batch) // 2
+                await self._commit_until_written(batch[:middle])
+                await self._commit_until_written(batch[middle:])
+                return
+            except Exception as e:
+                self.stats.retries += 1
+                log.error("Failed to commit batch of %d records, retrying in %.1fs: %r", len(batch), delay, e)
+                await asyncio.sleep(delay)
+                delay = min(INGEST_RETRY_MAX_S, delay * 2)
+
+    async def _writer_loop(self):
+        last_report = time.monotonic()
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._commit_until_written(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if time.monotonic() - last_report >= INGEST_REPORT_INTERVAL_S:
+                self.stats.roll_window()
+                log.info("%s", self.stats.snapshot())
+                last_report = time.monotonic()
+
+
+ingestor: AttendanceIngestor | None = None
+
+def get_ingestor() -> AttendanceIngestor:
+    """Returns the process-wide ingestor, creating it on the running loop."""
+    global ingestor
+    if ingestor is None:
+        ingestor = AttendanceIngestor()
+    return ingestor
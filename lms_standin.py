@@ -0,0 +1,115 @@
+# lms_standin.py (Local stand-in for the LMS batch upload endpoint)
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LmsStandIn:
+    """
+    Accepts the edge server's outbox uploads the way the LMS is expected to:
+    gzipped JSON batches, deduplicated by Idempotency-Key and by each record's
+    seq. It can be made slow or flaky to exercise the uploader's backoff.
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 8090, fail_rate: float = 0.0,
+                 latency: float = 0.0, token: str | None = None):
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.token = token
+        self.records: dict[tuple[str, int], dict] = {} # (edge, seq) -> record
+        self.batch_keys: set[str] = set()
+        self.requests = 0
+        self.failed = 0
+        self.duplicate_records = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.port = self._server.server_address[1]
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/api/attendance/batch"
+
+    def start(self) -> "LmsStandIn":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "failed": self.failed, "batches": len(self.batch_keys),
+                    "records": len(self.records), "duplicate_records": self.duplicate_records}
+
+    def _accept(self, key: str | None, batch: dict) -> int:
+        with self._lock:
+            self.requests += 1
+            if random.random() < self.fail_rate:
+                self.failed += 1
+                return 503
+            if key and key in self.batch_keys:
+                return 409
+            for record in batch["records"]:
+                if (batch["edge"], record["seq"]) in self.records:
+                    self.duplicate_records += 1
+                self.records[(batch["edge"], record["seq"])] = record
+            if key:
+                self.batch_keys.add(key)
+            return 200
+
+    def _handler_class(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if standin.token and self.headers.get("Authorization") != f"Bearer {standin.token}":
+                    return self._reply(401, {"error": "unauthorized"})
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                try:
+                    batch = json.loads(body)
+                except ValueError:
+                    return self._reply(400, {"error": "invalid JSON"})
+                if standin.latency:
+                    time.sleep(standin.latency)
+                status = standin._accept(self.headers.get("Idempotency-Key"), batch)
+                self._reply(status, {"accepted": len(batch["records"])} if status == 200 else {"status": status})
+
+            def do_GET(self):
+                self._reply(200, standin.snapshot())
+
+            def _reply(self, status: int, payload: dict):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the LMS upload endpoint.")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--token", help="Require this bearer token")
+    args = parser.parse_args()
+
+    standin = LmsStandIn(port=args.port, fail_rate=args.fail_rate, latency=args.latency, token=args.token)
+    print(f"LMS stand-in: POST {standin.url} (GET it for stats); set LMS_UPLOAD_URL to this")
+    try:
+        standin._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,290 @@
+# lms_uploader.py (Store-and-forward upload of attendance to the LMS)
+import asyncio
+import gzip
+import os
+import random
+import socket
+import sqlite3
+import time
+import urllib.error
+import urllib.request
+from database import Database, db as default_db
+from health import health, READY, DEGRADED
+from log import get_logger
+
+log = get_logger("lms")
+
+LMS_UPLOAD_URL = os.environ.get("LMS_UPLOAD_URL") # Batch endpoint of the LMS; uploads are off when unset
+LMS_API_TOKEN = os.environ.get("LMS_API_TOKEN")
+EDGE_NODE_ID = os.environ.get("EDGE_NODE_ID", socket.gethostname())
+
+UPLOAD_BATCH_START = 200 # Records per request...
+UPLOAD_BATCH_MIN = 1
+UPLOAD_BATCH_MAX = 5000
+UPLOAD_BATCH_STEP = 100 # ...grown by this much after each success and halved after each failure
+UPLOAD_TIMEOUT_S = 30
+UPLOAD_IDLE_POLL_S = 2.0 # How often an empty outbox is checked
+UPLOAD_BACKOFF_BASE_S = 1.0
+UPLOAD_BACKOFF_MAX_S = 300.0
+OUTBOX_COUNT_INTERVAL_S = 30.0 # How often the upload loop recounts the outbox for /metrics
+
+RETRYABLE_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+# The LMS objects to what was sent: narrowed down to the record and parked. Any
+# other status (401, 403, 404, ...) is about the uplink's setup, not the records,
+# so the whole outbox waits behind a backoff until an operator fixes it.
+REFUSED_STATUSES = frozenset({400, 413, 422})
+
+
+class UploadError(Exception):
+    def __init__(self, message: str, retryable: bool = True, retry_after: float | None = None, refused: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.refused = refused # The content was rejected, rather than the request
+
+
+def _read_batch(conn: sqlite3.Connection, limit: int) -> list[sqlite3.Row]:
+    return conn.execute("""
+        SELECT id, entity, op, payload FROM lms_outbox
+        WHERE parked_at IS NULL ORDER BY id LIMIT ?;""", (limit,)).fetchall()
+
+def _acknowledge(conn: sqlite3.Connection, first_id: int, last_id: int) -> int:
+    return conn.execute("DELETE FROM lms_outbox WHERE id BETWEEN ? AND ? AND parked_at IS NULL;", (first_id, last_id)).rowcount
+
+def _park(conn: sqlite3.Connection, outbox_id: int):
+    conn.execute("UPDATE lms_outbox SET parked_at = CURRENT_TIMESTAMP WHERE id = ?;", (outbox_id,))
+
+def _outbox_counts(conn: sqlite3.Connection) -> sqlite3.Row:
+    return conn.execute("""
+        SELECT COUNT(*) FILTER (WHERE parked_at IS NULL) AS pending,
+               COUNT(*) FILTER (WHERE parked_at IS NOT NULL) AS parked,
+               MIN(created_at) FILTER (WHERE parked_at IS NULL) AS oldest_pending
+        FROM lms_outbox;""").fetchone()
+
+def _outbox_depth(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT COUNT(*) FROM lms_outbox;").fetchone()[0]
+
+
+def encode_batch(rows: list[sqlite3.Row]) -> bytes:
+    """
+    Gzipped JSON body of one upload. Payloads are already JSON in the outbox,
+    so they are spliced in rather than parsed and re-serialized.
+    """
+    records = ",".join(
+        f'{{"seq":{row["id"]},"entity":"{row["entity"]}","op":"{row["op"]}","data":{row["payload"]}}}' for row in rows)
+    body = f'{{"edge":"{EDGE_NODE_ID}","records":[{records}]}}'
+    return gzip.compress(body.encode(), compresslevel=6)
+
+def _post(url: str, body: bytes, headers: dict, timeout: float) -> int:
+    """Blocking POST, run off the event loop. Returns the status or raises UploadError."""
+    request = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        if e.code == 409: # The LMS already has this batch
+            return e.code
+        retry_after = e.headers.get("Retry-After")
+        raise UploadError(f"HTTP {e.code}", retryable=e.code in RETRYABLE_STATUSES, refused=e.code in REFUSED_STATUSES,
+                          retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None)
+    except (urllib.error.URLError, socket.timeout, ConnectionError) as e:
+        raise UploadError(f"uplink error: {getattr(e, 'reason', e)}")
+
+
+class UploadStats:
+    def __init__(self):
+        self.uploaded = 0
+        self.batches = 0
+        self.failures = 0
+        self.parked = 0
+        self.bytes_sent = 0
+        self.last_error: str | None = None
+        self.last_success_at: float | None = None
+        self.blocked: str | None = None # Why uploads are held back, while the LMS refuses every request
+        self.depth: int | None = None # Records in the outbox, pending or parked, as last counted
+
+    def snapshot(self) -> dict:
+        return {
+            "uploaded": self.uploaded,
+            "batches": self.batches,
+            "failures": self.failures,
+            "parked": self.parked,
+            "bytes_sent": self.bytes_sent,
+            "last_error": self.last_error,
+            "last_success_at": self.last_success_at,
+            "blocked": self.blocked,
+            "depth": self.depth,
+        }
+
+
+class OutboxUploader:
+    """
+    Drains lms_outbox to the LMS in gzipped batches, oldest first.
+
+    Records leave the outbox only once the LMS has accepted them, so a crash or
+    restart resumes from the first unacknowledged record; the LMS deduplicates
+    redeliveries by each record's seq and each request's Idempotency-Key. The
+    batch size grows additively while uploads succeed and halves on failure,
+    and failures back off exponentially with jitter. Only a record the LMS
+    refuses as content (REFUSED_STATUSES) is narrowed down to and parked; an
+    authentication, permission or URL error holds the whole outbox back and
+    marks the "lms" subsystem degraded until an upload succeeds. Ingestion
+    only ever writes to the outbox table, so it never waits on the uplink.
+    Without a URL nothing is queued (see database._create_outbox) and the
+    uploader only reports what an earlier configuration left behind.
+    """
+    def __init__(self, url: str | None = LMS_UPLOAD_URL, db: Database = default_db, token: str | None = LMS_API_TOKEN,
+                 batch_size: int = UPLOAD_BATCH_START, idle_poll_s: float = UPLOAD_IDLE_POLL_S):
+        self.url = url
+        self.db = db
+        self.token = token
+        self.batch_size = batch_size
+        self.idle_poll_s = idle_poll_s
+        self.backoff_s = 0.0
+        self.stats = UploadStats()
+        self._task: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+        self._counted_at = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.url)
+
+    def start(self):
+        if self._task is not None:
+            return
+        if not self.enabled:
+            self._task = asyncio.create_task(self._report_leftovers())
+            return
+        health.set("lms", READY)
+        self._task = asyncio.create_task(self._upload_loop())
+        log.info("Draining outbox to %s", self.url)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            health.unregister("lms")
+
+    async def _count(self):
+        self.stats.depth = await self.db.read(_outbox_depth)
+        self._counted_at = time.monotonic()
+
+    async def _report_leftovers(self):
+        """Counts the outbox once: with upload disabled nothing is added to it or taken from it."""
+        await self._count()
+        log.info("Upload disabled (LMS_UPLOAD_URL not set); changes are not queued for the LMS")
+        if self.stats.depth:
+            log.warning("%d records queued before upload was disabled stay in lms_outbox until LMS_UPLOAD_URL is set again",
+                        self.stats.depth)
+
+    def wake(self):
+        """Skips the current idle wait, e.g. after a large import."""
+        self._wakeup.set()
+
+    def _headers(self, first_id: int, last_id: int) -> dict:
+        headers = {
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+            "Idempotency-Key": f"{EDGE_NODE_ID}:{first_id}-{last_id}",
+        }
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        return headers
+
+    async def upload_once(self) -> int:
+        """Uploads one batch. Returns how many records left the outbox (0 when it is empty)."""
+        rows = await self.db.read(_read_batch, self.batch_size)
+        if not rows:
+            return 0
+        first_id, last_id = rows[0]["id"], rows[-1]["id"]
+        body = encode_batch(rows)
+        try:
+            await asyncio.to_thread(_post, self.url, body, self._headers(first_id, last_id), UPLOAD_TIMEOUT_S)
+        except UploadError as e:
+            self.stats.failures += 1
+            self.stats.last_error = str(e)
+            if not e.retryable and not e.refused:
+                raise # Not about this batch: keep its size, and its records, for when the LMS takes requests again
+            self.batch_size = max(UPLOAD_BATCH_MIN, self.batch_size // 2)
+            if e.refused and len(rows) == 1:
+                # Narrowed down to the one record the LMS won't take: set it aside
+                await self.db.write(_park, first_id)
+                self.stats.parked += 1
+                log.warning("Parked outbox record %d (%s): %s", first_id, rows[0]["entity"], e)
+                return 1
+            raise
+        await self.db.write(_acknowledge, first_id, last_id)
+        self.stats.uploaded += len(rows)
+        self.stats.batches += 1
+        self.stats.bytes_sent += len(body)
+        self.stats.last_success_at = time.time()
+        if self.stats.blocked:
+            log.info("Uploads accepted again after: %s", self.stats.blocked)
+            self.stats.blocked = None
+            health.set("lms", READY)
+        self.batch_size = min(UPLOAD_BATCH_MAX, self.batch_size + UPLOAD_BATCH_STEP)
+        return len(rows)
+
+    async def _upload_loop(self):
+        while True:
+            try:
+                if time.monotonic() - self._counted_at >= OUTBOX_COUNT_INTERVAL_S:
+                    await self._count()
+                uploaded = await self.upload_once()
+                self.backoff_s = 0.0
+            except UploadError as e:
+                if e.refused:
+                    # The LMS refused the content: retry at once with the halved
+                    # batch, which narrows down to the offending record.
+                    continue
+                base = max(UPLOAD_BACKOFF_BASE_S, min(UPLOAD_BACKOFF_MAX_S, self.backoff_s * 2))
+                self.backoff_s = max(base, e.retry_after or 0.0)
+                delay = random.uniform(self.backoff_s / 2, self.backoff_s)
+                if e.retryable:
+                    log.warning("%s; next batch of %d in %.1fs", e, self.batch_size, delay)
+                else:
+                    health.set("lms", DEGRADED, f"LMS rejects uploads ({e}); records kept in the outbox")
+                    self.stats.blocked = str(e)
+                    log.error("LMS rejects uploads (%s), check LMS_UPLOAD_URL and LMS_API_TOKEN; outbox kept, retrying in %.1fs", e, delay)
+                await asyncio.sleep(delay)
+                continue
+            except Exception as e:
+                self.stats.last_error = repr(e)
+                log.error("Upload loop failed: %r", e)
+                await asyncio.sleep(UPLOAD_BACKOFF_MAX_S / 10)
+                continue
+            if not uploaded:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.idle_poll_s)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def snapshot(self) -> dict:
+        counts = await self.db.read(_outbox_counts)
+        self.stats.depth = counts["pending"] + counts["parked"]
+        return {
+            "enabled": self.enabled and self._task is not None,
+            "pending": counts["pending"],
+            "parked": counts["parked"],
+            "oldest_pending": counts["oldest_pending"],
+            "batch_size": self.batch_size,
+            "backoff_s": round(self.backoff_s, 2),
+            **self.stats.snapshot(),
+        }
+
+
+uploader: OutboxUploader | None = None
+
+def get_uploader() -> OutboxUploader:
+    """Returns the process-wide uploader, creating it on the running loop."""
+    global uploader
+    if uploader is None:
+        uploader = OutboxUploader()
+    return uploader
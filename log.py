@@ -0,0 +1,66 @@
+# log.py (Non-blocking, level-gated diagnostics)
+import atexit
+import copy
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper() # DEBUG adds per-request and per-message lines
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+LOGGER_ROOT = "edge"
+
+_listener: logging.handlers.QueueListener | None = None
+_handler: logging.Handler | None = None
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The message is interpolated now, while its args still hold what was logged (a dict
+        # or list may change before the listener gets to it); the line's layout and any
+        # traceback are left to the listener thread, since the queue never leaves the process
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger for one component, e.g. get_logger("mqtt") -> "edge.mqtt"."""
+    return logging.getLogger(f"{LOGGER_ROOT}.{name}")
+
+
+def start_logging(level: str = LOG_LEVEL):
+    """
+    Routes every edge.* logger through a queue drained by a background thread.
+    A call on the event loop only interpolates the message and enqueues the
+    record; formatting the line and the write to stdout happen off the loop,
+    and a call below `level` returns after one level check. Idempotent.
+    """
+    global _listener, _handler
+    root = logging.getLogger(LOGGER_ROOT)
+    root.setLevel(level)
+    if _listener is not None:
+        return
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    _handler = _DeferredQueueHandler(records)
+    root.addHandler(_handler)
+    root.propagate = False
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Writes out everything queued and stops the writer thread; later records go to the default handler."""
+    global _listener, _handler
+    if _listener is None:
+        return
+    root = logging.getLogger(LOGGER_ROOT)
+    root.removeHandler(_handler)
+    root.propagate = True
+    _listener.stop()
+    _listener = _handler = None
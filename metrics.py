@@ -0,0 +1,237 @@
+# metrics.py (Prometheus text-format metrics for /metrics)
+import abc
+import bisect
+import math
+import threading
+import time
+from typing import Callable
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; request, handler and query latencies from 0.5 ms to 10 s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Seconds; enrollment stages wait on a person tapping a card
+ENROLLMENT_BUCKETS = (0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    """
+    A metric family. Children are created per distinct label values on first
+    use; updates take a per-child lock, since database timings are recorded
+    from the pool's threads.
+    """
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._children: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        if not labels:
+            self.labels() # Reported from the start, as zero
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} takes labels {self.label_names}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    @abc.abstractmethod
+    def _new_child(self):
+        """The per-label-values state of this kind of metric."""
+
+    @abc.abstractmethod
+    def _samples(self) -> list[str]:
+        """Exposition lines for every child."""
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+
+class _Value:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def _samples(self) -> list[str]:
+        return [f"{self.name}_total{_labels(self.label_names, k)} {_number(c.value)}" for k, c in list(self._children.items())]
+
+
+class Gauge(Metric):
+    """A value that goes up and down; with `collect`, read from the owning object at scrape time instead."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), collect: Callable[[], float | None] | None = None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def _samples(self) -> list[str]:
+        if self.collect is not None:
+            try:
+                value = self.collect()
+            except Exception:
+                return [] # A component that isn't running has nothing to report
+            return [] if value is None else [f"{self.name} {_number(value)}"] # None: not measured yet
+        return [f"{self.name}{_labels(self.label_names, k)} {_number(c.value)}" for k, c in list(self._children.items())]
+
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum", "lock")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # The last slot is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.bounds, value) # First bucket with value <= bound
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for key, child in list(self._children.items()):
+            with child.lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+REGISTRY: list[Metric] = []
+
+def render() -> bytes:
+    """Every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return ("\n".join(lines) + "\n").encode()
+
+
+# ---- The server's metrics ----
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "edge_http_request_duration_seconds", "HTTP request latency by route template and status.",
+    ("method", "route", "status"))
+WEBSOCKETS_ACTIVE = Gauge("edge_websockets_active", "Open enrollment status WebSockets.")
+
+MQTT_MESSAGES = Counter("edge_mqtt_messages", "MQTT messages handled, by topic and outcome.", ("topic", "outcome"))
+MQTT_HANDLER_SECONDS = Histogram("edge_mqtt_handler_duration_seconds", "Time on_message spent per message, by topic.", ("topic",))
+
+DB_OPERATION_SECONDS = Histogram(
+    "edge_db_operation_duration_seconds", "Time a database call ran on its connection, by kind (read/write).", ("kind",))
+DB_WAIT_SECONDS = Histogram(
+    "edge_db_wait_duration_seconds", "Time a database call waited for a free connection, by kind.", ("kind",))
+DB_COMMIT_SECONDS = Histogram("edge_db_commit_duration_seconds", "Time spent in COMMIT on the writer connection.")
+DB_PENDING = Gauge("edge_db_pending_operations", "Database calls submitted and not yet finished, by kind.", ("kind",))
+
+ENROLLMENT_STAGE_SECONDS = Histogram(
+    "edge_enrollment_stage_duration_seconds", "Time an enrollment spent in each stage before moving on.",
+    ("stage",), buckets=ENROLLMENT_BUCKETS)
+ENROLLMENT_SECONDS = Histogram(
+    "edge_enrollment_duration_seconds", "End-to-end enrollment time, by outcome.", ("outcome",), buckets=ENROLLMENT_BUCKETS)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request. Routes are labeled by their
+    template (/cs/sync/{entity}), never the concrete path, to bound the label
+    set; unmatched paths share one label.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(
+                scope["method"], getattr(route, "path", "<unmatched>"), str(status)).observe(time.perf_counter() - started)
@@ -0,0 +1,575 @@
+# migrations.py (Versioned schema migrations, tracked in PRAGMA user_version)
+import argparse
+import sqlite3
+import sys
+import time
+from log import get_logger, start_logging
+
+log = get_logger("migrations")
+
+# STRICT tables need SQLite 3.37; older libraries get the same tables without it
+STRICT = ", STRICT" if sqlite3.sqlite_version_info >= (3, 37, 0) else ""
+
+MIGRATION_LOCK_TIMEOUT_S = 600 # A worker starting during another's long migration waits for it
+AUTO_VACUUM_INCREMENTAL = 2 # PRAGMA auto_vacuum
+
+# Monday of a session's week, e.g. '2024-03-04'
+SESSION_WEEK_SQL = "date({date}, '-6 days', 'weekday 1')"
+
+
+class MigrationError(RuntimeError):
+    pass
+
+
+class Migration:
+    def __init__(self, version: int, description: str, apply, transactional: bool = True):
+        self.version = version
+        self.description = description
+        self.apply = apply # apply(cursor), run inside the migration's transaction
+        self.transactional = transactional # False for steps such as VACUUM that can't run in one
+
+
+MIGRATIONS: list[Migration] = []
+
+def migration(version: int, description: str, transactional: bool = True):
+    """
+    Registers the decorated function as schema version `version`. Versions
+    are applied in order, once. A non-transactional migration must be safe
+    to run again, since a crash or a second worker may repeat it.
+    """
+    def register(apply):
+        if MIGRATIONS and version != MIGRATIONS[-1].version + 1:
+            raise MigrationError(f"Migration {version} registered out of order")
+        MIGRATIONS.append(Migration(version, description, apply, transactional))
+        return apply
+    return register
+
+
+def table_columns(cursor: sqlite3.Cursor, table: str) -> set[str]:
+    return {row[1] for row in cursor.execute(f"PRAGMA table_info({table});")}
+
+def _drop_triggers(cursor: sqlite3.Cursor):
+    """Triggers are recreated by database.init_db on every start, so a table rebuild can drop them freely."""
+    for (name,) in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger';").fetchall():
+        cursor.execute(f"DROP TRIGGER {name};")
+
+def _rebuild_table(cursor: sqlite3.Cursor, table: str, create_sql: str, copy_columns: dict[str, str]):
+    """Recreates a table with a new definition (SQLite can't ALTER one into WITHOUT ROWID/STRICT)."""
+    cursor.execute(create_sql.format(table=f"{table}_rebuilt"))
+    columns = ", ".join(copy_columns)
+    cursor.execute(f"INSERT INTO {table}_rebuilt ({columns}) SELECT {', '.join(copy_columns.values())} FROM {table};")
+    cursor.execute(f"DROP TABLE {table};")
+    cursor.execute(f"ALTER TABLE {table}_rebuilt RENAME TO {table};")
+
+
+# ---- Migrations. Never edit one that has shipped; add a new one. ----
+# 1-4 describe the schema as it stood before versioning, so they are written
+# to be no-ops on a database that already has it.
+
+@migration(1, "Core tables")
+def _core_tables(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS lecturers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            sch_id TEXT UNIQUE,
+            rfid_uid TEXT UNIQUE, -- Fingerprint/Card UID from enrollment
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS students (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            sch_id TEXT UNIQUE,
+            rfid_uid TEXT UNIQUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS courses (
+            code TEXT PRIMARY KEY,
+            course_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    # Catalog facets used by terminals to list the courses of a level/faculty/department
+    for column, decl in (("level", "INTEGER"), ("faculty", "TEXT"), ("dept", "TEXT")):
+        if column not in table_columns(cursor, "courses"):
+            cursor.execute(f"ALTER TABLE courses ADD COLUMN {column} {decl};")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_courses_catalog ON courses (level, faculty, dept);")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS lecture_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            course_code TEXT NOT NULL,
+            lecturer_id INTEGER NOT NULL, -- Lecturer for this specific session
+            session_date TIMESTAMP NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (course_code) REFERENCES courses(code) ON DELETE RESTRICT,
+            FOREIGN KEY (lecturer_id) REFERENCES lecturers(id) ON DELETE RESTRICT
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS attendance_records (
+            session_id INTEGER NOT NULL,
+            student_id INTEGER NOT NULL,
+            attendance_time TIMESTAMP NOT NULL,
+            attended BOOLEAN NOT NULL DEFAULT 1,
+            PRIMARY KEY (session_id, student_id),
+            FOREIGN KEY (session_id) REFERENCES lecture_sessions(id) ON DELETE CASCADE,
+            FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE RESTRICT
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS course_registrations (
+            course_code TEXT NOT NULL,
+            student_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (course_code, student_id),
+            FOREIGN KEY (course_code) REFERENCES courses(code) ON DELETE CASCADE,
+            FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_course_registrations_student ON course_registrations (student_id);")
+
+
+@migration(2, "Change tracking: change_seq columns, shared sequence, tombstones")
+def _change_tracking(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_sequence (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL
+        );
+    """)
+    cursor.execute("INSERT OR IGNORE INTO sync_sequence (id, value) VALUES (1, 0);")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sync_tombstones (
+            change_seq INTEGER PRIMARY KEY,
+            entity TEXT NOT NULL,
+            row_key TEXT NOT NULL, -- JSON object of the deleted row's primary key
+            deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sync_tombstones_entity ON sync_tombstones (entity, change_seq);")
+    for table in ("lecturers", "students", "courses", "lecture_sessions", "attendance_records"):
+        if "change_seq" not in table_columns(cursor, table):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0;")
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP;")
+            # Rows that predate versioning get unique sequence numbers of their own
+            cursor.execute(f"UPDATE {table} SET change_seq = (SELECT value FROM sync_sequence) + rowid;")
+            cursor.execute(f"UPDATE sync_sequence SET value = value + (SELECT COALESCE(MAX(rowid), 0) FROM {table});")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_change_seq ON {table} (change_seq);")
+
+
+@migration(3, "LMS upload outbox")
+def _lms_outbox(cursor: sqlite3.Cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS lms_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, -- Upload order; also the record's idempotency key upstream
+            entity TEXT NOT NULL,
+            op TEXT NOT NULL, -- 'upsert' or 'delete'
+            payload TEXT NOT NULL, -- JSON object of the row, or of its key for a delete
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            parked_at TIMESTAMP -- Set when the LMS rejected the record outright; parked records are not retried
+        );
+    """)
+
+
+@migration(4, "Attendance aggregates")
+def _attendance_aggregates(cursor: sqlite3.Cursor):
+    is_new = not cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'attendance_session_stats';").fetchone()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS attendance_session_stats (
+            session_id INTEGER PRIMARY KEY,
+            course_code TEXT NOT NULL,
+            week_start TEXT NOT NULL, -- Monday of the session's week
+            present INTEGER NOT NULL DEFAULT 0,
+            absent INTEGER NOT NULL DEFAULT 0
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS attendance_course_stats (
+            course_code TEXT PRIMARY KEY,
+            sessions INTEGER NOT NULL DEFAULT 0,
+            present INTEGER NOT NULL DEFAULT 0,
+            absent INTEGER NOT NULL DEFAULT 0
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS attendance_course_weekly (
+            course_code TEXT NOT NULL,
+            week_start TEXT NOT NULL,
+            sessions INTEGER NOT NULL DEFAULT 0,
+            present INTEGER NOT NULL DEFAULT 0,
+            absent INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (course_code, week_start)
+        ) WITHOUT ROWID;
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS attendance_student_course (
+            course_code TEXT NOT NULL,
+            student_id INTEGER NOT NULL,
+            attended INTEGER NOT NULL DEFAULT 0, -- Sessions the student was present at
+            recorded INTEGER NOT NULL DEFAULT 0, -- Sessions with a record for the student, present or absent
+            PRIMARY KEY (course_code, student_id)
+        ) WITHOUT ROWID;
+    """)
+    # "Who is below 75%" is a range scan of one course's students
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attendance_student_course_rate ON attendance_student_course (course_code, attended);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attendance_student_course_student ON attendance_student_course (student_id);")
+    if is_new:
+        rebuild_attendance_stats(cursor)
+
+
+@migration(5, "WITHOUT ROWID, STRICT attendance_records and course_registrations")
+def _clustered_link_tables(cursor: sqlite3.Cursor):
+    # Both are keyed by a composite primary key, which as rowid tables cost a
+    # second b-tree (the autoindex) on every insert. Clustered on the key, each
+    # row is stored once, in key order.
+    _drop_triggers(cursor)
+    _rebuild_table(cursor, "attendance_records", f"""
+        CREATE TABLE {{table}} (
+            session_id INTEGER NOT NULL,
+            student_id INTEGER NOT NULL,
+            attendance_time TEXT NOT NULL,
+            attended INTEGER NOT NULL DEFAULT 1,
+            change_seq INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT,
+            PRIMARY KEY (session_id, student_id),
+            FOREIGN KEY (session_id) REFERENCES lecture_sessions(id) ON DELETE CASCADE,
+            FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE RESTRICT
+        ) WITHOUT ROWID{STRICT};""", {
+            "session_id": "CAST(session_id AS INTEGER)",
+            "student_id": "CAST(student_id AS INTEGER)",
+            "attendance_time": "CAST(attendance_time AS TEXT)",
+            "attended": "CAST(attended AS INTEGER)",
+            "change_seq": "change_seq",
+            "updated_at": "CAST(updated_at AS TEXT)",
+        })
+    cursor.execute("CREATE INDEX idx_attendance_records_change_seq ON attendance_records (change_seq);")
+    _rebuild_table(cursor, "course_registrations", f"""
+        CREATE TABLE {{table}} (
+            course_code TEXT NOT NULL,
+            student_id INTEGER NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (course_code, student_id),
+            FOREIGN KEY (course_code) REFERENCES courses(code) ON DELETE CASCADE,
+            FOREIGN KEY (student_id) REFERENCES students(id) ON DELETE CASCADE
+        ) WITHOUT ROWID{STRICT};""", {
+            "course_code": "CAST(course_code AS TEXT)",
+            "student_id": "CAST(student_id AS INTEGER)",
+            "created_at": "CAST(created_at AS TEXT)",
+        })
+    cursor.execute("CREATE INDEX idx_course_registrations_student ON course_registrations (student_id);")
+
+
+@migration(6, "Indexes for the per-student, per-course and per-lecturer lookups")
+def _query_indexes(cursor: sqlite3.Cursor):
+    # A student's history, answered from the index alone
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_attendance_records_student ON attendance_records (student_id, session_id, attended);")
+    # A course's sessions by date, e.g. its latest session
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_lecture_sessions_course_date ON lecture_sessions (course_code, session_date);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_lecture_sessions_lecturer_date ON lecture_sessions (lecturer_id, session_date);")
+    # Card and school-id lookups already use the UNIQUE constraints' indexes; see QUERY_PLAN_CHECKS
+    cursor.execute("ANALYZE;")
+
+
+@migration(7, "Multi-worker coordination: leases, message log, enrollment jobs")
+def _worker_coordination(cursor: sqlite3.Cursor):
+    # Who holds a single-owner role (the MQTT subscription, the enrollment terminals) and until when
+    cursor.execute(f"""
+        CREATE TABLE worker_leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL -- Unix time; another worker may take the lease after it
+        ) WITHOUT ROWID{STRICT};
+    """)
+    # Messages every worker tails, in id order; pruned after a few minutes
+    cursor.execute(f"""
+        CREATE TABLE worker_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin TEXT NOT NULL, -- Worker that published it, which has already handled it
+            topic TEXT NOT NULL,
+            payload TEXT NOT NULL, -- JSON
+            created_at REAL NOT NULL
+        ){STRICT};
+    """)
+    cursor.execute("CREATE INDEX idx_worker_messages_created ON worker_messages (created_at);")
+    # Enrollments accepted by any worker, run by the worker holding the terminals
+    cursor.execute(f"""
+        CREATE TABLE enrollment_jobs (
+            session_id TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            unique_id TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'queued', -- queued, running, then the outcome
+            worker TEXT, -- Worker running it
+            uid TEXT, -- Card read, once completed
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID{STRICT};
+    """)
+    cursor.execute("CREATE INDEX idx_enrollment_jobs_state ON enrollment_jobs (state, created_at);")
+
+
+@migration(8, "Semester archival: archive registry, trigger suppression, session date index")
+def _semester_archival(cursor: sqlite3.Cursor):
+    # Closed semesters moved to the archive file by archive.py, attached by every connection
+    cursor.execute(f"""
+        CREATE TABLE archived_semesters (
+            semester TEXT PRIMARY KEY, -- Month it started, e.g. '2024-09'
+            path TEXT NOT NULL, -- Archive file, relative to this database's directory
+            starts TEXT NOT NULL, -- [starts, ends) of session_date
+            ends TEXT NOT NULL,
+            state TEXT NOT NULL, -- 'moving', then 'archived'
+            sessions INTEGER NOT NULL DEFAULT 0,
+            records INTEGER NOT NULL DEFAULT 0,
+            started_at REAL,
+            finished_at REAL
+        ) WITHOUT ROWID{STRICT};
+    """)
+    # Holds a row only inside an archival transaction; delete triggers check it
+    cursor.execute(f"CREATE TABLE trigger_suppression (reason TEXT PRIMARY KEY) WITHOUT ROWID{STRICT};")
+    # A semester's sessions are found by date
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_lecture_sessions_date ON lecture_sessions (session_date);")
+
+
+@migration(9, "Incremental auto-vacuum, so pages freed by archival can be returned", transactional=False)
+def _incremental_vacuum(cursor: sqlite3.Cursor):
+    # New files are created in this mode (database.CONNECTION_PRAGMAS). An older
+    # one only records the request here: converting it rewrites the whole file,
+    # which is left to `python migrations.py --vacuum` rather than to startup
+    if cursor.execute("PRAGMA main.auto_vacuum;").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        cursor.execute("PRAGMA main.auto_vacuum = INCREMENTAL;")
+        log.warning("Database is not in incremental auto-vacuum mode; archival can't shrink it "
+                    "until `python migrations.py --vacuum` is run with the server stopped")
+
+
+def convert_to_incremental_vacuum(conn: sqlite3.Connection) -> bool:
+    """
+    Rewrites the file with a full VACUUM so it can be shrunk incrementally;
+    returns False if it already could. Takes as long as copying the file and
+    holds the write lock throughout, so it's a maintenance step, not a startup one.
+    """
+    pragma = lambda name: conn.execute(f"PRAGMA main.{name};").fetchone()[0]
+    if pragma("auto_vacuum") == AUTO_VACUUM_INCREMENTAL:
+        return False
+    if conn.in_transaction:
+        conn.commit()
+    size = pragma("page_count") * pragma("page_size")
+    log.info("Converting to incremental auto-vacuum: rewriting %.1f MiB", size / 2**20)
+    started = time.perf_counter()
+    conn.execute("PRAGMA main.auto_vacuum = INCREMENTAL;")
+    conn.execute("VACUUM main;")
+    log.info("Converted to incremental auto-vacuum in %.1fs; now %.1f MiB",
+             time.perf_counter() - started, pragma("page_count") * pragma("page_size") / 2**20)
+    return True
+
+
+def rebuild_attendance_stats(conn: sqlite3.Connection | sqlite3.Cursor,
+                             sessions: str = "lecture_sessions", records: str = "attendance_records"):
+    """
+    Recomputes every attendance aggregate from scratch (backfill and repair).
+    Pass the all_* views to count archived semesters too.
+    """
+    for table in ("attendance_session_stats", "attendance_course_stats", "attendance_course_weekly", "attendance_student_course"):
+        conn.execute(f"DELETE FROM {table};")
+    conn.execute(f"""
+        INSERT INTO attendance_session_stats (session_id, course_code, week_start, present, absent)
+        SELECT ls.id, ls.course_code, {SESSION_WEEK_SQL.format(date="ls.session_date")},
+               COALESCE(SUM(a.attended), 0), COALESCE(SUM(NOT a.attended), 0)
+        FROM {sessions} ls LEFT JOIN {records} a ON a.session_id = ls.id
+        GROUP BY ls.id;""")
+    conn.execute("""
+        INSERT INTO attendance_course_stats (course_code, sessions, present, absent)
+        SELECT course_code, COUNT(*), SUM(present), SUM(absent) FROM attendance_session_stats GROUP BY course_code;""")
+    conn.execute("""
+        INSERT INTO attendance_course_weekly (course_code, week_start, sessions, present, absent)
+        SELECT course_code, week_start, COUNT(*), SUM(present), SUM(absent)
+        FROM attendance_session_stats GROUP BY course_code, week_start;""")
+    conn.execute(f"""
+        INSERT INTO attendance_student_course (course_code, student_id, attended, recorded)
+        SELECT s.course_code, a.student_id, SUM(a.attended), COUNT(*)
+        FROM {records} a JOIN attendance_session_stats s ON s.session_id = a.session_id
+        GROUP BY s.course_code, a.student_id;""")
+
+
+# ---- Runner ----
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+def _begin_exclusive_write(cursor: sqlite3.Cursor, timeout: float = MIGRATION_LOCK_TIMEOUT_S):
+    """BEGIN IMMEDIATE, waiting out workers that are migrating the same file, however long that takes."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            cursor.execute("BEGIN IMMEDIATE;")
+            return
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or time.monotonic() >= deadline:
+                raise
+            time.sleep(0.1)
+
+def _apply_outside_transaction(cursor: sqlite3.Cursor, m: Migration, timeout: float = MIGRATION_LOCK_TIMEOUT_S):
+    """Runs a non-transactional migration, waiting out a worker running the same one."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            m.apply(cursor)
+            return
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or time.monotonic() >= deadline:
+                raise
+            time.sleep(0.1)
+
+def migrate(conn: sqlite3.Connection) -> list[int]:
+    """
+    Applies every migration newer than the database's user_version, each in
+    its own transaction together with the version bump, so a failed migration
+    leaves the database at the previous version. A non-transactional one runs
+    first and its version is bumped after. Returns the versions applied.
+    """
+    if conn.in_transaction:
+        conn.commit()
+    current = schema_version(conn)
+    latest = MIGRATIONS[-1].version
+    if current > latest:
+        raise MigrationError(f"Database schema version {current} is newer than this server's ({latest})")
+    applied = []
+    for m in MIGRATIONS:
+        if m.version <= current:
+            continue
+        started = time.perf_counter()
+        cursor = conn.cursor()
+        try:
+            if not m.transactional:
+                _apply_outside_transaction(cursor, m)
+            _begin_exclusive_write(cursor)
+            if schema_version(conn) >= m.version: # Another worker applied it while we waited
+                conn.rollback()
+                continue
+            if m.transactional:
+                m.apply(cursor)
+            cursor.execute(f"PRAGMA user_version = {m.version};")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise MigrationError(f"Migration {m.version} ({m.description}) failed: {e}") from e
+        finally:
+            cursor.close()
+        applied.append(m.version)
+        log.info("Applied %d (%s) in %.2fs", m.version, m.description, time.perf_counter() - started)
+    return applied
+
+
+# ---- Query plan checks ----
+
+# (lookup, query, text its EXPLAIN QUERY PLAN must contain). A missing or
+# unused index shows up as a SCAN, or as a different index, in the plan.
+# tests/test_query_plans.py asserts them against a seeded database; `--check`
+# runs them against a live one, whose small or skewed tables may rightly scan.
+QUERY_PLAN_CHECKS = (
+    ("attendance of a student",
+     "SELECT session_id, attended FROM attendance_records WHERE student_id = 1;",
+     "USING COVERING INDEX idx_attendance_records_student"),
+    ("attendance of a session",
+     "SELECT student_id FROM attendance_records WHERE session_id = 1 AND attended;",
+     "SEARCH attendance_records USING PRIMARY KEY (session_id=?)"),
+    ("latest session of a course",
+     "SELECT id FROM lecture_sessions WHERE course_code = 'CSC101' ORDER BY session_date DESC LIMIT 1;",
+     "idx_lecture_sessions_course_date"),
+    ("sessions of a lecturer",
+     "SELECT id FROM lecture_sessions WHERE lecturer_id = 1 ORDER BY session_date;",
+     "idx_lecture_sessions_lecturer_date"),
+    ("lecturer by card",
+     "SELECT id FROM lecturers WHERE rfid_uid = 'X';",
+     "INDEX sqlite_autoindex_lecturers_2 (rfid_uid=?)"),
+    ("student by card",
+     "SELECT id FROM students WHERE rfid_uid = 'X';",
+     "INDEX sqlite_autoindex_students_2 (rfid_uid=?)"),
+    ("student by school id",
+     "SELECT id FROM students WHERE sch_id = 'X';",
+     "INDEX sqlite_autoindex_students_1 (sch_id=?)"),
+    ("registrations of a course",
+     "SELECT student_id FROM course_registrations WHERE course_code = 'CSC101';",
+     "SEARCH course_registrations USING PRIMARY KEY (course_code=?)"),
+    ("courses of a student",
+     "SELECT course_code FROM course_registrations WHERE student_id = 1;",
+     "idx_course_registrations_student"),
+    ("attendance changes after a cursor",
+     "SELECT * FROM attendance_records WHERE change_seq > 0 ORDER BY change_seq LIMIT 100;",
+     "idx_attendance_records_change_seq"),
+    ("students below a rate",
+     "SELECT student_id FROM attendance_student_course WHERE course_code = 'CSC101' AND attended < 10;",
+     "idx_attendance_student_course_rate"),
+    ("catalog by facets",
+     "SELECT code FROM courses WHERE level = 100 AND faculty = 'SEET' AND dept = 'CSC';",
+     "idx_courses_catalog"),
+    ("worker messages after a cursor",
+     "SELECT id, topic, payload FROM worker_messages WHERE id > 0 ORDER BY id LIMIT 500;",
+     "INTEGER PRIMARY KEY (rowid>?)"),
+    ("sessions of a semester",
+     "SELECT id FROM lecture_sessions WHERE session_date >= '2024-03-01' AND session_date < '2024-09-01' ORDER BY session_date;",
+     "idx_lecture_sessions_date"),
+    ("attendance across semesters after a cursor",
+     "SELECT * FROM all_attendance_records WHERE (session_id, student_id) > (1, 1) ORDER BY session_id, student_id LIMIT 100;",
+     "attendance_records USING PRIMARY KEY ((session_id,student_id)>(?,?))"),
+    ("queued enrollment jobs",
+     "SELECT session_id FROM enrollment_jobs WHERE state = 'queued' ORDER BY created_at;",
+     "idx_enrollment_jobs_state"),
+)
+
+def check_query_plans(conn: sqlite3.Connection) -> list[str]:
+    """Returns a description of every lookup whose plan no longer uses the expected index."""
+    problems = []
+    for name, sql, expected in QUERY_PLAN_CHECKS:
+        plan = " / ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}"))
+        if expected not in plan:
+            problems.append(f"{name}: expected '{expected}', got '{plan}'")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate the edge server's database and check its query plans.")
+    parser.add_argument("--database", help="Database file (default: the server's)")
+    parser.add_argument("--status", action="store_true", help="Only print the schema version and pending migrations")
+    parser.add_argument("--check", action="store_true", help="Only run the query plan checks; exit 1 on a regression")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="Convert the file to incremental auto-vacuum (a full rewrite; stop the server first)")
+    args = parser.parse_args()
+
+    import asyncio
+    import database
+    from lms_uploader import LMS_UPLOAD_URL
+    start_logging()
+    target = database.Database(args.database) if args.database else database.db
+    conn = database._connect(target.path)
+    version = schema_version(conn)
+    if args.vacuum:
+        if version < MIGRATIONS[-1].version:
+            print(f"Schema version {version} of {MIGRATIONS[-1].version}; migrate before converting")
+            sys.exit(1)
+        if not convert_to_incremental_vacuum(conn):
+            print("Already in incremental auto-vacuum mode")
+        sys.exit(0)
+    if args.status:
+        print(f"Schema version {version} of {MIGRATIONS[-1].version}")
+        for m in MIGRATIONS:
+            if m.version > version:
+                print(f"  pending {m.version}: {m.description}")
+        sys.exit(0)
+    if not args.check:
+        # The full init, so triggers dropped by a table rebuild are recreated too
+        asyncio.run(database.init_db(target, outbox=bool(LMS_UPLOAD_URL)))
+        conn.close()
+        conn = database._connect(target.path) # Planned against the migrated schema and its fresh statistics
+    elif version < MIGRATIONS[-1].version:
+        print(f"Schema version {version} of {MIGRATIONS[-1].version}; migrate before checking query plans")
+        sys.exit(1)
+    problems = check_query_plans(conn)
+    for problem in problems:
+        print(f"Query plan regression: {problem}")
+    print(f"Query plans: {len(QUERY_PLAN_CHECKS) - len(problems)}/{len(QUERY_PLAN_CHECKS)} as expected")
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,243 @@
+# mini_broker.py (Embedded MQTT broker stand-in for local runs and load tests)
+import argparse
+import asyncio
+import struct
+import time
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+MQTT_V311 = 4
+MQTT_V5 = 5
+
+
+# ---- Wire codec, shared with fleet_sim.py's lightweight client ----
+
+def encode_varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte, n = n % 128, n // 128
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+def decode_varint(data: bytes, pos: int) -> tuple[int, int]:
+    value, shift = 0, 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value += (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def encode_str(s: str | bytes) -> bytes:
+    data = s.encode() if isinstance(s, str) else s
+    return struct.pack("!H", len(data)) + data
+
+def decode_str(data: bytes, pos: int) -> tuple[bytes, int]:
+    (length,) = struct.unpack_from("!H", data, pos)
+    return data[pos + 2:pos + 2 + length], pos + 2 + length
+
+def packet(kind: int, body: bytes, flags: int = 0) -> bytes:
+    return bytes([kind << 4 | flags]) + encode_varint(len(body)) + body
+
+async def read_packet(reader: asyncio.StreamReader) -> tuple[int, int, bytes]:
+    """Reads one control packet, returning (type, flags, body)."""
+    first = (await reader.readexactly(1))[0]
+    length, shift = 0, 0
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) << shift
+        if not byte & 0x80:
+            break
+        shift += 7
+    body = await reader.readexactly(length) if length else b""
+    return first >> 4, first & 0x0F, body
+
+def encode_publish(topic: str, payload: bytes, qos: int = 0, packet_id: int = 0,
+                   version: int = MQTT_V311, properties: bytes = b"") -> bytes:
+    body = encode_str(topic)
+    if qos:
+        body += struct.pack("!H", packet_id)
+    if version == MQTT_V5:
+        body += encode_varint(len(properties)) + properties
+    return packet(PUBLISH, body + payload, flags=qos << 1)
+
+def decode_publish(flags: int, body: bytes, version: int) -> tuple[str, bytes, int, int, bytes]:
+    """Returns (topic, payload, qos, packet_id, raw v5 properties)."""
+    qos = (flags >> 1) & 0x03
+    topic, pos = decode_str(body, 0)
+    packet_id = 0
+    if qos:
+        (packet_id,) = struct.unpack_from("!H", body, pos)
+        pos += 2
+    properties = b""
+    if version == MQTT_V5:
+        length, pos = decode_varint(body, pos)
+        properties, pos = body[pos:pos + length], pos + length
+    return topic.decode(), body[pos:], qos, packet_id, properties
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_parts, topic_parts = topic_filter.split("/"), topic.split("/")
+    for i, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if i >= len(topic_parts) or (part != "+" and part != topic_parts[i]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+# ---- Broker ----
+
+class _Session:
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.client_id = ""
+        self.version = MQTT_V311
+        self.subscriptions: dict[str, int] = {} # filter -> max QoS
+        self.next_packet_id = 0
+        self.inflight: dict[int, tuple[str, float]] = {} # packet id -> (topic, time the broker received it)
+
+    def allocate_packet_id(self) -> int:
+        self.next_packet_id = self.next_packet_id % 65535 + 1
+        return self.next_packet_id
+
+
+class MiniBroker:
+    """
+    Just enough of MQTT 3.1.1 and 5 (QoS 0/1, wildcards, keepalive) to stand in
+    for mosquitto on a laptop. It also measures, per topic, the time from a
+    publisher's message reaching the broker to each QoS 1 subscriber's PUBACK,
+    which for the edge server is the moment a record has been queued.
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 1883):
+        self.host = host
+        self.port = port
+        self.sessions: set[_Session] = set()
+        self.delivery_latencies: dict[str, list[float]] = {}
+        self.published = 0
+        self._server: asyncio.base_events.Server | None = None
+
+    async def start(self) -> "MiniBroker":
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            for session in list(self.sessions):
+                session.writer.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = _Session(writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                kind, flags, body = await read_packet(reader)
+                if kind == CONNECT:
+                    self._on_connect(session, body)
+                elif kind == PUBLISH:
+                    self._on_publish(session, flags, body)
+                elif kind == PUBACK:
+                    (packet_id,) = struct.unpack_from("!H", body)
+                    sent = session.inflight.pop(packet_id, None)
+                    if sent:
+                        topic, received_at = sent
+                        self.delivery_latencies.setdefault(topic, []).append(time.perf_counter() - received_at)
+                elif kind == SUBSCRIBE:
+                    self._on_subscribe(session, body)
+                elif kind == UNSUBSCRIBE:
+                    self._on_unsubscribe(session, body)
+                elif kind == PINGREQ:
+                    writer.write(packet(PINGRESP, b""))
+                elif kind == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    def _on_connect(self, session: _Session, body: bytes):
+        _, pos = decode_str(body, 0) # protocol name
+        session.version = body[pos]
+        pos += 4 # level, connect flags, keepalive
+        if session.version == MQTT_V5:
+            length, pos = decode_varint(body, pos)
+            pos += length
+        client_id, _ = decode_str(body, pos)
+        session.client_id = client_id.decode()
+        if session.version == MQTT_V5:
+            session.writer.write(packet(CONNACK, b"\x00\x00\x00"))
+        else:
+            session.writer.write(packet(CONNACK, b"\x00\x00"))
+
+    def _on_publish(self, session: _Session, flags: int, body: bytes):
+        topic, payload, qos, packet_id, properties = decode_publish(flags, body, session.version)
+        received_at = time.perf_counter()
+        self.published += 1
+        if qos == 1:
+            session.writer.write(packet(PUBACK, struct.pack("!H", packet_id)))
+        for subscriber in list(self.sessions):
+            granted = max((q for f, q in subscriber.subscriptions.items() if topic_matches(f, topic)), default=None)
+            if granted is None:
+                continue
+            out_qos = min(qos, granted)
+            out_id = 0
+            if out_qos:
+                out_id = subscriber.allocate_packet_id()
+                subscriber.inflight[out_id] = (topic, received_at)
+            forwarded = properties if session.version == MQTT_V5 else b""
+            subscriber.writer.write(encode_publish(topic, payload, out_qos, out_id, subscriber.version, forwarded))
+
+    def _on_subscribe(self, session: _Session, body: bytes):
+        (packet_id,) = struct.unpack_from("!H", body)
+        pos = 2
+        if session.version == MQTT_V5:
+            length, pos = decode_varint(body, pos)
+            pos += length
+        granted = bytearray()
+        while pos < len(body):
+            topic_filter, pos = decode_str(body, pos)
+            qos = min(body[pos] & 0x03, 1)
+            pos += 1
+            session.subscriptions[topic_filter.decode()] = qos
+            granted.append(qos)
+        props = b"\x00" if session.version == MQTT_V5 else b""
+        session.writer.write(packet(SUBACK, struct.pack("!H", packet_id) + props + bytes(granted)))
+
+    def _on_unsubscribe(self, session: _Session, body: bytes):
+        (packet_id,) = struct.unpack_from("!H", body)
+        pos = 2
+        if session.version == MQTT_V5:
+            length, pos = decode_varint(body, pos)
+            pos += length
+        count = 0
+        while pos < len(body):
+            topic_filter, pos = decode_str(body, pos)
+            session.subscriptions.pop(topic_filter.decode(), None)
+            count += 1
+        tail = b"\x00" + b"\x00" * count if session.version == MQTT_V5 else b""
+        session.writer.write(packet(UNSUBACK, struct.pack("!H", packet_id) + tail))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the embedded MQTT broker stand-in.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    async def main():
+        broker = await MiniBroker(args.host, args.port).start()
+        print(f"MQTT broker stand-in listening on {args.host}:{broker.port}")
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
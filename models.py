@@ -1,5 +1,6 @@
 from pydantic import BaseModel
 from datetime import datetime
+from typing import Optional, List
 
 class LecturerBase(BaseModel):
     id: int
@@ -17,6 +18,9 @@ class CourseBase(BaseModel):
     code: str
     course_id: int
     title: str
+    level: Optional[int] = None
+    faculty: Optional[str] = None
+    dept: Optional[str] = None
 
 class LectureSessionBase(BaseModel):
     id: int
@@ -24,13 +28,43 @@ class LectureSessionBase(BaseModel):
     lecturer_id: int
     session_date: datetime
 
+class LectureSessionClose(BaseModel):
+    id: int
+
+class CourseRegistrationBase(BaseModel):
+    course_code: str
+    student_id: int
+
 class StudentAttendanceRecordBase(BaseModel):
     session_id: int
     student_id: int
     attendance_time: datetime
     attended: bool = True
 
+class AttendanceTap(BaseModel):
+    """A raw card tap; the card is resolved to a student through the identity index."""
+    session_id: int
+    rfid_uid: str
+    attendance_time: Optional[datetime] = None
+
 class EnrollRequest(BaseModel):
     username: str
     unique_id: str
 
+class BatchRowError(BaseModel):
+    index: int
+    key: Optional[str] = None
+    detail: str
+
+class BatchSyncResult(BaseModel):
+    received: int
+    written: int
+    failed: int
+    errors: List[BatchRowError] = []
+
+class ChangeFeed(BaseModel):
+    entity: str
+    changes: List[dict]
+    deleted: List[dict]
+    next_cursor: int
+    has_more: bool
@@ -3,58 +3,239 @@ import gmqtt
 import json
 import contextlib as ctxlib
 from datetime import datetime
+import random
 import sqlite3
+import time
+from pydantic import ValidationError
 from database import get_db_connection
-from models import LectureSessionBase, StudentAttendanceRecordBase
+from models import LectureSessionBase, LectureSessionClose, StudentAttendanceRecordBase, AttendanceTap
+from ingest import get_ingestor
+from identity_index import identity_index, STUDENT
+from session_context import session_contexts, TAP_DUPLICATE
+from tap_dedup import tap_dedup
+from esp32_handler import ESP32_TOPICS, ESP32_TOPIC_PREFIX, ROSTER_ATTENDANCE_PREFIX, handle_esp32_message, publish_roster
+from metrics import MQTT_MESSAGES, MQTT_HANDLER_SECONDS
+from health import health, STARTING, READY, DEGRADED
+from log import get_logger
+
+log = get_logger("mqtt")
 
 
 MQTT_BROKER_HOST = 'localhost'
 MQTT_BROKER_PORT = 1883
 MQTT_CLIENT_ID = 'cs_edge_mqtt_client'
+MQTT_CONNECT_TIMEOUT_S = 10 # For the TCP connect and the CONNACK together
+MQTT_RECONNECT_MIN_S = 0.5 # Backoff before the first retry...
+MQTT_RECONNECT_MAX_S = 30 # ...doubling up to this
+MQTT_SESSION_EXPIRY_S = 3600 # The broker keeps our subscriptions and queues QoS 1 taps this long while we're away
+
+MQTT_SUBSYSTEM = "mqtt" # Name reported by /healthz and /readyz
 
 LECTURE_SESSION_TOPIC = "cs/lecture/session"
+LECTURE_SESSION_CLOSE_TOPIC = "cs/lecture/session/close"
 ATTENDANCE_TOPIC = "cs/attendance"
 
-mqtt_client: gmqtt.Client = None
-
 def on_connect(client, flags, rc, properties):
-    """Callback for when the MQTT client connects to the broker."""
-    print(f"MQTT: Connected to broker with result code: {rc}")
-    # Subscribe to required topics upon successful connection
-    client.subscribe(LECTURE_SESSION_TOPIC, qos=1)
-    client.subscribe(ATTENDANCE_TOPIC, qos=1)
-    print(f"MQTT: Subscribed to topics: {LECTURE_SESSION_TOPIC}, {ATTENDANCE_TOPIC}")
+    """Callback for when the MQTT client connects to the broker, including every reconnect."""
+    log.info("Connected to broker with result code: %s", rc)
+    # Subscribe on every connection: a broker that lost our session has forgotten them
+    topics = (LECTURE_SESSION_TOPIC, LECTURE_SESSION_CLOSE_TOPIC, ATTENDANCE_TOPIC) + ESP32_TOPICS
+    for topic in topics:
+        client.subscribe(topic, qos=1)
+    log.info("Subscribed to topics: %s", ", ".join(topics))
+
 
+TOPIC_MODELS = {
+    LECTURE_SESSION_TOPIC: LectureSessionBase,
+    LECTURE_SESSION_CLOSE_TOPIC: LectureSessionClose,
+    ATTENDANCE_TOPIC: StudentAttendanceRecordBase,
+}
+KNOWN_TOPICS = frozenset(TOPIC_MODELS) | frozenset(ESP32_TOPICS)
 
-def on_message(client, topic, payload, qos, prop):
-    print(f'still working on this part:\nclient: {client}\ntopic: {topic}\npayload: {payload}\nqos: {qos}\nprop: {prop}')
-# handle on_message received for subscriptions
+def _topic_label(topic: str) -> str:
+    """Metric label for a topic; per-device topics share one, so the label set stays bounded."""
+    if topic.startswith(ROSTER_ATTENDANCE_PREFIX):
+        return ROSTER_ATTENDANCE_PREFIX + "+"
+    return topic if topic in KNOWN_TOPICS else "other"
 
-async def start_mqtt_client():
-    """Initializes and connects the MQTT client"""
-    global mqtt_client
-    mqtt_client = gmqtt.Client(MQTT_CLIENT_ID)
-    mqtt_client.on_connect = on_connect
-    mqtt_client.on_message = on_message
+def _decode(topic: str, payload: bytes):
+    """
+    Decodes a payload into the record to persist. Attendance may arrive either
+    as a resolved record or as a raw card tap, which is resolved in memory.
+    """
+    if topic == ATTENDANCE_TOPIC and b'"rfid_uid"' in payload:
+        tap = AttendanceTap.model_validate_json(payload)
+        identity = identity_index.resolve(tap.rfid_uid)
+        if identity is None or identity.kind != STUDENT:
+            log.info("Dropping tap from unknown student card %s", tap.rfid_uid)
+            return None
+        return StudentAttendanceRecordBase(
+            session_id=tap.session_id,
+            student_id=identity.id,
+            attendance_time=tap.attendance_time or datetime.now(),
+        )
+    return TOPIC_MODELS[topic].model_validate_json(payload)
 
+async def _start_session(client, session: LectureSessionBase, payload: bytes, prop: dict):
+    """Builds the session's in-memory context and pushes its roster to the terminal that started it."""
+    context = await session_contexts.open(session)
+    request = json.loads(payload)
+    if request.get("device_id") or prop.get("response_topic"): # Older firmware can't be addressed, nor use a roster
+        publish_roster(client, context.roster, session.id, request, prop)
 
-    mqtt_client.on_disconnect = lambda client, packet, exc: print(f"MQTT: Disconnected: {exc}")
-    mqtt_client.on_subscribe = lambda client, mid, qos, properties: print(f"MQTT: SUBSCRIBED MID={mid}, QOS={qos}, Prop={properties}")
+async def on_message(client, topic, payload, qos, prop):
+    """
+    Validates session/attendance payloads and hands them to the ingestion
+    pipeline. Awaiting the bounded queue delays the PUBACK, which is how a
+    burst of taps is pushed back onto the broker instead of into memory.
+    Repeated taps are dropped in memory first: within a short window by
+    tap_dedup, and for as long as the session is open by its context.
+    """
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        outcome = await _handle_message(client, topic, payload, prop)
+    finally:
+        label = _topic_label(topic)
+        MQTT_MESSAGES.labels(label, outcome).inc()
+        MQTT_HANDLER_SECONDS.labels(label).observe(time.perf_counter() - started)
+    return 0
 
+async def _handle_message(client, topic: str, payload: bytes, prop: dict) -> str:
+    """Handles one message and returns its outcome, for the per-topic counters."""
+    if topic.startswith(ESP32_TOPIC_PREFIX):
+        try:
+            await handle_esp32_message(client, topic, payload, prop)
+        except (ValueError, KeyError, TypeError) as e:
+            log.warning("Dropping malformed %s message: %r", topic, e)
+            return "invalid"
+        return "handled"
+    if topic not in TOPIC_MODELS:
+        log.warning("Ignoring message on unexpected topic %s", topic)
+        return "ignored"
     try:
-        print(f"MQTT: Attempting to connect to broker at {MQTT_BROKER_HOST}:{MQTT_BROKER_PORT}...")
-        await mqtt_client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT)
-        print("MQTT: Client connection initiated.")
-        # TODO:
-        # Keep the client running by awaiting a long-running task if needed,
-        # but the lifespan management will handle the main loop.
-    except Exception as e:
-        print(f"MQTT ERROR: Failed to connect to broker: {e}")
-        # You might want to implement a reconnection strategy here for robustness
+        record = _decode(topic, payload)
+    except ValidationError as e:
+        # Acknowledge anyway: a malformed payload will never become valid on redelivery
+        log.warning("Dropping invalid payload on %s: %s", topic, e.errors(include_url=False))
+        return "invalid"
+    if record is None:
+        return "unknown_card"
+    if isinstance(record, LectureSessionClose):
+        await session_contexts.close(record.id)
+        return "handled"
+    if isinstance(record, StudentAttendanceRecordBase) and record.attended and (
+            tap_dedup.is_duplicate(record.session_id, record.student_id)
+            or session_contexts.check_tap(record.session_id, record.student_id) == TAP_DUPLICATE):
+        return "duplicate"
+    await get_ingestor().submit(record)
+    if isinstance(record, LectureSessionBase):
+        try:
+            await _start_session(client, record, payload, prop)
+        except Exception as e:
+            # The session itself is queued; taps are then deduplicated by the database alone
+            log.warning("Could not preload session %d: %r", record.id, e)
+    return "queued"
+
+class _SupervisedClient(gmqtt.Client):
+    """gmqtt client that leaves reconnecting to MqttSupervisor instead of retrying on a fixed delay."""
+    async def reconnect(self, delay=False):
+        pass
+
+
+class MqttSupervisor:
+    """
+    Owns the broker connection. Connecting happens in the background, so a
+    broker that is down at boot delays nothing else; after a failed attempt or
+    a lost connection it retries with exponential backoff and full jitter, so
+    a building's worth of clients doesn't reconnect in lockstep after the
+    broker restarts.
+    """
+    def __init__(self, host: str = MQTT_BROKER_HOST, port: int = MQTT_BROKER_PORT):
+        self.host = host
+        self.port = port
+        # PUBACK only once on_message has queued the record, so the broker redelivers what a crash
+        # catches before that; from there the ingestor retries a failed commit until it is written
+        self.client = _SupervisedClient(
+            MQTT_CLIENT_ID, clean_session=False, optimistic_acknowledgement=False,
+            session_expiry_interval=MQTT_SESSION_EXPIRY_S)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = on_message
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_subscribe = lambda client, mid, qos, properties: log.debug("Subscribed mid=%s qos=%s properties=%s", mid, qos, properties)
+        self.connected = False
+        self.connects = 0
+        self.failures = 0
+        self._lost = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.connected:
+            await self.client.disconnect()
+            log.info("Client disconnected.")
+
+    def _on_connect(self, client, flags, rc, properties):
+        self.connected = True
+        self.connects += 1
+        health.set(MQTT_SUBSYSTEM, READY, f"connected to {self.host}:{self.port}")
+        on_connect(client, flags, rc, properties)
+
+    def _on_disconnect(self, client, packet, exc=None):
+        if self.connected:
+            log.warning("Disconnected from broker: %s", exc or "connection closed")
+        self.connected = False
+        self._lost.set()
+
+    async def _run(self):
+        backoff = MQTT_RECONNECT_MIN_S
+        while True:
+            self._lost.clear()
+            try:
+                log.info("Connecting to broker at %s:%s...", self.host, self.port)
+                await asyncio.wait_for(self.client.connect(self.host, self.port), MQTT_CONNECT_TIMEOUT_S)
+            except Exception as e:
+                self.failures += 1
+                if isinstance(e, asyncio.TimeoutError): # Connected but no CONNACK; refused sockets are already closed
+                    with ctxlib.suppress(Exception):
+                        await self.client.disconnect()
+                delay = random.uniform(0, backoff)
+                state = DEGRADED if self.connects else STARTING
+                health.set(MQTT_SUBSYSTEM, state, f"broker unreachable ({e!r}); retrying")
+                log.warning("Could not connect to broker at %s:%s: %r; retrying in %.1fs", self.host, self.port, e, delay)
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, MQTT_RECONNECT_MAX_S)
+                continue
+            backoff = MQTT_RECONNECT_MIN_S
+            await self._lost.wait()
+            health.set(MQTT_SUBSYSTEM, DEGRADED, "connection lost; reconnecting")
+            await asyncio.sleep(random.uniform(0, backoff))
+
+
+mqtt_supervisor: MqttSupervisor | None = None
+
+def start_mqtt_client():
+    """Starts the ingest writer and connects to the broker in the background; returns immediately."""
+    global mqtt_supervisor
+    get_ingestor().start()
+    if mqtt_supervisor is None:
+        mqtt_supervisor = MqttSupervisor()
+        mqtt_supervisor.start()
 
 async def stop_mqtt_client():
     """Disconnects the MQTT client gracefully."""
-    global mqtt_client
-    if mqtt_client:
-        await mqtt_client.disconnect()
-        print("MQTT: Client disconnected.")
+    global mqtt_supervisor
+    if mqtt_supervisor is not None:
+        await mqtt_supervisor.stop()
+        mqtt_supervisor = None
+    await get_ingestor().stop()
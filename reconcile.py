@@ -0,0 +1,194 @@
+# reconcile.py (Range hashes for finding rows that differ from the LMS copy)
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+from fastapi import FastAPI, Depends, HTTPException, status, Response, Query
+from changes import FeedEntity, FEED_ENTITIES
+from database import Database, get_database
+import fast_json
+
+RECONCILE_ENTITIES = ("lecturers", "students", "courses") # The tables the LMS pushes through /cs/sync
+TREE_DEPTH = 3 # Hex digits of the key hash per leaf: 4096 leaves, ~25 rows each at 100k rows
+ROWS_FETCH_CHUNK = 500 # Keys per query when reading a range's rows
+PREFIX_PATTERN = re.compile(f"[0-9a-f]{{0,{TREE_DEPTH}}}")
+LEAF_PATTERN = re.compile(f"[0-9a-f]{{{TREE_DEPTH}}}") # Rows are read one leaf at a time
+
+
+def canonical(values) -> bytes:
+    """The encoding both sides hash: a compact JSON array of the values as stored."""
+    return json.dumps(list(values), separators=(",", ":"), ensure_ascii=False).encode()
+
+def key_path(key: tuple) -> str:
+    """The leaf a key falls in: the first TREE_DEPTH hex digits of sha256 over its canonical encoding."""
+    return hashlib.sha256(canonical(key)).hexdigest()[:TREE_DEPTH]
+
+def row_digest(values: tuple) -> int:
+    """128 bits of sha256 over the row's columns, in the order of /cs/sync/<entity>."""
+    return int.from_bytes(hashlib.sha256(canonical(values)).digest()[:16], "big")
+
+
+def _read_hashed_rows(conn: sqlite3.Connection, entity: FeedEntity, since: int | None) -> tuple[int, list]:
+    """
+    (sequence now, [(key, leaf, digest or None for a delete)] in change order):
+    every row when `since` is None, otherwise what changed after it. Hashed
+    here, on the reader thread, so a full load doesn't stall the event loop.
+    """
+    columns = ", ".join(entity.columns)
+    conn.execute("BEGIN;") # The rows and the sequence from one snapshot
+    try:
+        version = conn.execute("SELECT value FROM sync_sequence;").fetchone()[0]
+        if since is None:
+            rows = [(0, tuple(r)) for r in conn.execute(f"SELECT {columns} FROM {entity.table};")]
+            tombstones = []
+        else:
+            rows = [(r[-1], tuple(r)[:-1]) for r in conn.execute(
+                f"SELECT {columns}, change_seq FROM {entity.table} WHERE change_seq > ?;", (since,))]
+            tombstones = [(r["change_seq"], json.loads(r["row_key"])) for r in conn.execute(
+                "SELECT change_seq, row_key FROM sync_tombstones WHERE entity = ? AND change_seq > ?;", (entity.table, since))]
+    finally:
+        conn.execute("COMMIT;")
+    positions = [entity.columns.index(k) for k in entity.keys]
+    changes = []
+    for seq, values in rows:
+        key = tuple(values[i] for i in positions)
+        changes.append((seq, key, key_path(key), row_digest(values)))
+    for seq, row_key in tombstones:
+        key = tuple(row_key[k] for k in entity.keys)
+        changes.append((seq, key, key_path(key), None))
+    changes.sort(key=lambda c: c[0])
+    return version, [c[1:] for c in changes]
+
+def _read_rows_by_key(conn: sqlite3.Connection, entity: FeedEntity, keys: list[tuple]) -> list[dict]:
+    columns = ", ".join(entity.columns)
+    if len(entity.keys) == 1:
+        target, values = entity.keys[0], lambda n: ", ".join("?" * n)
+    else:
+        row = f"({', '.join('?' for _ in entity.keys)})"
+        target, values = f"({', '.join(entity.keys)})", lambda n: "VALUES " + ", ".join([row] * n)
+    rows = []
+    for i in range(0, len(keys), ROWS_FETCH_CHUNK):
+        chunk = keys[i:i + ROWS_FETCH_CHUNK]
+        rows += [dict(r) for r in conn.execute(
+            f"SELECT {columns} FROM {entity.table} WHERE {target} IN ({values(len(chunk))});",
+            [v for key in chunk for v in key])]
+    rows.sort(key=lambda r: tuple(r[k] for k in entity.keys))
+    return rows
+
+
+class RangeHashTree:
+    """
+    Hashes of one synced table over ranges of key-hash prefixes. A node's
+    hash is the XOR of the digests of every row whose key hash starts with
+    its prefix, so changing one row updates the TREE_DEPTH + 1 nodes on its
+    path and nothing else. Row digests are kept per leaf, so a request costs
+    the size of its range, not of the table. The tree is built on first use
+    and then follows the table through change_seq and the tombstones, which
+    also picks up writes made by other worker processes.
+    """
+    def __init__(self, entity: FeedEntity):
+        self.entity = entity
+        self.version: int | None = None # sync_sequence value the tree reflects; None until loaded
+        self._leaves: dict[str, dict[tuple, int]] = {} # leaf -> {key: digest}; empty leaves are absent
+        self._nodes: dict[str, list[int]] = {} # prefix -> [hash, row count]; empty ranges are absent
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, db: Database) -> int:
+        """Brings the tree up to date with the table; returns how many changes were applied."""
+        async with self._lock:
+            version, changes = await db.read(_read_hashed_rows, self.entity, self.version)
+            if self.version is None:
+                self._leaves.clear()
+                self._nodes.clear()
+            for key, leaf, digest in changes:
+                self._apply(key, leaf, digest)
+            self.version = version
+            return len(changes)
+
+    def _apply(self, key: tuple, leaf: str, digest: int | None):
+        rows = self._leaves.setdefault(leaf, {}) # A key's leaf never changes, only its digest
+        old = rows.pop(key, None)
+        if old is not None:
+            self._fold(leaf, old, -1)
+        if digest is not None:
+            rows[key] = digest
+            self._fold(leaf, digest, 1)
+        elif not rows:
+            del self._leaves[leaf]
+
+    def _fold(self, leaf: str, digest: int, delta: int):
+        for depth in range(TREE_DEPTH + 1):
+            prefix = leaf[:depth]
+            node = self._nodes.setdefault(prefix, [0, 0])
+            node[0] ^= digest
+            node[1] += delta
+            if node[1] == 0:
+                del self._nodes[prefix]
+
+    def node(self, prefix: str) -> dict:
+        """A range's hash and row count, with its non-empty sub-ranges or, for a leaf, its rows' digests."""
+        hash, count = self._nodes.get(prefix, (0, 0))
+        report = {"entity": self.entity.name, "version": self.version, "prefix": prefix,
+                  "hash": f"{hash:032x}", "count": count}
+        if len(prefix) < TREE_DEPTH:
+            report["children"] = [
+                {"prefix": child, "hash": f"{node[0]:032x}", "count": node[1]}
+                for child in (prefix + d for d in "0123456789abcdef") if (node := self._nodes.get(child))
+            ]
+        else:
+            report["rows"] = [{"key": list(key), "digest": f"{digest:032x}"}
+                              for key, digest in sorted(self._leaves.get(prefix, {}).items())]
+        return report
+
+    def keys(self, leaf: str) -> list[tuple]:
+        return list(self._leaves.get(leaf, ()))
+
+
+RANGE_HASH_TREES = {name: RangeHashTree(FEED_ENTITIES[name]) for name in RECONCILE_ENTITIES}
+
+
+def _tree(entity: str, prefix: str) -> RangeHashTree:
+    tree = RANGE_HASH_TREES.get(entity)
+    if tree is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"{entity} can't be reconciled; try one of {', '.join(RECONCILE_ENTITIES)}")
+    if not PREFIX_PATTERN.fullmatch(prefix):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"prefix must be up to {TREE_DEPTH} lowercase hex digits")
+    return tree
+
+
+class Reconcile:
+    """
+    Lets the LMS check its copy of the synced tables against this one
+    without a full dump. Every row is placed by sha256 of its canonical key
+    and hashed over its canonical columns (see key_path and row_digest); the
+    LMS computes the same over its own rows. It fetches the root range
+    (prefix ""), and where a hash or count differs it descends into the
+    differing sub-ranges, down to leaves listing per-row digests. The rows
+    that differ are then read, a leaf at a time, from
+    /cs/reconcile/<entity>/rows?prefix=<leaf> or pushed
+    through /cs/sync/<entity>:batch. Tables already in sync cost one request.
+    """
+    def __init__(self, app: FastAPI):
+        self.app = app
+        self._register_routes()
+
+    def _register_routes(self):
+        @self.app.get("/cs/reconcile/{entity}")
+        async def range_hash(entity: str, prefix: str = Query("", description=f"Key-hash prefix of the range, up to {TREE_DEPTH} hex digits"),
+                             db: Database = Depends(get_database)):
+            tree = _tree(entity, prefix)
+            await tree.refresh(db)
+            return Response(content=fast_json.dumps(tree.node(prefix)), media_type="application/json")
+
+        @self.app.get("/cs/reconcile/{entity}/rows")
+        async def range_rows(entity: str, prefix: str = Query(..., description=f"Leaf to read: a key-hash prefix of {TREE_DEPTH} hex digits"),
+                             db: Database = Depends(get_database)):
+            """The full rows of one leaf range, in primary-key order, in the shape of /cs/sync/<entity>."""
+            tree = _tree(entity, prefix)
+            if not LEAF_PATTERN.fullmatch(prefix):
+                # A wider range could be the whole table; /cs/sync/<entity> pages that
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"rows are read one leaf at a time: prefix must be {TREE_DEPTH} hex digits")
+            await tree.refresh(db)
+            rows = await db.read(_read_rows_by_key, tree.entity, tree.keys(prefix))
+            return Response(content=fast_json.dumps(rows), media_type="application/json")
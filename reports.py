@@ -0,0 +1,127 @@
+# reports.py
+import sqlite3
+from typing import Optional
+from fastapi import FastAPI, Depends, HTTPException, status, Response, Query
+from database import Database, get_database
+from migrations import rebuild_attendance_stats
+import fast_json
+
+DEFAULT_ATTENDANCE_THRESHOLD = 0.75
+REPORT_MAX_ROWS = 5000
+
+
+def _rate(attended: int, sessions: int) -> float:
+    return round(attended / sessions, 4) if sessions else 0.0
+
+
+def read_session_report(conn: sqlite3.Connection, session_id: int) -> dict | None:
+    row = conn.execute("SELECT * FROM attendance_session_stats WHERE session_id = ?;", (session_id,)).fetchone()
+    if row is None:
+        return None
+    return {**dict(row), "rate": _rate(row["present"], row["present"] + row["absent"])}
+
+
+def read_course_report(conn: sqlite3.Connection, course_code: str) -> dict | None:
+    row = conn.execute("SELECT * FROM attendance_course_stats WHERE course_code = ?;", (course_code,)).fetchone()
+    if row is None:
+        return None
+    registered = conn.execute("SELECT COUNT(*) FROM course_registrations WHERE course_code = ?;", (course_code,)).fetchone()[0]
+    return {**dict(row), "registered": registered, "rate": _rate(row["present"], row["present"] + row["absent"])}
+
+
+def read_course_weekly(conn: sqlite3.Connection, course_code: str) -> list[dict]:
+    rows = conn.execute("""
+        SELECT week_start, sessions, present, absent FROM attendance_course_weekly
+        WHERE course_code = ? ORDER BY week_start;""", (course_code,)).fetchall()
+    return [{**dict(row), "rate": _rate(row["present"], row["present"] + row["absent"])} for row in rows]
+
+
+def read_course_students(conn: sqlite3.Connection, course_code: str, below: float | None, limit: int) -> dict | None:
+    """
+    Students of a course with how many of its sessions they attended. With
+    `below`, only those under that share of the sessions held, lowest first;
+    registered students with no record at all count as having attended none.
+    """
+    course = conn.execute("SELECT sessions FROM attendance_course_stats WHERE course_code = ?;", (course_code,)).fetchone()
+    if course is None:
+        return None
+    sessions = course["sessions"]
+    cutoff = below * sessions if below is not None else sessions + 1 # Bound on the indexed attended column
+    rows = conn.execute("""
+        SELECT r.student_id, s.name, s.sch_id, r.attended, r.recorded
+        FROM attendance_student_course r LEFT JOIN students s ON s.id = r.student_id
+        WHERE r.course_code = ? AND r.attended < ?
+        UNION ALL
+        SELECT g.student_id, s.name, s.sch_id, 0, 0
+        FROM course_registrations g LEFT JOIN students s ON s.id = g.student_id
+        WHERE g.course_code = ? AND ? > 0 AND NOT EXISTS (
+            SELECT 1 FROM attendance_student_course r WHERE r.course_code = g.course_code AND r.student_id = g.student_id)
+        ORDER BY 4, 1 LIMIT ?;""", (course_code, cutoff, course_code, cutoff, limit)).fetchall()
+    return {
+        "course_code": course_code,
+        "sessions": sessions,
+        "threshold": below,
+        "students": [{**dict(row), "rate": _rate(row["attended"], sessions)} for row in rows],
+    }
+
+
+def read_student_report(conn: sqlite3.Connection, student_id: int) -> list[dict]:
+    rows = conn.execute("""
+        SELECT r.course_code, r.attended, r.recorded, c.sessions
+        FROM attendance_student_course r JOIN attendance_course_stats c ON c.course_code = r.course_code
+        WHERE r.student_id = ? ORDER BY r.course_code;""", (student_id,)).fetchall()
+    return [{**dict(row), "rate": _rate(row["attended"], row["sessions"])} for row in rows]
+
+
+def _json(payload) -> Response:
+    return Response(content=fast_json.dumps(payload), media_type="application/json")
+
+def _found(payload, what: str):
+    if payload is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No attendance recorded for {what}")
+    return _json(payload)
+
+
+class Reports:
+    """
+    Read-only attendance reports, served from the aggregate tables the
+    database keeps current on every write, so no report scans history.
+    """
+    def __init__(self, app: FastAPI):
+        self.app = app
+        self._register_routes()
+
+    def _register_routes(self):
+        @self.app.get("/cs/reports/sessions/{session_id}")
+        async def session_report(session_id: int, db: Database = Depends(get_database)):
+            return _found(await db.read(read_session_report, session_id), f"session {session_id}")
+
+        @self.app.get("/cs/reports/courses/{course_code}")
+        async def course_report(course_code: str, db: Database = Depends(get_database)):
+            return _found(await db.read(read_course_report, course_code), f"course {course_code}")
+
+        @self.app.get("/cs/reports/courses/{course_code}/weekly")
+        async def course_weekly(course_code: str, db: Database = Depends(get_database)):
+            return _json(await db.read(read_course_weekly, course_code))
+
+        @self.app.get("/cs/reports/courses/{course_code}/students")
+        async def course_students(
+            course_code: str,
+            below: Optional[float] = Query(None, gt=0, le=1, description=f"Only students under this attendance rate, e.g. {DEFAULT_ATTENDANCE_THRESHOLD}"),
+            limit: int = Query(REPORT_MAX_ROWS, ge=1, le=REPORT_MAX_ROWS),
+            db: Database = Depends(get_database),
+        ):
+            return _found(await db.read(read_course_students, course_code, below, limit), f"course {course_code}")
+
+        @self.app.get("/cs/reports/students/{student_id}")
+        async def student_report(student_id: int, db: Database = Depends(get_database)):
+            return _json(await db.read(read_student_report, student_id))
+
+        @self.app.post("/cs/reports:rebuild")
+        async def rebuild_reports(db: Database = Depends(get_database)):
+            """Recomputes the aggregates from the raw records; only needed after manual edits with triggers off."""
+            try:
+                await db.write(rebuild_attendance_stats, "all_lecture_sessions", "all_attendance_records")
+            except Exception as e:
+                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error rebuilding reports: {e}")
+            return {"message": "Attendance aggregates rebuilt."}
@@ -0,0 +1,167 @@
+# roster.py (Compact end-of-lecture attendance uploads)
+import sqlite3
+import struct
+import zlib
+from datetime import datetime
+
+ROSTER_FORMAT_VERSION = 1
+
+ENCODING_BITMAP = 0 # One bit per roster position, least significant bit first
+ENCODING_RUNS = 1 # Varint run lengths alternating absent/present, starting with absent
+
+# version, encoding, session_id, roster version, roster size
+UPLOAD_HEADER = struct.Struct("!BBIIH")
+
+# A run never exceeds the u16 roster size, which takes at most 3 varint bytes
+MAX_VARINT_BYTES = 3
+
+# Set-bit positions of every byte value, so a bitmap decodes a byte at a time
+_BIT_POSITIONS = tuple(tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256))
+
+# The terminal's bitmap can add attendance but never revokes a tap the server already recorded
+APPLY_ATTENDANCE_SQL = """
+    INSERT INTO attendance_records (session_id, student_id, attendance_time, attended) VALUES (?, ?, ?, ?)
+    ON CONFLICT(session_id, student_id) DO UPDATE SET attended = 1
+    WHERE excluded.attended AND NOT attendance_records.attended;"""
+
+
+class RosterError(ValueError):
+    """An upload that doesn't match the format or the roster it claims to be for."""
+
+
+class Roster:
+    """
+    The ordered list of students a terminal reports on for one lecture
+    session. Uploads refer to students by position in this list, and the
+    version (a CRC32 of the ids and cards) ties an upload to the exact list
+    the terminal was sent.
+    """
+    __slots__ = ("session_id", "student_ids", "uids", "version")
+
+    def __init__(self, session_id: int, student_ids: tuple[int, ...], uids: tuple[str, ...]):
+        self.session_id = session_id
+        self.student_ids = student_ids
+        self.uids = uids
+        self.version = zlib.crc32(repr((student_ids, uids)).encode())
+
+    def __len__(self):
+        return len(self.student_ids)
+
+    def to_message(self) -> dict:
+        return {"v": ROSTER_FORMAT_VERSION, "session_id": self.session_id, "version": self.version, "uids": list(self.uids)}
+
+
+def load_course_roster(conn: sqlite3.Connection, session_id: int, course_code: str) -> Roster:
+    """
+    The students registered for the course, ordered by id. A course with no
+    registrations falls back to everyone who has attended one of its sessions.
+    """
+    rows = conn.execute("""
+        SELECT s.id, COALESCE(s.rfid_uid, '') AS rfid_uid FROM course_registrations r
+        JOIN students s ON s.id = r.student_id
+        WHERE r.course_code = ? ORDER BY s.id;""", (course_code,)).fetchall()
+    if not rows:
+        rows = conn.execute("""
+            SELECT s.id, COALESCE(s.rfid_uid, '') AS rfid_uid FROM students s
+            WHERE s.id IN (
+                SELECT a.student_id FROM attendance_records a
+                JOIN lecture_sessions ls ON ls.id = a.session_id
+                WHERE ls.course_code = ?)
+            ORDER BY s.id;""", (course_code,)).fetchall()
+    return Roster(session_id, tuple(row["id"] for row in rows), tuple(row["rfid_uid"] for row in rows))
+
+def load_roster(conn: sqlite3.Connection, session_id: int) -> Roster | None:
+    """A session's roster, or None for an unknown session."""
+    session = conn.execute("SELECT course_code FROM lecture_sessions WHERE id = ?;", (session_id,)).fetchone()
+    if session is None:
+        return None
+    return load_course_roster(conn, session_id, session["course_code"])
+
+
+# ---- Codec ----
+
+def encode_bitmap(present: list[int], size: int) -> bytes:
+    bitmap = bytearray((size + 7) // 8)
+    for position in present:
+        bitmap[position >> 3] |= 1 << (position & 7)
+    return bytes(bitmap)
+
+def decode_bitmap(data: bytes, size: int) -> list[int]:
+    if len(data) != (size + 7) // 8:
+        raise RosterError(f"bitmap of {len(data)} bytes for a roster of {size}")
+    present = [base + bit for base, value in zip(range(0, size + 8, 8), data) if value for bit in _BIT_POSITIONS[value]]
+    if present and present[-1] >= size:
+        raise RosterError("bitmap marks positions past the end of the roster")
+    return present
+
+def _encode_varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte, n = n & 0x7F, n >> 7
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+def encode_runs(present: list[int], size: int) -> bytes:
+    out, position, expect_present = bytearray(), 0, False
+    marks = set(present)
+    while position < size:
+        start = position
+        while position < size and (position in marks) == expect_present:
+            position += 1
+        out += _encode_varint(position - start)
+        expect_present = not expect_present
+    return bytes(out)
+
+def decode_runs(data: bytes, size: int) -> list[int]:
+    """Each run is checked against the roster before it is expanded, so a hostile upload can't allocate past `size`."""
+    present, position, is_present, value, shift = [], 0, False, 0, 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            if shift >= 7 * MAX_VARINT_BYTES:
+                raise RosterError(f"run length longer than {MAX_VARINT_BYTES} bytes")
+            continue
+        if position + value > size:
+            raise RosterError(f"runs cover more than the {size} positions of the roster")
+        if is_present:
+            present.extend(range(position, position + value))
+        position += value
+        is_present, value, shift = not is_present, 0, 0
+    if position != size or shift:
+        raise RosterError(f"runs cover {position} positions of a roster of {size}")
+    return present
+
+def pack_upload(session_id: int, roster_version: int, size: int, present: list[int],
+                encoding: int = ENCODING_BITMAP) -> bytes:
+    """What a terminal sends: the positions of a roster message's uids that were tapped."""
+    body = encode_bitmap(present, size) if encoding == ENCODING_BITMAP else encode_runs(present, size)
+    return UPLOAD_HEADER.pack(ROSTER_FORMAT_VERSION, encoding, session_id, roster_version, size) + body
+
+def unpack_upload(payload: bytes) -> tuple[int, int, int, int, bytes]:
+    """Returns (encoding, session_id, roster version, roster size, body) of an upload."""
+    if len(payload) < UPLOAD_HEADER.size:
+        raise RosterError("upload shorter than its header")
+    version, encoding, session_id, roster_version, size = UPLOAD_HEADER.unpack_from(payload)
+    if version != ROSTER_FORMAT_VERSION:
+        raise RosterError(f"unsupported roster format version {version}")
+    if encoding not in (ENCODING_BITMAP, ENCODING_RUNS):
+        raise RosterError(f"unknown encoding {encoding}")
+    return encoding, session_id, roster_version, size, payload[UPLOAD_HEADER.size:]
+
+def decode_upload(roster: Roster, encoding: int, size: int, body: bytes) -> list[int]:
+    """Positions marked present, checked against the roster the upload was made for."""
+    if size != len(roster):
+        raise RosterError(f"upload is for a roster of {size}, not {len(roster)}")
+    return decode_bitmap(body, size) if encoding == ENCODING_BITMAP else decode_runs(body, size)
+
+
+def apply_attendance(conn: sqlite3.Connection, roster: Roster, present: list[int], attendance_time: datetime) -> int:
+    """Writes a whole roster's attendance as one batch; returns how many students were present."""
+    marked = set(present)
+    stamp = attendance_time.isoformat(sep=" ")
+    conn.executemany(APPLY_ATTENDANCE_SQL, (
+        (roster.session_id, student_id, stamp, position in marked)
+        for position, student_id in enumerate(roster.student_ids)))
+    return len(marked)
@@ -0,0 +1,151 @@
+# session_context.py
+import asyncio
+import collections
+import sqlite3
+import time
+from datetime import datetime
+from cluster import cluster
+from database import Database, db as default_db
+from ingest import get_ingestor
+from models import LectureSessionBase
+from roster import Roster, load_course_roster, apply_attendance
+from log import get_logger
+
+log = get_logger("sessions")
+
+SESSION_IDLE_TIMEOUT_S = 4 * 3600 # An open session without taps for this long is closed as abandoned
+MAX_OPEN_SESSIONS = 500 # Beyond this the least recently active session is closed
+SWEEP_INTERVAL_S = 60
+
+TAP_NEW = "new"
+TAP_DUPLICATE = "duplicate"
+TAP_UNREGISTERED = "unregistered" # Recorded, but the student isn't on the course roster
+TAP_NO_CONTEXT = "no_context" # Session not open in this process; the database dedupes instead
+
+# Worker message topic; open sessions live on the leader, registrations may change on any worker
+REGISTRATIONS_CHANGED_TOPIC = "registrations.changed"
+
+
+class SessionContext:
+    """Everything a running lecture needs to judge a tap without a query."""
+    __slots__ = ("session_id", "course_code", "lecturer_id", "roster", "positions", "marked", "last_activity")
+
+    def __init__(self, session: LectureSessionBase, roster: Roster, marked: set[int]):
+        self.session_id = session.id
+        self.course_code = session.course_code
+        self.lecturer_id = session.lecturer_id
+        self.roster = roster
+        self.positions = {student_id: i for i, student_id in enumerate(roster.student_ids)}
+        self.marked = marked
+        self.last_activity = time.monotonic()
+
+    def present_positions(self) -> list[int]:
+        return sorted(self.positions[s] for s in self.marked if s in self.positions)
+
+
+def _load_context(conn: sqlite3.Connection, session_id: int, course_code: str) -> tuple[Roster, set[int]]:
+    roster = load_course_roster(conn, session_id, course_code)
+    # Taps already stored, for a session reopened after a restart or a repeated start message
+    marked = {row[0] for row in conn.execute(
+        "SELECT student_id FROM attendance_records WHERE session_id = ? AND attended;", (session_id,))}
+    return roster, marked
+
+
+class SessionContexts:
+    """
+    Open lecture sessions, keyed by session id. A context is built once when
+    the session starts; from then on every tap is validated and deduplicated
+    in memory. Closing a session writes its final attendance, absentees
+    included, in one batch and evicts the context.
+    """
+    def __init__(self, db: Database = default_db):
+        self.db = db
+        self._open: collections.OrderedDict[int, SessionContext] = collections.OrderedDict()
+        self._sweeper: asyncio.Task | None = None
+        self.counts = collections.Counter()
+
+    def __len__(self):
+        return len(self._open)
+
+    def get(self, session_id: int) -> SessionContext | None:
+        return self._open.get(session_id)
+
+    async def open(self, session: LectureSessionBase) -> SessionContext:
+        context = self._open.get(session.id)
+        if context is None:
+            roster, marked = await self.db.read(_load_context, session.id, session.course_code)
+            context = self._open[session.id] = SessionContext(session, roster, marked)
+            self.counts["opened"] += 1
+            while len(self._open) > MAX_OPEN_SESSIONS:
+                await self.close(next(iter(self._open)))
+        return context
+
+    async def reload_courses(self, course_codes: set[str]):
+        """Rebuilds the rosters of open sessions after their courses' registrations changed."""
+        for context in [c for c in self._open.values() if c.course_code in course_codes]:
+            roster = await self.db.read(load_course_roster, context.session_id, context.course_code)
+            context.roster = roster
+            context.positions = {student_id: i for i, student_id in enumerate(roster.student_ids)}
+
+    def check_tap(self, session_id: int, student_id: int) -> str:
+        """Classifies a tap and, unless it is a duplicate, marks the student present."""
+        context = self._open.get(session_id)
+        if context is None:
+            status = TAP_NO_CONTEXT
+        elif student_id in context.marked:
+            status = TAP_DUPLICATE
+        else:
+            context.marked.add(student_id)
+            context.last_activity = time.monotonic()
+            self._open.move_to_end(session_id)
+            status = TAP_NEW if student_id in context.positions else TAP_UNREGISTERED
+        self.counts[status] += 1
+        return status
+
+    async def close(self, session_id: int) -> SessionContext | None:
+        context = self._open.pop(session_id, None)
+        if context is None:
+            return None
+        # Taps still queued for ingestion carry the real tap times, so they land first
+        await get_ingestor().queue.join()
+        present = context.present_positions()
+        await self.db.write(apply_attendance, context.roster, present, datetime.now())
+        self.counts["closed"] += 1
+        log.info("Session %d closed with %d present, %d absent", session_id, len(context.marked), len(context.roster) - len(present))
+        return context
+
+    def sweep(self) -> list[int]:
+        """Session ids idle for longer than SESSION_IDLE_TIMEOUT_S."""
+        cutoff = time.monotonic() - SESSION_IDLE_TIMEOUT_S
+        return [sid for sid, c in self._open.items() if c.last_activity < cutoff]
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL_S)
+            for session_id in self.sweep():
+                try:
+                    await self.close(session_id)
+                except Exception as e:
+                    log.error("Session %d: failed to close abandoned session: %s", session_id, e)
+
+    def start(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        """Stops sweeping. Open sessions are dropped, not closed: the lecture may go on after a restart."""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+        self._open.clear()
+
+    def snapshot(self) -> dict:
+        return {"open_sessions": len(self._open), **self.counts}
+
+
+session_contexts = SessionContexts()
+cluster.subscribe(REGISTRATIONS_CHANGED_TOPIC, lambda payload: session_contexts.reload_courses(set(payload["course_codes"])))
@@ -1,104 +1,314 @@
 import sqlite3
-from typing import Optional, List
+import json
+from typing import Optional, List, AsyncIterator, Type
 from datetime import datetime
-from fastapi import FastAPI, Depends, HTTPException, status, Response
-from models import LecturerBase, StudentBase, CourseBase
-from database import get_db_connection
+from pydantic import BaseModel, ValidationError
+from fastapi import FastAPI, Depends, HTTPException, status, Response, Request, Query
+from fastapi.responses import StreamingResponse
+from models import (
+    LecturerBase, StudentBase, CourseBase, LectureSessionBase, StudentAttendanceRecordBase, CourseRegistrationBase,
+    BatchSyncResult, BatchRowError, ChangeFeed,
+)
+from database import Database, get_database
+from identity_index import identity_index, STUDENT, LECTURER
+from course_catalog import course_catalog
+from session_context import REGISTRATIONS_CHANGED_TOPIC
+from cluster import cluster
+from changes import FeedEntity, FEED_ENTITIES, read_page, read_changes, CHANGE_FEED_DEFAULT_LIMIT, CHANGE_FEED_MAX_LIMIT
+import fast_json
+from log import get_logger
+
+log = get_logger("sync")
+
+BATCH_CHUNK_SIZE = 500 # rows per executemany transaction
+STREAM_PAGE_SIZE = 1000 # rows read per keyset page while streaming a listing
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+class BulkEntity:
+    """
+    Describes how rows of one synced table are upserted in bulk.
+    Upserts are keyed on the table's primary key so re-pushing the same
+    roster is idempotent. A composite key is given as a tuple of columns.
+    """
+    def __init__(self, table: str, model: Type[BaseModel], key: str | tuple, columns: tuple, identity_kind: Optional[str] = None):
+        self.table = table
+        self.model = model
+        self.keys = (key,) if isinstance(key, str) else key
+        self.columns = columns
+        self.identity_kind = identity_kind # Set for tables whose cards live in the identity index
+        updates = ", ".join(f"{c} = excluded.{c}" for c in columns if c not in self.keys)
+        self.upsert_sql = (
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)}) "
+            f"ON CONFLICT({', '.join(self.keys)}) " + (f"DO UPDATE SET {updates};" if updates else "DO NOTHING;")
+        )
+
+    def params(self, row: BaseModel) -> tuple:
+        return tuple(getattr(row, c) for c in self.columns)
+
+    def key_of(self, row: BaseModel) -> str:
+        return ":".join(str(getattr(row, k)) for k in self.keys)
+
+
+LECTURERS = BulkEntity("lecturers", LecturerBase, "id", ("id", "name", "sch_id", "rfid_uid"), LECTURER)
+STUDENTS = BulkEntity("students", StudentBase, "id", ("id", "name", "sch_id", "rfid_uid"), STUDENT)
+COURSES = BulkEntity("courses", CourseBase, "code", ("code", "course_id", "title", "level", "faculty", "dept"))
+REGISTRATIONS = BulkEntity("course_registrations", CourseRegistrationBase, ("course_code", "student_id"), ("course_code", "student_id"))
+
+
+async def _iter_batch_body(request: Request) -> AsyncIterator:
+    """
+    Yields raw row objects from either a JSON array body or a streamed
+    NDJSON body (one JSON object per line), without buffering NDJSON.
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith(NDJSON_MEDIA_TYPE):
+        pending = b""
+        async for chunk in request.stream():
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield line
+        if pending.strip():
+            yield pending
+        return
+
+    try:
+        rows = await request.json()
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid JSON body: {e}")
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Batch body must be a JSON array")
+    for row in rows:
+        yield row
+
+
+def _write_chunk(conn: sqlite3.Connection, entity: BulkEntity, chunk: list, errors: List[BatchRowError]) -> int:
+    """
+    Upserts one chunk of (index, row) pairs in a single transaction.
+    If the chunk violates a constraint the chunk is replayed row by row
+    under savepoints so only the offending rows are reported.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.executemany(entity.upsert_sql, [entity.params(row) for _, row in chunk])
+        conn.commit()
+        return len(chunk)
+    except sqlite3.IntegrityError:
+        conn.rollback()
+    finally:
+        cursor.close()
+
+    written = 0
+    cursor = conn.cursor()
+    try:
+        cursor.execute("BEGIN;")
+        for index, row in chunk:
+            cursor.execute("SAVEPOINT bulk_row;")
+            try:
+                cursor.execute(entity.upsert_sql, entity.params(row))
+                cursor.execute("RELEASE bulk_row;")
+                written += 1
+            except sqlite3.IntegrityError as e:
+                cursor.execute("ROLLBACK TO bulk_row;")
+                cursor.execute("RELEASE bulk_row;")
+                errors.append(BatchRowError(index=index, key=entity.key_of(row), detail=f"Integrity error: {e}"))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return written
+
+
+async def _bulk_sync(entity: BulkEntity, request: Request, db: Database) -> BatchSyncResult:
+    errors: List[BatchRowError] = []
+    chunk = []
+    received = written = 0
+
+    async def flush(chunk: list) -> int:
+        errors_before = len(errors)
+        count = await db.write(_write_chunk, entity, chunk, errors)
+        if entity.identity_kind:
+            failed = {e.index for e in errors[errors_before:]}
+            for index, row in chunk:
+                if index not in failed:
+                    identity_index.put(entity.identity_kind, row.id, row.rfid_uid)
+        if entity is COURSES and count:
+            course_catalog.invalidate()
+        if entity is REGISTRATIONS and count:
+            await cluster.publish(REGISTRATIONS_CHANGED_TOPIC, {"course_codes": sorted({row.course_code for _, row in chunk})})
+        return count
+
+    try:
+        async for raw in _iter_batch_body(request):
+            index = received
+            received += 1
+            try:
+                if isinstance(raw, (bytes, str)):
+                    row = entity.model.model_validate_json(raw)
+                else:
+                    row = entity.model.model_validate(raw)
+            except ValidationError as e:
+                errors.append(BatchRowError(index=index, detail=f"Validation error: {e.errors(include_url=False)}"))
+                continue
+            chunk.append((index, row))
+            if len(chunk) >= BATCH_CHUNK_SIZE:
+                written += await flush(chunk)
+                chunk = []
+        if chunk:
+            written += await flush(chunk)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error bulk syncing {entity.table}: {e}")
+    errors.sort(key=lambda e: e.index)
+    log.info("Bulk synced %s: %d/%d rows written, %d errors", entity.table, written, received, len(errors))
+    return BatchSyncResult(received=received, written=written, failed=len(errors), errors=errors)
+
+
+async def _stream_rows(db: Database, entity: FeedEntity, page: list, ndjson: bool) -> AsyncIterator[bytes]:
+    """
+    Streams a whole table one keyset page at a time, so memory stays bounded
+    by STREAM_PAGE_SIZE however large the table is.
+    """
+    first = True
+    if not ndjson:
+        yield b"["
+    while page:
+        if ndjson:
+            yield b"".join(fast_json.dumps(row) + b"\n" for row in page)
+        else:
+            encoded = b",".join(fast_json.dumps(row) for row in page)
+            yield encoded if first else b"," + encoded
+        first = False
+        if len(page) < STREAM_PAGE_SIZE:
+            break
+        page = await db.read(read_page, entity, tuple(page[-1][k] for k in entity.keys), STREAM_PAGE_SIZE)
+    if not ndjson:
+        yield b"]"
+
+
+async def _insert_one(db: Database, sql: str, params: tuple, what: str):
+    try:
+        await db.execute(sql, params)
+    except sqlite3.IntegrityError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Integrity error syncing {what}: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error syncing {what}: {e}")
 
 
 class Sync:
     def __init__(self, app: FastAPI):
         self.app = app
         self._register_routes()
-    
+        for name, model in (("lecturers", LecturerBase), ("students", StudentBase), ("courses", CourseBase),
+                            ("sessions", LectureSessionBase), ("attendance", StudentAttendanceRecordBase)):
+            self._register_read_route(FEED_ENTITIES[name], model)
+
+    def _register_read_route(self, entity: FeedEntity, model: Type[BaseModel]):
+        """
+        GET /cs/sync/<entity> lists rows in primary-key order. With ?limit= it
+        returns one keyset page (continue with ?after_id= from the
+        X-Next-After-Id header); without it, every row is streamed page by page
+        as a JSON array, or as NDJSON when asked for. With ?since=<cursor> it
+        instead returns only rows changed (and keys deleted) after that cursor.
+        Rows are encoded straight from the cursor, without Pydantic re-validation.
+        """
+        @self.app.get(f"/cs/sync/{entity.name}", response_model=List[model], name=f"get_{entity.name}",
+                      responses={200: {"model": ChangeFeed, "description": "Change feed when `since` is given"}})
+        async def get_rows(
+            request: Request,
+            since: Optional[int] = Query(None, ge=0, description="Change cursor from a previous feed response"),
+            after_id: Optional[str] = Query(None, description="Primary key to continue after; 'session_id:student_id' for attendance"),
+            limit: Optional[int] = Query(None, ge=1, le=CHANGE_FEED_MAX_LIMIT),
+            format: Optional[str] = Query(None, pattern="^(json|ndjson)$"),
+            db: Database = Depends(get_database),
+        ):
+            if since is not None:
+                feed = await db.read(read_changes, entity, since, limit or CHANGE_FEED_DEFAULT_LIMIT)
+                return Response(content=fast_json.dumps(feed), media_type="application/json")
+
+            try:
+                after = entity.parse_after(after_id) if after_id is not None else None
+            except ValueError as e:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+            first = await db.read(read_page, entity, after, limit or STREAM_PAGE_SIZE)
+            if not first and after is None:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"No {entity.name} found")
+
+            ndjson = format == "ndjson" or (format is None and NDJSON_MEDIA_TYPE in request.headers.get("accept", ""))
+            if limit is not None:
+                headers = {"X-Next-After-Id": entity.format_after(first[-1])} if len(first) == limit else {}
+                if ndjson:
+                    return Response(content=b"".join(fast_json.dumps(r) + b"\n" for r in first),
+                                    media_type=NDJSON_MEDIA_TYPE, headers=headers)
+                return Response(content=fast_json.dumps(first), media_type="application/json", headers=headers)
+            return StreamingResponse(_stream_rows(db, entity, first, ndjson),
+                                     media_type=NDJSON_MEDIA_TYPE if ndjson else "application/json")
+
     def _register_routes(self):
         @self.app.post("/cs/sync/lecturers")
-        async def sync_lecturers(lecturer: LecturerBase, db: sqlite3.Connection = Depends(get_db_connection)):
-            cursor = db.cursor()
-            try:
-                if lecturer is not None:
-                    cursor.execute("""
-                        INSERT INTO lecturers (id, name, sch_id, rfid_uid) VALUES (?, ?, ?, ?);""", 
-                        (lecturer.id, lecturer.name, lecturer.sch_id, lecturer.rfid_uid))
-                else:
-                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid lecturer data provided")
-                db.commit()
-                print(f"Successfully synced lecturer: {lecturer.name} with ID {lecturer.sch_id}")
-                return Response(status_code=status.HTTP_201_CREATED)
-            except sqlite3.IntegrityError as e:
-                db.rollback()
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, details=f"Integrity error syncing lecturer: {e}")
-            except Exception as e:
-                db.rollback()
-                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, details=f"Error syncing lecturer: {e}")
-            finally:
-                cursor.close()
+        async def sync_lecturers(lecturer: LecturerBase, db: Database = Depends(get_database)):
+            await _insert_one(db, """
+                INSERT INTO lecturers (id, name, sch_id, rfid_uid) VALUES (?, ?, ?, ?);""",
+                (lecturer.id, lecturer.name, lecturer.sch_id, lecturer.rfid_uid), "lecturer")
+            identity_index.put(LECTURER, lecturer.id, lecturer.rfid_uid)
+            log.debug("Synced lecturer %s with ID %s", lecturer.name, lecturer.sch_id)
+            return Response(status_code=status.HTTP_201_CREATED)
                 
         @self.app.post("/cs/sync/students")
-        async def sync_students(student: StudentBase, db: sqlite3.Connection = Depends(get_db_connection)):
-            print(f"Received lecturer sync request: {student}")
-            cursor = db.cursor()
-            try:
-                if student is not None:
-                    cursor.execute("""
-                        INSERT INTO students (id, name, sch_id, rfid_uid) VALUES (?, ?, ?, ?);"""
-                        (student.id, student.name, student.sch_id, student.rfid_uid))
-                else:
-                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid student data provided")
-                db.commit()
-                print(f"Successfully synced student: {student.name} with ID {student.sch_id}")
-                return Response(status_code=status.HTTP_201_CREATED)
-            except sqlite3.IntegrityError as e:
-                db.rollback()
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, details=f"Integrity error syncing lecturer: {e}")
-            except Exception as e:
-                db.rollback()
-                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, details=f"Error syncing lecturer: {e}")
+        async def sync_students(student: StudentBase, db: Database = Depends(get_database)):
+            await _insert_one(db, """
+                INSERT INTO students (id, name, sch_id, rfid_uid) VALUES (?, ?, ?, ?);""",
+                (student.id, student.name, student.sch_id, student.rfid_uid), "student")
+            identity_index.put(STUDENT, student.id, student.rfid_uid)
+            log.debug("Synced student %s with ID %s", student.name, student.sch_id)
+            return Response(status_code=status.HTTP_201_CREATED)
 
         @self.app.post("/cs/sync/courses")
-        async def sync_courses(course: CourseBase, db: sqlite3.Connection = Depends(get_db_connection)):
-        
+        async def sync_courses(course: CourseBase, db: Database = Depends(get_database)):
+            await _insert_one(db, """
+                INSERT INTO courses (code, course_id, title, level, faculty, dept) VALUES (?, ?, ?, ?, ?, ?);""",
+                (course.code, course.course_id, course.title, course.level, course.faculty, course.dept), "course")
+            course_catalog.invalidate()
+            log.debug("Synced course %s with code %s", course.title, course.code)
+            return Response(status_code=status.HTTP_201_CREATED)
+
+        @self.app.post("/cs/sync/lecturers:batch", response_model=BatchSyncResult)
+        async def sync_lecturers_batch(request: Request, db: Database = Depends(get_database)):
+            return await _bulk_sync(LECTURERS, request, db)
+
+        @self.app.post("/cs/sync/students:batch", response_model=BatchSyncResult)
+        async def sync_students_batch(request: Request, db: Database = Depends(get_database)):
+            return await _bulk_sync(STUDENTS, request, db)
+
+        @self.app.post("/cs/sync/courses:batch", response_model=BatchSyncResult)
+        async def sync_courses_batch(request: Request, db: Database = Depends(get_database)):
+            return await _bulk_sync(COURSES, request, db)
+
+        @self.app.post("/cs/sync/registrations:batch", response_model=BatchSyncResult)
+        async def sync_registrations_batch(request: Request, db: Database = Depends(get_database)):
+            return await _bulk_sync(REGISTRATIONS, request, db)
+
+        @self.app.delete("/cs/sync/registrations/{course_code}")
+        async def delete_registrations(course_code: str, db: Database = Depends(get_database)):
+            """Clears a course's registrations, so its roster can be pushed again from scratch."""
             try:
-                cursor = db.cursor()
-                if course is not None:
-                    cursor.execute("""
-                        INSERT INTO courses (code, course_id, title) VALUES (?, ?, ?)""", 
-                        (course.code, course.course_id, course.title))
-                    db.commit()
-                    print(f"Successfully synced course: {course.title} with code {course.code}")
-                else:
-                    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid course data provided")
-                db.commit()
-                print(f"Successfully synced course: {course.title} with code {course.code}")
-                
-            except sqlite3.IntegrityError as e:
-                db.rollback()
-                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, details=f"Integrity error syncing course: {e}")
+                deleted = await db.execute("DELETE FROM course_registrations WHERE course_code = ?;", (course_code,))
             except Exception as e:
-                db.rollback()
-                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, details=f"Error syncing course: {e}")
-                
-        @self.app.get("/cs/sync/lecturers", response_model=List[LecturerBase])
-        async def get_lecturers(db: sqlite3.Connection = Depends(get_db_connection)):
-            cursor = db.cursor()
-            cursor.execute("SELECT id, name, sch_id, rfid_uid FROM lecturers;")
-            rows = cursor.fetchall()
-            list_of_dicts = [dict(row) for row in rows]
-            print(rows, list_of_dicts)
-            if not rows:
-                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No lecturers found")
-            return list_of_dicts
+                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error deleting registrations: {e}")
+            await cluster.publish(REGISTRATIONS_CHANGED_TOPIC, {"course_codes": [course_code]})
+            return {"message": f"Deleted {deleted} registrations for {course_code}."}
 
         @self.app.delete("/cs/sync/lecturers",)
-        async def delete_lecturers(db: sqlite3.Connection = Depends(get_db_connection)):
-            cursor = db.cursor()
+        async def delete_lecturers(db: Database = Depends(get_database)):
             try:
-                cursor.execute("DELETE FROM lecturers;")
-                db.commit()
-                print("All lecturers deleted successfully.")
+                await db.execute("DELETE FROM lecturers;")
+                identity_index.clear(LECTURER)
+                log.info("All lecturers deleted")
                 return {"message": "All lecturers deleted successfully."}
             except Exception as e:
-                db.rollback()
                 raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error deleting lecturers: {e}")
-            finally:
-                cursor.close()
\ No newline at end of file
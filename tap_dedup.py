@@ -0,0 +1,74 @@
+# tap_dedup.py (Repeated taps absorbed in memory before they reach the ingest queue)
+import collections
+import os
+import time
+
+# A repeat of the same student's tap within this many seconds of the last one is dropped
+TAP_DEDUP_WINDOW_S = float(os.environ.get("TAP_DEDUP_WINDOW_S", 300))
+# Beyond this the least recently seen tap is forgotten; about 100 bytes each
+TAP_DEDUP_MAX_ENTRIES = int(os.environ.get("TAP_DEDUP_MAX_ENTRIES", 50000))
+
+
+class TapDeduplicator:
+    """
+    Remembers recent (session_id, student_id) taps for a sliding window.
+    Students tap two or three times and QoS 1 redelivers, so during the
+    burst at the start of a lecture most taps are repeats; catching them
+    here keeps them off the ingest queue, whether or not the session has
+    an in-memory context. Entries are kept in the order they were last
+    seen, so expired ones are always at the front and the memory cap
+    evicts the least recently seen first.
+    """
+    def __init__(self, window_s: float = TAP_DEDUP_WINDOW_S, max_entries: int = TAP_DEDUP_MAX_ENTRIES):
+        self.window_s = window_s
+        self.max_entries = max_entries
+        self._seen: collections.OrderedDict[tuple[int, int], float] = collections.OrderedDict()
+        self.counts = collections.Counter()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def is_duplicate(self, session_id: int, student_id: int) -> bool:
+        """True for a repeat within the window; either way the tap now counts as the last one seen."""
+        now = time.monotonic()
+        self._expire(now)
+        key = (session_id, student_id)
+        duplicate = key in self._seen
+        self._seen[key] = now
+        self._seen.move_to_end(key)
+        if duplicate:
+            self.counts["suppressed"] += 1
+            return True
+        self.counts["passed"] += 1
+        while len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+            self.counts["evicted"] += 1
+        return False
+
+    def _expire(self, now: float):
+        cutoff = now - self.window_s
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if seen_at > cutoff:
+                return
+            del self._seen[key]
+            self.counts["expired"] += 1
+
+    def clear(self):
+        self._seen.clear()
+
+    def snapshot(self) -> dict:
+        checked = self.counts["passed"] + self.counts["suppressed"]
+        return {
+            "entries": len(self._seen),
+            "window_s": self.window_s,
+            "max_entries": self.max_entries,
+            "passed": self.counts["passed"],
+            "suppressed": self.counts["suppressed"],
+            "suppression_rate": round(self.counts["suppressed"] / checked, 3) if checked else 0.0,
+            "expired": self.counts["expired"],
+            "evicted": self.counts["evicted"],
+        }
+
+
+tap_dedup = TapDeduplicator()
@@ -0,0 +1,143 @@
+# test_enrollment_terminals.py (SerialTerminal against pty fakes, and the manager's queue across terminals)
+import asyncio
+import pytest
+from enrollment_manager import EnrollmentError, EnrollmentManager, EnrollmentTerminal, SerialTerminal
+from fake_terminal import FakeTerminal, REPLY_GARBLED, REPLY_SILENT, REPLY_UID
+
+pytest.importorskip("serial") # SerialTerminal opens its port through pyserial
+
+
+def _enroll_on_fake(reply: str, timeout: float = 1.0) -> tuple[str | None, list[str]]:
+    """Runs one SerialTerminal enrollment against a fake terminal; returns the UID and the progress lines."""
+    progress = []
+    async def notify(stage: str, details: str, extra: dict):
+        progress.append(details)
+
+    async def run():
+        terminal = SerialTerminal(fake.port, reset_delay=0, timeout=timeout)
+        try:
+            return await terminal.enroll("u1", "Test User", notify)
+        finally:
+            await terminal.close()
+
+    fake = FakeTerminal(tap_delay=0.05, uid_prefix="TEST", reply=reply).start()
+    try:
+        return asyncio.run(run()), progress
+    finally:
+        fake.stop()
+
+
+def test_serial_terminal_reads_uid():
+    uid, progress = _enroll_on_fake(REPLY_UID)
+    assert uid is not None and uid.startswith("TEST")
+    assert "ESP32: Waiting for card..." in progress # Progress lines are relayed before the UID
+
+
+def test_serial_terminal_times_out_without_a_card():
+    uid, progress = _enroll_on_fake(REPLY_SILENT, timeout=0.3)
+    assert uid is None
+    assert "ESP32: Waiting for card..." in progress
+
+
+def test_serial_terminal_rejects_garbled_uid():
+    with pytest.raises(EnrollmentError, match="garbled UID"):
+        _enroll_on_fake(REPLY_GARBLED)
+
+
+class HeldTerminal(EnrollmentTerminal):
+    """Holds each enrollment until the test lets it finish."""
+    def __init__(self, name: str):
+        self.name = name
+        self.release = asyncio.Event()
+        self.enrolled: list[str] = []
+
+    async def enroll(self, user_id: str, user_name: str, notify) -> str | None:
+        await self.release.wait()
+        self.release.clear()
+        self.enrolled.append(user_id)
+        return f"UID_{user_id}"
+
+
+def test_manager_reports_queue_positions_across_terminals():
+    async def run():
+        terminals = [HeldTerminal("a"), HeldTerminal("b")]
+        manager = EnrollmentManager(terminals)
+        await manager.start()
+        updates: dict[str, list[tuple[str, dict]]] = {}
+
+        def enroll(user_id: str) -> asyncio.Task:
+            async def notify(stage: str, details: str, extra: dict):
+                updates[user_id].append((stage, extra))
+            updates[user_id] = []
+            return asyncio.create_task(manager.enroll(f"session-{user_id}", user_id, user_id, notify))
+
+        def position(user_id: str) -> int | None:
+            queued = [extra["position"] for stage, extra in updates[user_id] if stage == "QUEUED"]
+            return queued[-1] if queued else None
+
+        async def settle():
+            for _ in range(20):
+                await asyncio.sleep(0)
+
+        try:
+            jobs = [enroll(f"u{i}") for i in range(1, 5)]
+            await settle()
+            # Two jobs on the two terminals, the other two waiting in order
+            running = {extra["terminal"] for user_id in ("u1", "u2")
+                       for stage, extra in updates[user_id] if stage == "WAITING_FOR_CARD"}
+            assert running == {"a", "b"}
+            assert (position("u3"), position("u4")) == (1, 2)
+            assert manager.queue_depth == 2
+
+            terminals[0].release.set() # Terminal a frees up: u3 moves onto it, u4 moves up
+            await settle()
+            assert await jobs[0] == "UID_u1"
+            assert ("WAITING_FOR_CARD", {"terminal": "a"}) in updates["u3"]
+            assert position("u4") == 1
+            assert manager.queue_depth == 1
+
+            terminals[1].release.set() # Then b: u4 moves onto it and the queue is empty
+            await settle()
+            assert await jobs[1] == "UID_u2"
+            assert ("WAITING_FOR_CARD", {"terminal": "b"}) in updates["u4"]
+            assert manager.queue_depth == 0
+
+            for terminal in terminals:
+                terminal.release.set()
+            assert await asyncio.gather(*jobs[2:]) == ["UID_u3", "UID_u4"]
+        finally:
+            await manager.stop()
+
+    asyncio.run(run())
+
+
+def test_manager_stop_fails_the_job_being_announced():
+    """A job taken off the queue but not yet on its terminal is failed by stop(), not left waiting forever."""
+    async def run():
+        terminal = HeldTerminal("a")
+        manager = EnrollmentManager([terminal])
+        await manager.start()
+        announcing = False
+        stuck = asyncio.Event()
+
+        async def notify(stage: str, details: str, extra: dict):
+            pass
+        async def slow_notify(stage: str, details: str, extra: dict):
+            if announcing and stage == "QUEUED":
+                stuck.set()
+                await asyncio.Event().wait() # A position update that never gets through
+
+        jobs = [asyncio.create_task(manager.enroll("s1", "u1", "u1", notify)),
+                asyncio.create_task(manager.enroll("s2", "u2", "u2", notify)),
+                asyncio.create_task(manager.enroll("s3", "u3", "u3", slow_notify))]
+        await asyncio.sleep(0.01)
+        announcing = True
+        terminal.release.set() # u1 finishes; the worker takes u2 and is held up telling u3 its position
+        await asyncio.wait_for(stuck.wait(), 1)
+        await manager.stop()
+        assert await jobs[0] == "UID_u1"
+        for job in jobs[1:]:
+            with pytest.raises(EnrollmentError, match="shutting down"):
+                await asyncio.wait_for(job, 1)
+
+    asyncio.run(run())
@@ -0,0 +1,58 @@
+# test_lms_outbox.py (Changes are queued for the LMS only while an upload is configured)
+import asyncio
+import sqlite3
+import pytest
+from database import Database, init_db
+from lms_uploader import OutboxUploader
+from metrics import Gauge
+
+
+def _record_session(conn: sqlite3.Connection, session_id: int):
+    conn.execute("INSERT INTO lecturers (id, name, sch_id, rfid_uid) VALUES (?, ?, ?, ?) ON CONFLICT DO NOTHING;",
+                 (1, "Lecturer 1", "L00001", "LUID00000001"))
+    conn.execute("INSERT INTO courses (code, course_id, title, level, faculty, dept) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING;",
+                 ("SEET-CSC101", 1, "Course 1", 100, "SEET", "CSC"))
+    conn.execute("INSERT INTO lecture_sessions (id, course_code, lecturer_id, session_date) VALUES (?, ?, ?, ?);",
+                 (session_id, "SEET-CSC101", 1, "2024-03-01 09:00:00"))
+
+def _outbox_rows(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT COUNT(*) FROM lms_outbox;").fetchone()[0]
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "central_server.db"))
+    yield db
+    db.close()
+
+
+def test_outbox_fills_while_upload_is_configured(db):
+    async def scenario():
+        await init_db(db, outbox=True)
+        await db.write(_record_session, 1)
+        return await db.read(_outbox_rows)
+    assert asyncio.run(scenario()) == 1
+
+
+def test_outbox_stays_put_while_upload_is_disabled(db):
+    async def scenario():
+        await init_db(db, outbox=True)
+        await db.write(_record_session, 1)
+        await init_db(db, outbox=False) # Restarted without LMS_UPLOAD_URL
+        await db.write(_record_session, 2)
+        uploader = OutboxUploader(url=None, db=db)
+        uploader.start()
+        await uploader._task
+        await uploader.stop()
+        return await db.read(_outbox_rows), uploader
+    rows, uploader = asyncio.run(scenario())
+    assert rows == 1 # Left from before, kept for when the upload is configured again
+    assert uploader.stats.depth == 1
+    gauge = Gauge("test_lms_outbox_depth", "Outbox depth.", collect=lambda: uploader.stats.depth)
+    assert gauge.render()[-1] == "test_lms_outbox_depth 1"
+
+
+def test_depth_is_not_reported_before_it_is_counted():
+    uploader = OutboxUploader(url=None)
+    gauge = Gauge("test_lms_outbox_uncounted", "Outbox depth.", collect=lambda: uploader.stats.depth)
+    assert gauge.render()[2:] == []
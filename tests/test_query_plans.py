@@ -0,0 +1,53 @@
+# test_query_plans.py (Every indexed lookup in migrations.QUERY_PLAN_CHECKS keeps its index)
+import sqlite3
+import pytest
+import database
+from migrations import MIGRATIONS, QUERY_PLAN_CHECKS, migrate, rebuild_attendance_stats, schema_version
+
+LEVELS = (100, 200, 300, 400, 500)
+FACULTIES = ("SEET", "SAAT", "SOS")
+DEPTS = ("CSC", "EEE", "MTH", "PHY")
+
+
+def _seed(conn: sqlite3.Connection):
+    """A small term's worth of data, shaped like a real one so the planner's statistics are too."""
+    conn.executemany("INSERT INTO lecturers (id, name, sch_id, rfid_uid) VALUES (?, ?, ?, ?);",
+                     [(i, f"Lecturer {i}", f"L{i:05d}", f"LUID{i:08X}") for i in range(1, 31)])
+    facets = [(level, faculty, dept) for level in LEVELS for faculty in FACULTIES for dept in DEPTS]
+    courses = [(f"{faculty}-{dept}{level + i}", n, f"Course {n}", level, faculty, dept)
+               for n, ((level, faculty, dept), i) in enumerate((facet, i) for facet in facets for i in (1, 2))]
+    conn.executemany("INSERT INTO courses (code, course_id, title, level, faculty, dept) VALUES (?, ?, ?, ?, ?, ?);", courses)
+    conn.executemany("INSERT INTO students (id, name, sch_id, rfid_uid) VALUES (?, ?, ?, ?);",
+                     [(i, f"Student {i}", f"S{i:07d}", f"SUID{i:08X}") for i in range(1, 2001)])
+    conn.executemany("INSERT INTO course_registrations (course_code, student_id) VALUES (?, ?);",
+                     [(courses[(student + k) % len(courses)][0], student) for student in range(1, 2001) for k in range(6)])
+    sessions = [(i, courses[i % len(courses)][0], 1 + i % 30, f"2024-{1 + i % 12:02d}-{1 + i % 28:02d} 09:00:00")
+                for i in range(1, 1201)]
+    conn.executemany("INSERT INTO lecture_sessions (id, course_code, lecturer_id, session_date) VALUES (?, ?, ?, ?);", sessions)
+    conn.executemany("INSERT INTO attendance_records (session_id, student_id, attendance_time, attended) VALUES (?, ?, ?, ?);",
+                     [(session, 1 + (session * 7 + k) % 2000, "2024-03-01 09:05:00", int(k % 5 != 0))
+                      for session in range(1, 1201) for k in range(40)])
+
+
+@pytest.fixture(scope="module")
+def conn(tmp_path_factory):
+    conn = database._connect(str(tmp_path_factory.mktemp("plans") / "central_server.db"))
+    migrate(conn)
+    _seed(conn)
+    rebuild_attendance_stats(conn)
+    conn.execute("ANALYZE;")
+    conn.commit()
+    database._attach_archives(conn) # The all_* views
+    yield conn
+    conn.close()
+
+
+def test_migrated_to_latest(conn):
+    assert schema_version(conn) == MIGRATIONS[-1].version
+
+
+@pytest.mark.parametrize("sql, expected", [check[1:] for check in QUERY_PLAN_CHECKS],
+                         ids=[check[0] for check in QUERY_PLAN_CHECKS])
+def test_query_plan_uses_index(conn, sql, expected):
+    plan = " / ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}"))
+    assert expected in plan